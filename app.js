@@ -13,6 +13,11 @@ let attraction = parseInt(localStorage.getItem('attraction') || '0');
 let currentGame = null;
 let nsfwMode = localStorage.getItem('nsfwMode') !== 'false'; // Default to true
 let messageHistoryCount = parseInt(localStorage.getItem('messageHistoryCount') || '8'); // Default to 8
+// server.py, which stores uploaded profile pictures and serves thumbnails under /avatar/
+const PROGRESS_SERVER_URL = localStorage.getItem('progressServerUrl') || 'http://localhost:3000';
+// '/avatar/<hash>' on the server, or a small data URL when the server couldn't be reached.
+// Older versions kept the full image as a data URL in profilePictureData.
+let profilePictureURL = localStorage.getItem('profilePictureURL') || localStorage.getItem('profilePictureData') || '';
 
 // Voice recording variables
 let mediaRecorder = null;
@@ -267,11 +272,13 @@ function loadSavedData() {
     toggleGroqModelSection();
 
     // Load saved profile picture
-    const savedProfilePic = localStorage.getItem('profilePictureData');
-    if (savedProfilePic) {
+    if (profilePictureURL) {
         const profilePic = document.getElementById('profilePic');
         if (profilePic) {
-            profilePic.src = savedProfilePic;
+            profilePic.src = profilePictureSrc(200);
+        }
+        if (localStorage.getItem('profilePictureData')) {
+            migrateProfilePicture();
         }
     }
 
@@ -476,39 +483,88 @@ function handleProfilePicSelect(event) {
     }
 }
 
-function saveProfilePicture() {
+async function saveProfilePicture() {
     const fileInput = document.getElementById('profilePicInput');
     if (!fileInput || !fileInput.files[0]) {
         alert('Please select an image file first.');
         return;
     }
 
-    const file = fileInput.files[0];
-    const reader = new FileReader();
+    try {
+        await storeProfilePicture(fileInput.files[0]);
+    } catch (error) {
+        alert('Error reading file. Please try again.');
+        return;
+    }
 
-    reader.onload = function(e) {
-        const imageData = e.target.result;
+    // Update the profile picture display
+    const profilePic = document.getElementById('profilePic');
+    if (profilePic) {
+        profilePic.src = profilePictureSrc(200);
+    }
 
-        // Update the profile picture display
-        const profilePic = document.getElementById('profilePic');
-        if (profilePic) {
-            profilePic.src = imageData;
-        }
+    // Close modal
+    closeProfilePicModal();
 
-        // Store in localStorage
-        localStorage.setItem('profilePictureData', imageData);
+    alert('Profile picture updated successfully!');
+}
 
-        // Close modal
-        closeProfilePicModal();
+// URL of the profile picture for display `size` pixels wide (thumbnails are rendered at 2x for
+// high-DPI screens); no size gets the original
+function profilePictureSrc(size) {
+    if (!profilePictureURL) {
+        return 'images/sweet_neutral.svg';
+    }
+    if (profilePictureURL.startsWith('/avatar/')) {
+        return PROGRESS_SERVER_URL + profilePictureURL + (size ? `?size=${size}` : '');
+    }
+    return profilePictureURL;
+}
 
-        alert('Profile picture updated successfully!');
-    };
+// Upload the picture once; the server keeps it by content hash and pre-renders thumbnails.
+// Without the server, a 200px copy is kept locally instead of the full image.
+async function storeProfilePicture(blob) {
+    try {
+        const response = await fetch(`${PROGRESS_SERVER_URL}/avatar`, {
+            method: 'POST',
+            headers: { 'Content-Type': blob.type || 'application/octet-stream' },
+            body: blob
+        });
+        if (!response.ok) {
+            throw new Error(`HTTP ${response.status}`);
+        }
+        profilePictureURL = (await response.json()).url;
+    } catch (error) {
+        console.warn('Profile picture upload failed, keeping a local thumbnail:', error);
+        profilePictureURL = await shrinkImage(blob, 200);
+    }
+    localStorage.setItem('profilePictureURL', profilePictureURL);
+    localStorage.removeItem('profilePictureData');
+}
 
-    reader.onerror = function() {
-        alert('Error reading file. Please try again.');
-    };
+async function migrateProfilePicture() {
+    try {
+        const blob = await (await fetch(localStorage.getItem('profilePictureData'))).blob();
+        await storeProfilePicture(blob);
+        const profilePic = document.getElementById('profilePic');
+        if (profilePic) {
+            profilePic.src = profilePictureSrc(200);
+        }
+    } catch (error) {
+        console.warn('Could not move the saved profile picture:', error);
+    }
+}
 
-    reader.readAsDataURL(file);
+// Centre-cropped square JPEG data URL, `size` pixels wide
+async function shrinkImage(blob, size) {
+    const bitmap = await createImageBitmap(blob);
+    const side = Math.min(bitmap.width, bitmap.height);
+    const canvas = document.createElement('canvas');
+    canvas.width = canvas.height = size;
+    canvas.getContext('2d').drawImage(bitmap, (bitmap.width - side) / 2, (bitmap.height - side) / 2,
+                                      side, side, 0, 0, size, size);
+    bitmap.close();
+    return canvas.toDataURL('image/jpeg', 0.85);
 }
 
 async function sendMessage() {
@@ -674,13 +730,11 @@ function displayChatHistory() {
         // Create profile picture element for AI messages
         let profilePicElement = null;
         if (msg.sender === 'ai' || msg.sender === 'game_ai') {
-            const savedProfilePic = localStorage.getItem('profilePictureData');
-            const profileSrc = savedProfilePic || 'images/sweet_neutral.svg';
             profilePicElement = document.createElement('img');
-            profilePicElement.src = profileSrc;
+            profilePicElement.src = profilePictureSrc(80);
             profilePicElement.alt = 'AI Profile';
             profilePicElement.className = 'profile-pic message-profile-pic';
-            profilePicElement.onclick = () => showProfilePreview(profileSrc);
+            profilePicElement.onclick = () => showProfilePreview(profilePictureSrc());
         }
 
         // Create main content container
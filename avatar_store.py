@@ -0,0 +1,203 @@
+import base64
+import binascii
+import hashlib
+import io
+import os
+import re
+import tempfile
+
+# PIL is imported on first upload, so loading a pre-rendered thumbnail never pays for it.
+# Without Pillow originals are still stored and served, just without thumbnails.
+
+AVATAR_DIR = os.path.join('data', 'avatars')
+# Square thumbnails rendered once per upload: chatbot.py's 30px avatar, and the web page's 40px
+# message and 100px header pictures at 2x for high-DPI screens
+THUMBNAIL_SIZES = (30, 80, 200)
+MAX_AVATAR_BYTES = 8 * 1024 * 1024  # for pictures uploaded over HTTP
+MAX_AVATAR_PIXELS = 40 * 1000 * 1000  # refuse decompression bombs before decoding them
+# Local pictures over either limit are shrunk to fit this box instead of being refused
+IMPORT_MAX_SIDE = 1024
+AVATAR_URL_PREFIX = '/avatar/'
+PROFILE_PICTURE_FIELD = 'profilePictureURL'  # in progress documents
+HASH_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+DATA_URL_PATTERN = re.compile(r'^data:image/[\w.+-]+;base64,', re.IGNORECASE)
+# Leading bytes -> Content-Type. SVG is deliberately not accepted: it can carry scripts.
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+)
+
+class AvatarError(ValueError):
+    pass
+
+def image_type(data):
+    # Content-Type of a supported image, or None
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, content_type in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    return None
+
+def avatar_hash(data):
+    return hashlib.sha256(data).hexdigest()[:32]
+
+def avatar_url(digest, size=None):
+    return AVATAR_URL_PREFIX + digest + (f'?size={size}' if size else '')
+
+def decode_data_url(url):
+    # Image bytes of a base64 `data:image/...` URL, or None if it isn't one
+    match = DATA_URL_PATTERN.match(url) if isinstance(url, str) else None
+    if match is None:
+        return None
+    try:
+        return base64.b64decode(url[match.end():], validate=True)
+    except (binascii.Error, ValueError):
+        return None
+
+def render_thumbnails(data, sizes=THUMBNAIL_SIZES):
+    # {size: PNG bytes}, or {} when Pillow isn't installed. Each thumbnail is a centred square
+    # crop, rendered from the next larger one so the full image is only resampled once.
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return {}
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if image.width * image.height > MAX_AVATAR_PIXELS:
+                raise AvatarError(f'Image is larger than {MAX_AVATAR_PIXELS} pixels')
+            # JPEGs can be decoded at a fraction of their size, far cheaper than a full decode
+            image.draft('RGB', (max(sizes) * 2, max(sizes) * 2))
+            transparent = 'A' in image.getbands() or 'transparency' in image.info
+            image = ImageOps.exif_transpose(image).convert('RGBA' if transparent else 'RGB')
+    except (OSError, Image.DecompressionBombError) as e:
+        raise AvatarError(f'Unreadable image: {e}')
+    thumbnails = {}
+    for size in sorted(sizes, reverse=True):
+        image = ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, 'PNG', optimize=True)
+        thumbnails[size] = out.getvalue()
+    return thumbnails
+
+def fit_for_import(data):
+    # A picture chosen on this machine, downscaled to IMPORT_MAX_SIDE when it is over the byte
+    # or pixel limits; anything within them is returned unchanged, so it hashes like an upload.
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        if len(data) > MAX_AVATAR_BYTES:
+            raise AvatarError(f'Image is larger than {MAX_AVATAR_BYTES} bytes; install Pillow to shrink it')
+        return data
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if len(data) <= MAX_AVATAR_BYTES and image.width * image.height <= MAX_AVATAR_PIXELS:
+                return data
+            image.draft('RGB', (IMPORT_MAX_SIDE, IMPORT_MAX_SIDE))
+            transparent = 'A' in image.getbands() or 'transparency' in image.info
+            image = ImageOps.exif_transpose(image).convert('RGBA' if transparent else 'RGB')
+    except (OSError, Image.DecompressionBombError) as e:
+        raise AvatarError(f'Unreadable image: {e}')
+    image.thumbnail((IMPORT_MAX_SIDE, IMPORT_MAX_SIDE), Image.Resampling.LANCZOS)
+    out = io.BytesIO()
+    if transparent:
+        image.save(out, 'PNG', optimize=True)
+    else:
+        image.save(out, 'JPEG', quality=90)
+    return out.getvalue()
+
+class AvatarStore:
+    # Profile pictures stored once under a hash of their bytes, as `<hash>` plus a
+    # `<hash>-<size>.png` thumbnail per THUMBNAIL_SIZES. Files are immutable once written, so
+    # their URLs can be cached forever, and uploading the same picture again is free.
+    def __init__(self, directory=AVATAR_DIR, sizes=THUMBNAIL_SIZES):
+        self.directory = directory
+        self.sizes = tuple(sorted(sizes))
+
+    def path(self, digest, size=None):
+        name = digest if size is None else f'{digest}-{size}.png'
+        return os.path.join(self.directory, name)
+
+    def exists(self, digest):
+        return bool(HASH_PATTERN.match(digest)) and os.path.exists(self.path(digest))
+
+    def put(self, data, max_bytes=None):
+        # Store an image and its thumbnails; returns its hash. Raises AvatarError for anything
+        # that isn't a supported image within the size limits.
+        if max_bytes is not None and len(data) > max_bytes:
+            raise AvatarError(f'Image is larger than {max_bytes} bytes')
+        if image_type(data) is None:
+            raise AvatarError('Not a PNG, JPEG, GIF, WebP or BMP image')
+        digest = avatar_hash(data)
+        if self.exists(digest):
+            return digest
+        thumbnails = render_thumbnails(data, self.sizes)
+        os.makedirs(self.directory, exist_ok=True)
+        for size, body in thumbnails.items():
+            self._write(self.path(digest, size), body)
+        # The original goes last: once it exists, the thumbnails do too
+        self._write(self.path(digest), data)
+        return digest
+
+    def put_data_url(self, url):
+        # Hash of the image in a base64 data URL, stored if it wasn't already; None if `url`
+        # isn't an image data URL
+        data = decode_data_url(url)
+        return self.put(data, MAX_AVATAR_BYTES) if data is not None else None
+
+    def externalize(self, document):
+        # Move an inline base64 profile picture out of a progress document into the store,
+        # leaving its /avatar/ URL in its place. True if the document changed; pictures that
+        # aren't valid images are left as they are.
+        url = document.get(PROFILE_PICTURE_FIELD)
+        if not isinstance(url, str) or not url.startswith('data:'):
+            return False
+        try:
+            digest = self.put_data_url(url)
+        except AvatarError:
+            return False
+        if digest is None:
+            return False
+        document[PROFILE_PICTURE_FIELD] = avatar_url(digest)
+        return True
+
+    def thumbnail_path(self, digest, size):
+        # Path of the smallest thumbnail at least `size` pixels wide, or None if there is none
+        for candidate in self.sizes:
+            if candidate >= size:
+                path = self.path(digest, candidate)
+                if os.path.exists(path):
+                    return path
+        return None
+
+    def open(self, digest, size=None):
+        # (binary file, Content-Type) for a stored picture, or None. Asking for a size gets the
+        # nearest thumbnail at least that big, or the original when there is none.
+        if not HASH_PATTERN.match(digest):
+            return None
+        path = self.thumbnail_path(digest, size) if size is not None else None
+        if path is not None:
+            return open(path, 'rb'), 'image/png'
+        try:
+            f = open(self.path(digest), 'rb')
+        except FileNotFoundError:
+            return None
+        content_type = image_type(f.read(16)) or 'application/octet-stream'
+        f.seek(0)
+        return f, content_type
+
+    def _write(self, path, body):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(body)
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+            raise
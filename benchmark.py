@@ -0,0 +1,352 @@
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+
+from cryptography.fernet import Fernet
+
+from chat_log import ChatLog
+
+# Drives server.py and chat_log.ChatLog with synthetic data and reports throughput and latency
+# percentiles as JSON, so runs can be compared across commits:
+#
+#   python benchmark.py server --history 10,1000,100000 --concurrency 16 --output before.json
+#   python benchmark.py chatlog --conversations 20000
+#
+# The server runs as a subprocess in a scratch directory, so it never touches ./data and the
+# load generator doesn't share its GIL.
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SEED = 1234
+DEFAULT_HISTORY_SIZES = '10,1000,100000'
+DEFAULT_REQUESTS = 1000
+DEFAULT_USERS = 50
+DEFAULT_CONCURRENCY = 16
+# Fewer requests are made for big documents so one scenario doesn't move more than this
+MAX_MB_PER_SCENARIO = 2000
+UNLIMITED = 1 << 30  # for server.py request limits the benchmark turns off
+RECENT_HISTORY_LIMIT = 50
+SERVER_START_TIMEOUT = 30.0
+
+# Shapes taken from data/*.json
+PERSONALITIES = ('sweet', 'playful', 'sexy', 'goth')
+ATTRACTION_LEVELS = (('stranger', 20), ('friend', 40), ('girlfriend', 60), ('lover', 80), ('soulmate', 100))
+WORDS = ('hey', 'there', 'how', 'was', 'your', 'day', 'i', 'missed', 'you', 'so', 'much', 'tell', 'me',
+         'about', 'it', 'that', 'sounds', 'amazing', 'what', 'are', 'we', 'doing', 'tonight', 'love',
+         'the', 'way', 'think', 'really', 'want', 'to', 'know', 'more', 'haha', 'honestly', 'cute')
+
+def synthetic_text(rng, min_words=3, max_words=40):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+
+def synthetic_turn(rng, role):
+    return {'role': role, 'parts': [{'text': synthetic_text(rng) + ('\n' if role == 'model' else '')}]}
+
+def synthetic_progress(rng, turns, avatar_kb=16):
+    level, next_level = rng.choice(ATTRACTION_LEVELS)
+    return {
+        'personality': rng.choice(PERSONALITIES),
+        'companionGender': rng.choice(('female', 'male')),
+        'attraction': {'level': level, 'points': rng.randint(0, next_level - 1), 'nextLevel': next_level},
+        'chatHistory': [synthetic_turn(rng, 'user' if i % 2 == 0 else 'model') for i in range(turns)],
+        # Uploaded avatars are stored inline as data URLs
+        'profilePictureURL': 'data:image/jpeg;base64,' + 'A' * (avatar_kb * 1024),
+    }
+
+def synthetic_conversation(rng, index):
+    return {
+        'timestamp': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(1700000000 + index * 60)),
+        'user_message': synthetic_text(rng),
+        'bot_response': synthetic_text(rng, 10, 80),
+    }
+
+def latency_summary(latencies):
+    if not latencies:
+        return {}
+    ordered = sorted(latencies)
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000
+
+    return {
+        'p50_ms': round(rank(0.50), 3),
+        'p99_ms': round(rank(0.99), 3),
+        'p999_ms': round(rank(0.999), 3),
+        'max_ms': round(ordered[-1] * 1000, 3),
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3),
+    }
+
+def scenario_result(name, latencies, elapsed, errors=0, **params):
+    result = {'scenario': name, **params, 'operations': len(latencies), 'errors': errors,
+              'seconds': round(elapsed, 3),
+              'throughput_per_s': round(len(latencies) / elapsed, 1) if elapsed > 0 else None}
+    result.update(latency_summary(latencies))
+    return result
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+class ServerProcess:
+    # server.py running in a scratch working directory with a known encryption key
+    def __init__(self, mode, storage, workers, write_behind_ms, cache_mb, processes=1):
+        self.workdir = tempfile.mkdtemp(prefix='progress-bench-')
+        self.port = free_port()
+        self.argv = [sys.executable, os.path.join(REPO_DIR, 'server.py'), '--port', str(self.port),
+                     '--mode', mode, '--storage', storage, '--workers', str(workers),
+                     '--processes', str(processes),
+                     '--write-behind-ms', str(write_behind_ms), '--cache-mb', str(cache_mb),
+                     '--trace-sample-rate', '0',
+                     # All load comes from one address and the largest documents are big; only
+                     # the server itself should limit throughput here
+                     '--client-rate', '0', '--client-concurrency', str(UNLIMITED),
+                     '--max-concurrent', str(UNLIMITED), '--max-body-mb', '4096',
+                     '--upload-memory-mb', str(UNLIMITED)]
+        self.process = None
+        self.cipher = None
+
+    def __enter__(self):
+        os.makedirs(os.path.join(self.workdir, 'data'))
+        key = Fernet.generate_key()
+        with open(os.path.join(self.workdir, 'data', 'encryption.key'), 'wb') as f:
+            f.write(key)
+        self.cipher = Fernet(key)
+        self.process = subprocess.Popen(self.argv, cwd=self.workdir, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'server exited with status {self.process.returncode}')
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return self
+            except OSError:
+                time.sleep(0.05)
+        self.__exit__(None, None, None)
+        raise RuntimeError('server did not start listening')
+
+    def __exit__(self, *exc_info):
+        if self.process is not None and self.process.poll() is None:
+            # SIGTERM lets the server drain buffered saves, like a normal shutdown
+            self.process.terminate()
+            try:
+                self.process.wait(30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def token(self, api_key):
+        return self.cipher.encrypt(api_key.encode()).decode()
+
+def run_requests(port, count, make_request, concurrency):
+    # `concurrency` threads, each on its own keep-alive connection, work through `count`
+    # requests built by make_request(i) -> (method, path, body). Only the round trip is timed.
+    latencies = []
+    errors = [0]
+    next_index = [0]
+    lock = threading.Lock()
+
+    def worker():
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+        local = []
+        failed = 0
+        while True:
+            with lock:
+                i = next_index[0]
+                next_index[0] += 1
+            if i >= count:
+                break
+            method, path, body = make_request(i)
+            headers = {'Content-Type': 'application/json', 'Accept-Encoding': 'gzip'} if body else {}
+            start = time.perf_counter()
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                response.read()
+                ok = response.status == 200
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+                ok = False
+            if ok:
+                local.append(time.perf_counter() - start)
+            else:
+                failed += 1
+        connection.close()
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - start, errors[0]
+
+def bench_server(args):
+    results = []
+    for turns in args.history:
+        rng = random.Random(SEED + turns)
+        document = json.dumps(synthetic_progress(rng, turns, args.avatar_kb)).encode()
+        requests = min(args.requests, max(args.concurrency,
+                                          args.max_mb_per_scenario * 1024 * 1024 // len(document)))
+        params = {'historyTurns': turns, 'documentBytes': len(document), 'users': args.users,
+                  'concurrency': args.concurrency, 'mode': args.mode, 'storage': args.storage,
+                  'processes': args.processes}
+        users = [f'bench-user-{i:05d}' for i in range(args.users)]
+
+        with ServerProcess(args.mode, args.storage, args.workers, args.write_behind_ms,
+                           args.cache_mb, args.processes) as server:
+            tokens = [quote(server.token(user)) for user in users]
+
+            def save(i):
+                prefix = b'{"apiKey": ' + json.dumps(users[i % len(users)]).encode() + b', "progress": '
+                return 'POST', '/save-progress', prefix + document + b'}'
+
+            def load(i):
+                return 'GET', f'/load-progress?apiKey={tokens[i % len(tokens)]}', None
+
+            def load_recent(i):
+                return 'GET', (f'/load-progress?apiKey={tokens[i % len(tokens)]}'
+                               f'&historyLimit={RECENT_HISTORY_LIMIT}'), None
+
+            # Saves run first so every user has a document to load
+            for name, make_request in (('save', save), ('load', load), ('load_recent', load_recent)):
+                latencies, elapsed, errors = run_requests(server.port, requests, make_request,
+                                                          args.concurrency)
+                results.append(scenario_result(name, latencies, elapsed, errors, **params))
+                print(f'{name:12} {turns:>7} turns: {results[-1]["throughput_per_s"]} req/s, '
+                      f'p99 {results[-1].get("p99_ms")} ms', file=sys.stderr)
+    return results
+
+def bench_chatlog(args):
+    # The ChatbotGUI persistence path without Tk: log the user message, then supersede it with
+    # the finished conversation, then reopen and read the startup tail and older pages
+    rng = random.Random(SEED)
+    workdir = tempfile.mkdtemp(prefix='chatlog-bench-')
+    path = os.path.join(workdir, 'chat_history.jsonl')
+    params = {'conversations': args.conversations}
+    results = []
+    try:
+        log = ChatLog(path, legacy_path=None)
+        appends, updates = [], []
+        for i in range(args.conversations):
+            conversation = synthetic_conversation(rng, i)
+            partial = {'timestamp': conversation['timestamp'], 'user_message': conversation['user_message']}
+            t0 = time.perf_counter()
+            position = log.append(partial)
+            t1 = time.perf_counter()
+            log.update(position, conversation)
+            t2 = time.perf_counter()
+            appends.append(t1 - t0)
+            updates.append(t2 - t1)
+        log.close()
+        # The two phases alternate per conversation, so each one's time is the sum of its own calls
+        results.append(scenario_result('chatlog_append', appends, sum(appends), **params))
+        results.append(scenario_result('chatlog_update', updates, sum(updates), **params))
+
+        opens = []
+        start = time.perf_counter()
+        for _ in range(args.reopens):
+            t0 = time.perf_counter()
+            log = ChatLog(path, legacy_path=None)
+            log.tail(args.tail)
+            opens.append(time.perf_counter() - t0)
+            log.close()
+        results.append(scenario_result('chatlog_open_tail', opens, time.perf_counter() - start,
+                                       tail=args.tail, **params))
+
+        log = ChatLog(path, legacy_path=None)
+        pages = []
+        start = time.perf_counter()
+        for _ in range(args.page_reads):
+            first = rng.randrange(max(1, len(log) - args.page_size))
+            t0 = time.perf_counter()
+            log.read(first, first + args.page_size)
+            pages.append(time.perf_counter() - t0)
+        results.append(scenario_result('chatlog_read_page', pages, time.perf_counter() - start,
+                                       pageSize=args.page_size, **params))
+        log.close()
+        results[-1]['logBytes'] = os.path.getsize(path)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    for result in results:
+        print(f'{result["scenario"]:18} {result["throughput_per_s"]} ops/s, p99 {result.get("p99_ms")} ms',
+              file=sys.stderr)
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks for the progress server and chat log')
+    subparsers = parser.add_subparsers(dest='suite', required=True)
+
+    server = subparsers.add_parser('server', help='drive /save-progress and /load-progress')
+    server.add_argument('--output', help='write the JSON report here instead of stdout')
+    server.add_argument('--mode', default='threaded', help='server.py --mode')
+    server.add_argument('--storage', default='files', help='server.py --storage')
+    server.add_argument('--workers', type=int, default=32, help='server.py --workers')
+    server.add_argument('--processes', type=int, default=1, help='server.py --processes')
+    server.add_argument('--write-behind-ms', type=int, default=500, help='server.py --write-behind-ms')
+    server.add_argument('--cache-mb', type=int, default=64, help='server.py --cache-mb')
+    server.add_argument('--history', default=DEFAULT_HISTORY_SIZES,
+                        help='comma-separated chatHistory sizes in turns')
+    server.add_argument('--users', type=int, default=DEFAULT_USERS)
+    server.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+    server.add_argument('--requests', type=int, default=DEFAULT_REQUESTS, help='requests per scenario')
+    server.add_argument('--max-mb-per-scenario', type=int, default=MAX_MB_PER_SCENARIO,
+                        help='fewer requests are made for large documents to stay under this')
+    server.add_argument('--avatar-kb', type=int, default=16, help='size of the inline profile picture')
+
+    chatlog = subparsers.add_parser('chatlog', help='ChatbotGUI persistence without the GUI')
+    chatlog.add_argument('--output', help='write the JSON report here instead of stdout')
+    chatlog.add_argument('--conversations', type=int, default=10000)
+    chatlog.add_argument('--reopens', type=int, default=50)
+    chatlog.add_argument('--tail', type=int, default=200, help='conversations read at startup')
+    chatlog.add_argument('--page-reads', type=int, default=1000)
+    chatlog.add_argument('--page-size', type=int, default=50)
+
+    args = parser.parse_args(argv)
+    if args.suite == 'server':
+        args.history = [int(size) for size in args.history.split(',') if size]
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = {
+        'suite': args.suite,
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'startedAt': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'settings': {k: v for k, v in vars(args).items() if k not in ('output', 'suite')},
+    }
+    report['results'] = bench_server(args) if args.suite == 'server' else bench_chatlog(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+import json
+import os
+from array import array
+
+LOG_FILE = 'chat_history.jsonl'
+LEGACY_FILE = 'chat_history.json'
+INDEX_SUFFIX = '.idx'
+OFFSET_BYTES = array('Q').itemsize
+# The index starts with a format tag and the number of superseded lines in the log, so the
+# count survives a reopen; an index without the tag is rebuilt
+INDEX_MAGIC = b'CHATIDX1'
+INDEX_HEADER_BYTES = len(INDEX_MAGIC) + OFFSET_BYTES
+# Rewrite the log once superseded lines reach half the live ones (and at least this many)
+COMPACT_MIN_DEAD = 64
+
+class ChatLog:
+    # Append-only JSON-lines store for ChatbotGUI conversations.
+    #
+    # Each line is {"i": position, "c": conversation}; a later line for the same position
+    # replaces the earlier one, so finishing a reply is one more append rather than a rewrite.
+    # A sidecar index (<log>.idx) holds the byte offset of the current line for every position,
+    # which makes appends O(1) and lets any range be read without scanning the file, plus the
+    # count of superseded lines that decides when the log is compacted.
+    def __init__(self, path=LOG_FILE, legacy_path=LEGACY_FILE):
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+        self.legacy_path = legacy_path
+        self.offsets = array('Q')
+        self.dead = 0  # superseded lines in the log
+        self._log = None
+        self._index = None
+        self._open()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def read(self, start, end=None):
+        end = len(self.offsets) if end is None else min(end, len(self.offsets))
+        conversations = []
+        for i in range(max(0, start), end):
+            self._log.seek(self.offsets[i])
+            conversations.append(json.loads(self._log.readline())['c'])
+        return conversations
+
+    def tail(self, count):
+        return self.read(len(self.offsets) - count)
+
+    def append(self, conversation):
+        position = len(self.offsets)
+        offset = self._write_line(position, conversation)
+        self.offsets.append(offset)
+        self._index.seek(INDEX_HEADER_BYTES + position * OFFSET_BYTES)
+        self._index.write(array('Q', [offset]).tobytes())
+        self._index.flush()
+        return position
+
+    def update(self, position, conversation):
+        # Checked before writing so a stale position (e.g. after clear) leaves the log untouched
+        if not 0 <= position < len(self.offsets):
+            raise IndexError(f'no conversation at position {position}')
+        offset = self._write_line(position, conversation)
+        self.offsets[position] = offset
+        self.dead += 1
+        self._index.seek(INDEX_HEADER_BYTES + position * OFFSET_BYTES)
+        self._index.write(array('Q', [offset]).tobytes())
+        self._write_dead_count()
+        self._index.flush()
+        if self.dead >= max(COMPACT_MIN_DEAD, len(self.offsets) // 2):
+            self.compact()
+
+    def clear(self):
+        self._log.truncate(0)
+        self._index.truncate(INDEX_HEADER_BYTES)
+        self.offsets = array('Q')
+        self.dead = 0
+        self._write_dead_count()
+        self._index.flush()
+
+    def compact(self):
+        # Rewrite only the current line for each position, then swap both files in
+        conversations = self.read(0)
+        self.close()
+        self._write_files(conversations)
+        self._open()
+
+    def close(self):
+        for f in (self._log, self._index):
+            if f is not None:
+                f.flush()
+                f.close()
+        self._log = self._index = None
+
+    def _open(self):
+        if not os.path.exists(self.path) and self.legacy_path and os.path.exists(self.legacy_path):
+            self._migrate_legacy()
+        # a+b: every write lands at the end even if we seeked elsewhere to read
+        self._log = open(self.path, 'a+b')
+        size = self._repair_tail()
+        self._index = open(self.index_path, 'r+b' if os.path.exists(self.index_path) else 'w+b')
+        header = self._index.read(INDEX_HEADER_BYTES)
+        data = self._index.read()
+        self.offsets = array('Q')
+        valid = (len(header) == INDEX_HEADER_BYTES and header.startswith(INDEX_MAGIC)
+                 and len(data) % OFFSET_BYTES == 0)
+        if valid:
+            self.offsets.frombytes(data)
+            self.dead = int.from_bytes(header[len(INDEX_MAGIC):], 'little')
+        if not valid or not self._index_matches(size):
+            self._rebuild_index()
+
+    def _write_line(self, position, conversation):
+        line = json.dumps({'i': position, 'c': conversation}).encode() + b'\n'
+        self._log.seek(0, os.SEEK_END)
+        offset = self._log.tell()
+        self._log.write(line)
+        self._log.flush()
+        return offset
+
+    def _repair_tail(self):
+        # A crash mid-write leaves a line without its newline; drop it
+        self._log.seek(0, os.SEEK_END)
+        size = self._log.tell()
+        end = size
+        while end > 0:
+            start = max(0, end - 4096)
+            self._log.seek(start)
+            newline = self._log.read(end - start).rfind(b'\n')
+            if newline != -1:
+                end = start + newline + 1
+                break
+            end = start
+        if end != size:
+            self._log.truncate(end)
+        return end
+
+    def _index_matches(self, size):
+        # The newest line is always the one at the largest offset, and it must end at EOF
+        if not self.offsets:
+            return size == 0
+        last = max(self.offsets)
+        if last >= size:
+            return False
+        self._log.seek(last)
+        self._log.readline()
+        return self._log.tell() == size
+
+    def _rebuild_index(self):
+        offsets = array('Q')
+        dead = 0
+        self._log.seek(0)
+        offset = 0
+        for line in self._log:
+            try:
+                position = json.loads(line)['i']
+            except (ValueError, KeyError, TypeError):
+                position = None
+            if position == len(offsets):
+                offsets.append(offset)
+            elif isinstance(position, int) and 0 <= position < len(offsets):
+                offsets[position] = offset
+                dead += 1
+            else:
+                dead += 1
+            offset += len(line)
+        self.offsets = offsets
+        self.dead = dead
+        self._index.seek(0)
+        self._index.truncate()
+        self._index.write(index_header(dead) + offsets.tobytes())
+        self._index.flush()
+
+    def _write_dead_count(self):
+        self._index.seek(len(INDEX_MAGIC))
+        self._index.write(self.dead.to_bytes(OFFSET_BYTES, 'little'))
+
+    def _write_files(self, conversations):
+        offsets = array('Q')
+        tmp_log = self.path + '.tmp'
+        with open(tmp_log, 'wb') as f:
+            for position, conversation in enumerate(conversations):
+                offsets.append(f.tell())
+                f.write(json.dumps({'i': position, 'c': conversation}).encode() + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        tmp_index = self.index_path + '.tmp'
+        with open(tmp_index, 'wb') as f:
+            f.write(index_header(0) + offsets.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        # If we die between the two renames the index no longer matches and is rebuilt on open
+        os.replace(tmp_log, self.path)
+        os.replace(tmp_index, self.index_path)
+
+    def _migrate_legacy(self):
+        # One-time import of the old chat_history.json; the original is kept as a backup
+        with open(self.legacy_path, 'r') as f:
+            conversations = json.load(f).get('conversations', [])
+        self._write_files(conversations)
+        os.replace(self.legacy_path, self.legacy_path + '.migrated')
+
+def index_header(dead):
+    return INDEX_MAGIC + dead.to_bytes(OFFSET_BYTES, 'little')
+
+def read_snapshot(path=LOG_FILE, count=None):
+    # The current conversation at each position below `count`, read on a handle of its own so
+    # another thread can call it while a ChatLog has the file open. The file is read in one go
+    # so the handle isn't held open across a compaction. A line still being written at the end
+    # of the file is skipped.
+    with open(path, 'rb') as f:
+        data = f.read()
+    latest = {}
+    for line in data.splitlines():
+        try:
+            entry = json.loads(line)
+            position = entry['i']
+        except (ValueError, KeyError, TypeError):
+            continue
+        if count is None or position < count:
+            latest[position] = entry['c']
+    size = max(latest, default=-1) + 1 if count is None else count
+    return [latest.get(position, {}) for position in range(size)]
@@ -1,13 +1,166 @@
+import time
+# Taken before anything else is imported so the startup report includes import time
+STARTUP_STARTED = time.perf_counter()
 import tkinter as tk
 from tkinter import ttk, scrolledtext
-import google.generativeai as genai
 from tkinter import messagebox, filedialog
 import json
 import os
 from datetime import datetime
 from ctypes import windll, byref, c_int, sizeof
-from PIL import Image, ImageTk
-import shutil
+import threading
+import queue
+from collections import deque
+from chat_log import ChatLog, read_snapshot
+from response_cache import ResponseCache
+from metrics import MetricsRegistry, TraceSampler
+from search_index import SearchIndex
+from avatar_store import AvatarError, AvatarStore, fit_for_import
+# google.generativeai (with its gRPC/protobuf stack) and PIL are imported on first use: the
+# SDK when the first message is sent, PIL when a new profile picture has to be thumbnailed
+IMPORTS_DONE = time.perf_counter()
+
+# How often the Tk loop drains results from the model worker thread
+RESPONSE_POLL_MS = 30
+SYSTEM_PROMPT_FILE = '../system_prompt.json'
+#gemini-2.0-pro-exp-02-05
+#gemini-1.5-pro-latest - old
+MODEL_NAME = 'gemini-2.0-pro-exp-02-05'
+# Also part of the response cache key, so changing it never serves replies made with the old values
+GENERATION_CONFIG = {'temperature': 0.7, 'top_p': 0.8, 'top_k': 40}
+# Past conversations replayed into a new session; older ones are left out to bound the context
+SESSION_HISTORY_CONVERSATIONS = 50
+ERROR_RESPONSE = "Sorry, I encountered an error."
+# Conversations read from the log at startup; older ones stay on disk
+STARTUP_CONVERSATIONS = 200
+# Conversations drawn when the transcript is (re)built, and how many more each scroll to the top adds
+RENDER_WINDOW = 50
+RENDER_PAGE = 50
+# Conversations drawn above a search result when jumping to it
+SEARCH_CONTEXT = 10
+SEARCH_RESULT_LIMIT = 50
+# When set, timing histograms are written here on exit (Prometheus text) and sampled
+# per-message traces next to it as <file>.traces.jsonl
+METRICS_FILE = os.environ.get('CHATBOT_METRICS_FILE')
+TRACE_SAMPLE_RATE = float(os.environ.get('CHATBOT_TRACE_SAMPLE_RATE', '0.1'))
+# Set to print how long imports, the first paint, history and avatar loading took
+STARTUP_REPORT = bool(os.environ.get('CHATBOT_STARTUP_REPORT'))
+# Hash of the profile picture in the avatar store shared with server.py, whose 30px thumbnail
+# is drawn next to replies. profile_picture.png is the single resized copy older versions kept.
+PROFILE_AVATAR_FILE = 'profile_avatar.txt'
+PROFILE_PICTURE_FILE = 'profile_picture.png'
+PROFILE_PICTURE_SIZE = (30, 30)
+
+# Safety settings removed to allow unrestricted conversations
+SAFETY_SETTINGS = [
+    # Using the most permissive settings
+    {
+        "category": "HARM_CATEGORY_HARASSMENT",
+        "threshold": "BLOCK_NONE"
+    },
+    {
+        "category": "HARM_CATEGORY_HATE_SPEECH",
+        "threshold": "BLOCK_NONE"
+    },
+    {
+        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        "threshold": "BLOCK_NONE"
+    },
+    {
+        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+        "threshold": "BLOCK_NONE"
+    }
+]
+
+class ChatSessionManager:
+    # Keeps one model and ChatSession alive across messages. The session is rebuilt only when
+    # the API key or system prompt changes, or after a reply was cut short.
+    def __init__(self):
+        self.chat = None
+        self._session_key = None
+        self._prompt_version = None
+        self._system_prompt = ""
+        self._lock = threading.Lock()
+        # Held while a session is built, so the Tk thread's calls never wait on the SDK import
+        self._build_lock = threading.Lock()
+        self._generation = 0  # bumped by reset() so a session built meanwhile isn't kept
+    
+    def load_system_prompt(self):
+        # Re-read the prompt file only when its mtime or size changes
+        try:
+            st = os.stat(SYSTEM_PROMPT_FILE)
+        except OSError:
+            self._prompt_version = None
+            self._system_prompt = ""
+            return self._system_prompt, None
+        version = (st.st_mtime_ns, st.st_size)
+        if version != self._prompt_version:
+            try:
+                with open(SYSTEM_PROMPT_FILE, 'r') as f:
+                    data = json.load(f)
+                    self._system_prompt = data.get('system_prompt', '')
+            except Exception as e:
+                print(f"Failed to load system prompt: {str(e)}")
+                self._system_prompt = ""
+            self._prompt_version = version
+        return self._system_prompt, version
+    
+    def get_chat(self, api_key, chat_history):
+        with self._build_lock:
+            with self._lock:
+                system_prompt, prompt_version = self.load_system_prompt()
+                session_key = (api_key, prompt_version)
+                if self.chat is not None and session_key == self._session_key:
+                    return self.chat
+                generation = self._generation
+            # Built without self._lock, which reset() and system_prompt() take on the Tk thread
+            chat = self.start_chat(api_key, system_prompt, chat_history)
+            with self._lock:
+                if generation == self._generation:
+                    self.chat = chat
+                    self._session_key = session_key
+            return chat
+    
+    def start_chat(self, api_key, system_prompt, chat_history):
+        # Deferred from startup; the first message pays for the SDK import
+        import google.generativeai as genai
+        
+        # Configure the API
+        genai.configure(api_key=api_key, transport='rest')
+        
+        # Initialize the model with configurations; the system prompt goes in as a
+        # system instruction instead of an extra round trip
+        model = genai.GenerativeModel(
+            model_name=MODEL_NAME,
+            generation_config=genai.GenerationConfig(**GENERATION_CONFIG),
+            safety_settings=SAFETY_SETTINGS,
+            system_instruction=system_prompt or None
+        )
+        return model.start_chat(history=self.seed_history(chat_history))
+    
+    def system_prompt(self):
+        with self._lock:
+            return self.load_system_prompt()[0]
+    
+    def reset(self, chat=None):
+        # Drop the session (only if it is still `chat`, when given) so the next message rebuilds it
+        with self._lock:
+            if chat is None:
+                self._generation += 1
+            if chat is None or chat is self.chat:
+                self.chat = None
+    
+    @staticmethod
+    def seed_history(chat_history):
+        history = []
+        for conversation in chat_history[-SESSION_HISTORY_CONVERSATIONS:]:
+            user_message = conversation.get('user_message')
+            bot_response = conversation.get('bot_response')
+            if not user_message or not bot_response or bot_response == ERROR_RESPONSE:
+                continue
+            history.append({'role': 'user', 'parts': [user_message]})
+            history.append({'role': 'model', 'parts': [bot_response]})
+        return history
 
 class ChatbotGUI:
     def __init__(self, root):
@@ -27,9 +180,46 @@ class ChatbotGUI:
         except Exception as e:
             print(f"Failed to set dark title bar: {e}")
         
-        # Initialize chat history
+        # Timings for model round trips, chat log reads/writes and transcript rendering
+        self.metrics = MetricsRegistry()
+        self.model_latency = self.metrics.histogram('chatbot_model_seconds', 'Model reply time by phase',
+                                                    ('phase',))
+        self.persistence_latency = self.metrics.histogram('chatbot_persistence_seconds',
+                                                          'Chat log call time', ('op',))
+        self.render_latency = self.metrics.histogram('chatbot_render_seconds', 'Transcript render time',
+                                                     ('view',))
+        self.search_latency = self.metrics.histogram('chatbot_search_seconds', 'Search index lookup time')
+        self.trace_sampler = TraceSampler(TRACE_SAMPLE_RATE)
+        self.startup_latency = self.metrics.histogram('chatbot_startup_seconds',
+                                                      'Time from launch until each startup phase finished',
+                                                      ('phase',))
+        self.startup_phases = {}
+        self.record_startup_phase('imports', IMPORTS_DONE)
+        
+        # Chat history is loaded on a background thread once the window is up; messages sent
+        # before it arrives wait in pending_messages
         self.chat_history = []
-        self.load_chat_history()
+        self.chat_log = None
+        self.history_loaded = False
+        # Log positions of chat_history[0] and of the range of conversations drawn in chat_display.
+        # Normally the range runs to the newest conversation; after jumping to a search result
+        # it is a window around the result and grows in both directions as the user scrolls.
+        self.history_start = 0
+        self.rendered_start = 0
+        self.rendered_end = 0
+        self.loading_older = False
+        self.loading_newer = False
+        # Full-text index over every conversation in the log, offsets being log positions.
+        # Built on a background thread after the history loads; None until then.
+        self.search_index = None
+        
+        # Model calls run on a worker thread; results come back through this queue
+        self.session_manager = ChatSessionManager()
+        # Replies to repeated openers are answered locally instead of by the model
+        self.response_cache = ResponseCache()
+        self.response_queue = queue.Queue()
+        self.current_request = None
+        self.pending_messages = deque()
         
         # Configure style
         style = ttk.Style()
@@ -125,16 +315,27 @@ class ChatbotGUI:
         ttk.Button(api_frame, text="Set GF Picture", style='Custom.TButton',
                   command=self.set_profile_picture).pack(side=tk.LEFT, padx=5)
         
-        # Initialize profile picture
+        # Search box for past conversations
+        ttk.Button(api_frame, text="Search", style='Custom.TButton',
+                  command=self.search_history).pack(side=tk.RIGHT)
+        self.search_entry = tk.Entry(api_frame,
+                                    bg='#1e1e1e',
+                                    fg='white',
+                                    insertbackground='#00ff00',
+                                    relief=tk.SOLID,
+                                    borderwidth=1,
+                                    font=default_font,
+                                    width=30)
+        self.search_entry.pack(side=tk.RIGHT, padx=5)
+        self.search_entry.bind('<Return>', lambda e: self.search_history())
+        
+        # The saved profile picture is decoded in the background along with the history. Until
+        # then a blank image of the same size holds its place, so the transcript can be drawn
+        # now and simply re-pointed at the real picture when it arrives.
         self.profile_picture = None
-        self.profile_picture_path = None
-        if os.path.exists('profile_picture.png'):
-            try:
-                image = Image.open('profile_picture.png')
-                image = image.resize((30, 30), Image.Resampling.LANCZOS)
-                self.profile_picture = ImageTk.PhotoImage(image)
-            except Exception as e:
-                print(f"Failed to load profile picture: {e}")
+        self.avatar_store = AvatarStore()
+        if os.path.exists(PROFILE_AVATAR_FILE) or os.path.exists(PROFILE_PICTURE_FILE):
+            self.profile_picture = tk.PhotoImage(width=PROFILE_PICTURE_SIZE[0], height=PROFILE_PICTURE_SIZE[1])
         
         # Chat display
         self.chat_display = scrolledtext.ScrolledText(main_frame, wrap=tk.WORD, 
@@ -146,9 +347,9 @@ class ChatbotGUI:
                                                      relief=tk.SOLID,
                                                      borderwidth=1)
         self.chat_display.grid(row=1, column=0, sticky="WENS")
-        
-        # Display previous chat history if available
-        self.display_chat_history()
+        self.chat_display.tag_configure('search_hit', background='#3a3a20')
+        # Watch the scroll position to pull in older conversations at the top
+        self.chat_display.configure(yscrollcommand=self.on_chat_scroll)
         
         # Message input frame
         input_frame = ttk.Frame(main_frame, style='TFrame')
@@ -168,16 +369,46 @@ class ChatbotGUI:
         
         # Update chat display cursor color
         self.chat_display.configure(insertbackground='#00ff00')
+        self.cancel_button = ttk.Button(input_frame, text="Cancel", style='Custom.TButton',
+                                        command=self.cancel_response, state=tk.DISABLED)
+        self.cancel_button.pack(side=tk.RIGHT, padx=(5, 0))
         send_button = ttk.Button(input_frame, text="Send", style='Custom.TButton',
                                 command=self.send_message)
         send_button.pack(side=tk.RIGHT)
         
+        # Shows how many messages are waiting for the current reply to finish
+        self.status_label = ttk.Label(input_frame, text="", style='TLabel')
+        self.status_label.pack(side=tk.RIGHT, padx=5)
+        self.update_status()
+        
         # Bind Enter key to send message
         self.message_entry.bind('<Return>', lambda e: self.send_message())
         
         # Configure root window grid
         root.columnconfigure(0, weight=1)
         root.rowconfigure(0, weight=1)
+        
+        # Start draining worker results on the Tk thread
+        self.root.after(RESPONSE_POLL_MS, self.process_response_queue)
+        
+        # Everything below runs once the window has been drawn
+        self.root.after_idle(self.on_window_ready)
+    
+    def on_window_ready(self):
+        self.record_startup_phase('interactive')
+        threading.Thread(target=self.load_chat_history, daemon=True).start()
+        if self.profile_picture is not None:
+            threading.Thread(target=self.load_profile_picture, daemon=True).start()
+        else:
+            self.record_startup_phase('avatar')
+    
+    def record_startup_phase(self, phase, at=None):
+        elapsed = (time.perf_counter() if at is None else at) - STARTUP_STARTED
+        self.startup_phases[phase] = elapsed
+        self.startup_latency.observe((phase,), elapsed)
+        if STARTUP_REPORT and {'interactive', 'history', 'avatar'} <= self.startup_phases.keys():
+            print('Startup: ' + ', '.join(f'{name} {seconds * 1000:.0f}ms'
+                                          for name, seconds in self.startup_phases.items()))
     
     def save_api_key(self):
         api_key = self.api_key_entry.get().strip()
@@ -199,21 +430,119 @@ class ChatbotGUI:
             messagebox.showerror("Error", f"Failed to load API key: {str(e)}")
     
     def load_chat_history(self):
+        # Runs on a background thread; the Tk thread picks the result up in finish_history_load.
+        # chat_history.jsonl replaces chat_history.json, which is migrated on first run
+        chat_log = None
+        history = []
         try:
-            if os.path.exists('chat_history.json'):
-                with open('chat_history.json', 'r') as f:
-                    data = json.load(f)
-                    self.chat_history = data.get('conversations', [])
+            with self.persistence_latency.time(('load',)):
+                chat_log = ChatLog()
+                history = chat_log.tail(STARTUP_CONVERSATIONS)
         except Exception as e:
             print(f"Failed to load chat history: {str(e)}")
-            self.chat_history = []
+        self.response_queue.put(('history', None, (chat_log, history)))
+    
+    def finish_history_load(self, chat_log, history):
+        self.chat_log = chat_log
+        self.chat_history = history
+        self.history_start = len(chat_log) - len(history) if chat_log is not None else 0
+        self.history_loaded = True
+        self.display_chat_history()
+        self.record_startup_phase('history')
+        if chat_log is not None:
+            threading.Thread(target=self.build_search_index, args=(chat_log.path, len(chat_log)),
+                             daemon=True).start()
+        else:
+            self.search_index = SearchIndex()
+        if self.pending_messages and self.current_request is None:
+            self.start_request(*self.pending_messages.popleft())
+        self.update_status()
     
-    def save_chat_history(self):
+    def build_search_index(self, path, count):
+        # Background thread: reads the log file directly, since self.chat_log belongs to the Tk
+        # thread. Conversations finished after `count` are added by update_search_index.
+        index = SearchIndex()
         try:
-            with open('chat_history.json', 'w') as f:
-                json.dump({'conversations': self.chat_history}, f, indent=2)
+            with self.persistence_latency.time(('index',)):
+                for conversation in read_snapshot(path, count):
+                    index.add(conversation_text(conversation))
+        except Exception as e:
+            # Offsets would no longer line up with log positions, so go without search
+            print(f"Failed to build search index: {str(e)}")
+            index = None
+        self.response_queue.put(('search_index', None, index))
+    
+    def update_search_index(self):
+        # Index finished conversations the index doesn't have yet
+        if self.search_index is None:
+            return
+        for conversation in self.chat_history[len(self.search_index) - self.history_start:]:
+            self.search_index.add(conversation_text(conversation))
+    
+    def load_profile_picture(self):
+        # Off the Tk thread. The thumbnail was rendered when the picture was chosen, so this
+        # normally just finds the file; a picture from an older version is stored first.
+        try:
+            digest = None
+            if os.path.exists(PROFILE_AVATAR_FILE):
+                with open(PROFILE_AVATAR_FILE) as f:
+                    digest = f.read().strip()
+            if digest is None or not self.avatar_store.exists(digest):
+                with open(PROFILE_PICTURE_FILE, 'rb') as f:
+                    digest = self.store_avatar(f.read())
+            self.response_queue.put(('avatar', None, self.avatar_thumbnail(digest)))
+        except Exception as e:
+            print(f"Failed to load profile picture: {e}")
+            self.response_queue.put(('avatar', None, None))
+    
+    def store_avatar(self, data):
+        # Store (decoding and thumbnailing on first sight) and remember it as the profile picture.
+        # Pictures from disk aren't held to the upload limit; large photos are shrunk instead.
+        digest = self.avatar_store.put(fit_for_import(data))
+        with open(PROFILE_AVATAR_FILE, 'w') as f:
+            f.write(digest)
+        return digest
+    
+    def avatar_thumbnail(self, digest):
+        path = self.avatar_store.thumbnail_path(digest, PROFILE_PICTURE_SIZE[0])
+        if path is None:
+            raise AvatarError('no thumbnail was rendered; is Pillow installed?')
+        return path
+    
+    def apply_profile_picture(self, path):
+        # Thumbnails are PNGs at display size, which Tk loads without PIL or any resizing
+        had_picture = self.profile_picture is not None
+        self.profile_picture = tk.PhotoImage(file=path)
+        # Point the avatars already in the transcript at the new image instead of redrawing it;
+        # a full redraw is only needed when there were no avatars to update
+        if had_picture:
+            for image_name in self.chat_display.image_names():
+                self.chat_display.image_configure(image_name, image=self.profile_picture)
+        else:
+            self.display_chat_history()
+    
+    def save_conversation(self, conversation, position=None):
+        # Appends one line to the log; passing the position of an earlier entry supersedes it
+        if self.chat_log is None:
+            return None
+        try:
+            with self.persistence_latency.time(('append' if position is None else 'update',)):
+                if position is None:
+                    return self.chat_log.append(conversation)
+                self.chat_log.update(position, conversation)
+                return position
         except Exception as e:
             print(f"Failed to save chat history: {str(e)}")
+            return None
+    
+    def dump_metrics(self, path):
+        self.metrics.dump(path)
+        self.trace_sampler.dump(path + '.traces.jsonl')
+    
+    def close_chat_log(self):
+        if self.chat_log is not None:
+            self.chat_log.close()
+            self.chat_log = None
     
     def set_profile_picture(self):
         file_path = filedialog.askopenfilename(
@@ -222,57 +551,197 @@ class ChatbotGUI:
         )
         
         if file_path:
-            try:
-                # Open and resize the image
-                image = Image.open(file_path)
-                image = image.resize((30, 30), Image.Resampling.LANCZOS)
-                
-                # Save the resized image
-                image.save('profile_picture.png')
-                
-                # Update the displayed profile picture
-                self.profile_picture = ImageTk.PhotoImage(image)
-                
-                # Copy the image to Chatbot Test folder
-                shutil.copy2('profile_picture.png', os.path.join('Chatbot Test', 'profile_picture.png'))
-                
-                messagebox.showinfo("Success", "Profile picture updated successfully!")
-                
-                # Refresh the chat display to show the new profile picture
-                self.display_chat_history()
-                
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to set profile picture: {str(e)}")
+            # Decoding a large photo can take a while; the window stays responsive meanwhile
+            threading.Thread(target=self.import_profile_picture, args=(file_path,), daemon=True).start()
+    
+    def import_profile_picture(self, file_path):
+        try:
+            with open(file_path, 'rb') as f:
+                digest = self.store_avatar(f.read())
+            self.response_queue.put(('avatar_set', None, (self.avatar_thumbnail(digest), None)))
+        except Exception as e:
+            self.response_queue.put(('avatar_set', None, (None, str(e))))
     
     def clear_chat_history(self):
+        if not self.history_loaded:
+            return
         if messagebox.askyesno("Clear History", "Are you sure you want to clear all chat history? This cannot be undone."):
+            # A reply still streaming belongs to the history being cleared, and its log position
+            # won't exist afterwards; drop it, and its late chunks are ignored
+            request = self.current_request
+            if request is not None:
+                request['cancelled'].set()
+                self.session_manager.reset()
+                self.current_request = None
+                self.cancel_button.configure(state=tk.DISABLED)
             self.chat_history = []
-            self.save_chat_history()
+            self.history_start = 0
+            if self.chat_log is not None:
+                self.chat_log.clear()
+            # An index still being built is dropped when it arrives
+            self.search_index = SearchIndex()
             self.display_chat_history()
+            if request is not None and self.pending_messages:
+                self.start_request(*self.pending_messages.popleft())
+            self.update_status()
     
-    def display_chat_history(self):
-        # Clear current display
-        self.chat_display.delete('1.0', tk.END)
-        
-        # Display previous conversations
-        for conversation in self.chat_history:
-            # Add timestamp if available
-            if 'timestamp' in conversation:
-                self.chat_display.insert(tk.END, f"--- {conversation['timestamp']} ---\n")
-            
-            # Add user message without profile picture
-            if 'user_message' in conversation:
-                self.chat_display.insert(tk.END, f"You: {conversation['user_message']}\n\n")
+    def display_chat_history(self, around=None):
+        with self.render_latency.time(('window',)):
+            # Clear current display
+            self.chat_display.delete('1.0', tk.END)
+            for mark in self.chat_display.mark_names():
+                if mark.startswith('conv'):
+                    self.chat_display.mark_unset(mark)
             
-            # Add bot response with profile picture
-            if 'bot_response' in conversation:
-                if self.profile_picture:
-                    self.chat_display.image_create(tk.END, image=self.profile_picture)
-                    self.chat_display.insert(tk.END, " ")
-                self.chat_display.insert(tk.END, f"GF: {conversation['bot_response']}\n\n")
+            # Display only the most recent conversations, or a window starting a little above
+            # `around`; the rest are drawn on scroll
+            total = self.history_start + len(self.chat_history)
+            if around is None:
+                self.rendered_start = max(self.history_start, total - RENDER_WINDOW)
+                self.rendered_end = total
+            else:
+                self.rendered_start = max(0, around - SEARCH_CONTEXT)
+                self.rendered_end = min(total, self.rendered_start + RENDER_WINDOW)
+            conversations = self.conversations(self.rendered_start, self.rendered_end)
+            for position, conversation in enumerate(conversations, self.rendered_start):
+                self.render_conversation(conversation, position=position)
         
         # Scroll to bottom
-        self.chat_display.see(tk.END)
+        if around is None:
+            self.chat_display.see(tk.END)
+    
+    def conversations(self, start, end):
+        # Conversations [start, end) from chat_history, reading what isn't loaded from the log.
+        # What is read just above chat_history is kept there; a distant range is not.
+        if start < self.history_start:
+            older = self.chat_log.read(start, min(end, self.history_start)) if self.chat_log is not None else []
+            if end < self.history_start:
+                return older
+            self.chat_history[0:0] = older
+            self.history_start -= len(older)
+            start = max(start, self.history_start)
+        return self.chat_history[start - self.history_start:end - self.history_start]
+    
+    def render_conversation(self, conversation, index=tk.END, position=None):
+        # A left-gravity mark at the start of each conversation lets a search result be scrolled to
+        if position is not None:
+            self.chat_display.mark_set(f'conv{position}', index)
+            self.chat_display.mark_gravity(f'conv{position}', tk.LEFT)
+        
+        # Add timestamp if available
+        if 'timestamp' in conversation:
+            self.chat_display.insert(index, f"--- {conversation['timestamp']} ---\n")
+        
+        # Add user message without profile picture
+        if 'user_message' in conversation:
+            self.chat_display.insert(index, f"You: {conversation['user_message']}\n\n")
+        
+        # Add bot response with profile picture
+        if 'bot_response' in conversation:
+            if self.profile_picture:
+                self.chat_display.image_create(index, image=self.profile_picture)
+                self.chat_display.insert(index, " ")
+            self.chat_display.insert(index, f"GF: {conversation['bot_response']}\n\n")
+    
+    def on_chat_scroll(self, first, last):
+        self.chat_display.vbar.set(first, last)
+        # Defer so the insert doesn't happen inside Tk's scroll callback
+        if float(first) <= 0.0 and self.rendered_start > 0 and not self.loading_older:
+            self.loading_older = True
+            self.root.after_idle(self.load_older_conversations)
+        elif (float(last) >= 1.0 and self.rendered_end < self.history_start + len(self.chat_history)
+              and not self.loading_newer):
+            self.loading_newer = True
+            self.root.after_idle(self.load_newer_conversations)
+    
+    def load_older_conversations(self):
+        self.loading_older = False
+        if self.rendered_start <= 0:
+            return
+        start = max(0, self.rendered_start - RENDER_PAGE)
+        # Fetches from the log only what hasn't been read yet
+        older = self.conversations(start, self.rendered_start)
+        start = self.rendered_start - len(older)
+        if not older:
+            return
+        
+        # Insert above the current text through a right-gravity mark so conversations stay in order,
+        # then shift the view down by what was added so the visible text doesn't jump
+        with self.render_latency.time(('older',)):
+            top_line = int(self.chat_display.index('@0,0').split('.')[0])
+            self.chat_display.mark_set('older_insert', '1.0')
+            self.chat_display.mark_gravity('older_insert', tk.RIGHT)
+            for position, conversation in enumerate(older, start):
+                self.render_conversation(conversation, 'older_insert', position)
+            added_lines = int(self.chat_display.index('older_insert').split('.')[0]) - 1
+            self.chat_display.mark_unset('older_insert')
+            self.chat_display.yview(f"{top_line + added_lines}.0")
+        self.rendered_start = start
+    
+    def load_newer_conversations(self):
+        # Only reached after a jump to a search result left the newest conversations undrawn
+        self.loading_newer = False
+        end = min(self.history_start + len(self.chat_history), self.rendered_end + RENDER_PAGE)
+        if end <= self.rendered_end:
+            return
+        with self.render_latency.time(('newer',)):
+            for position, conversation in enumerate(self.conversations(self.rendered_end, end), self.rendered_end):
+                self.render_conversation(conversation, position=position)
+        self.rendered_end = end
+    
+    def search_history(self):
+        query = self.search_entry.get().strip()
+        if not query:
+            return
+        if self.search_index is None:
+            messagebox.showinfo("Search", "Chat history isn't indexed yet.")
+            return
+        start = time.perf_counter()
+        results, total = self.search_index.results(query, SEARCH_RESULT_LIMIT)
+        elapsed = time.perf_counter() - start
+        self.search_latency.observe((), elapsed)
+        self.show_search_results(query, results, total, elapsed)
+    
+    def show_search_results(self, query, results, total, elapsed):
+        dialog = tk.Toplevel(self.root)
+        dialog.title(f"Search: {query}")
+        dialog.geometry("700x400")
+        dialog.configure(bg='#1e1e1e')
+        
+        ttk.Label(dialog, text=f"{total} matching conversations ({elapsed * 1000:.1f} ms)"
+                  + (f", showing the best {len(results)}" if total > len(results) else ""),
+                  style='TLabel').pack(fill='x', padx=10, pady=(10, 5))
+        
+        listbox = tk.Listbox(dialog, bg='#2b2b2b', fg='white',
+                             selectbackground='#404040',
+                             relief=tk.FLAT,
+                             activestyle='none')
+        listbox.pack(expand=True, fill='both', padx=10, pady=(0, 10))
+        for result in results:
+            listbox.insert(tk.END, f"#{result['turn'] + 1}  {result['snippet']}")
+        
+        def open_result(event=None):
+            selection = listbox.curselection()
+            if selection:
+                self.show_conversation(results[selection[0]]['turn'])
+        
+        # Double-click or Enter jumps the transcript to the conversation
+        listbox.bind('<Double-Button-1>', open_result)
+        listbox.bind('<Return>', open_result)
+        dialog.transient(self.root)
+    
+    def show_conversation(self, position):
+        if self.current_request is not None:
+            messagebox.showinfo("Search", "Wait for the current reply to finish.")
+            return
+        if position >= self.history_start + len(self.chat_history):
+            return
+        if not self.rendered_start <= position < self.rendered_end:
+            self.display_chat_history(around=position)
+        end = f'conv{position + 1}' if position + 1 < self.rendered_end else tk.END
+        self.chat_display.tag_remove('search_hit', '1.0', tk.END)
+        self.chat_display.tag_add('search_hit', f'conv{position}', end)
+        self.chat_display.yview(f'conv{position}')
     
     def edit_system_prompt(self):
         # Create a dialog window
@@ -291,8 +760,8 @@ class ChatbotGUI:
         
         # Load current system prompt
         try:
-            if os.path.exists('../system_prompt.json'):
-                with open('../system_prompt.json', 'r') as f:
+            if os.path.exists(SYSTEM_PROMPT_FILE):
+                with open(SYSTEM_PROMPT_FILE, 'r') as f:
                     data = json.load(f)
                     text_area.insert('1.0', data.get('system_prompt', ''))
         except Exception as e:
@@ -305,7 +774,7 @@ class ChatbotGUI:
         def save_prompt():
             try:
                 prompt_text = text_area.get('1.0', tk.END).strip()
-                with open('../system_prompt.json', 'w') as f:
+                with open(SYSTEM_PROMPT_FILE, 'w') as f:
                     json.dump({'system_prompt': prompt_text}, f)
                 messagebox.showinfo("Success", "System prompt saved successfully!")
                 dialog.destroy()
@@ -337,103 +806,225 @@ class ChatbotGUI:
         if not message:
             return
         
+        self.message_entry.delete(0, tk.END)
+        
+        # Hold messages typed while a reply is still streaming or the history is still loading
+        if self.current_request is not None or not self.history_loaded:
+            self.pending_messages.append((message, api_key))
+            self.update_status()
+            return
+        
+        self.start_request(message, api_key)
+    
+    def start_request(self, message, api_key):
         # Create a new conversation entry
         conversation = {
             'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             'user_message': message
         }
         
+        # Back to the newest conversations if a search result is being shown
+        position = self.history_start + len(self.chat_history)
+        if self.rendered_end < position:
+            self.display_chat_history()
+        self.chat_display.tag_remove('search_hit', '1.0', tk.END)
+        self.chat_display.mark_set(f'conv{position}', 'end-1c')
+        self.chat_display.mark_gravity(f'conv{position}', tk.LEFT)
+        
         # Display user message without profile picture
         self.chat_display.insert(tk.END, "You: " + message + "\n\n")
-        self.message_entry.delete(0, tk.END)
         
+        # Remember where the reply starts so an error can replace a partial reply
+        self.chat_display.mark_set('response_start', 'end-1c')
+        self.chat_display.mark_gravity('response_start', tk.LEFT)
+        if self.profile_picture:
+            self.chat_display.image_create(tk.END, image=self.profile_picture)
+            self.chat_display.insert(tk.END, " ")
+        self.chat_display.insert(tk.END, "GF: ")
+        self.chat_display.see(tk.END)
+        
+        request = {
+            'started': time.perf_counter(),
+            # Per-message span timings, kept only for sampled messages
+            'spans': [] if self.trace_sampler.sample() else None,
+            'conversation': conversation,
+            # Log the user message now so it survives a crash before the reply arrives
+            'log_position': self.save_conversation(conversation),
+            'cancelled': threading.Event(),
+            'text': []
+        }
+        self.current_request = request
+        self.cancel_button.configure(state=tk.NORMAL)
+        self.update_status()
+        
+        if self.response_cache.enabled_for():
+            request['cache_key'] = self.response_cache_key(message)
+            cached = self.response_cache.get(request['cache_key'])
+            if cached is not None:
+                request['cached'] = True
+                # The session never saw this turn, so rebuild it from chat_history next time
+                self.session_manager.reset()
+                self.response_queue.put(('chunk', request, cached))
+                self.response_queue.put(('done', request, None))
+                return
+        
+        threading.Thread(target=self.generate_response,
+                         args=(request, message, api_key, list(self.chat_history)),
+                         daemon=True).start()
+    
+    def response_cache_key(self, message):
+        messages = []
+        for conversation in self.chat_history[-self.response_cache.context_turns:]:
+            messages.append({'role': 'user', 'text': conversation.get('user_message') or ''})
+            messages.append({'role': 'assistant', 'text': conversation.get('bot_response') or ''})
+        messages.append({'role': 'user', 'text': message})
+        return self.response_cache.key('gemini', MODEL_NAME, GENERATION_CONFIG,
+                                       self.session_manager.system_prompt(), messages)
+    
+    def generate_response(self, request, message, api_key, history):
+        # Runs on a worker thread: never touch Tk widgets here, only the queue
+        chat = None
         try:
-            # Load system prompt
-            system_prompt = ""
-            try:
-                if os.path.exists('../system_prompt.json'):
-                    with open('../system_prompt.json', 'r') as f:
-                        data = json.load(f)
-                        system_prompt = data.get('system_prompt', '')
-            except Exception as e:
-                print(f"Failed to load system prompt: {str(e)}")
-            
-            # Configure the API
-            genai.configure(api_key=api_key, transport='rest')
-            
-            # Create generation config
-            generation_config = genai.GenerationConfig(
-                temperature=0.7,
-                top_p=0.8,
-                top_k=40
-            )
-            
-            # Safety settings removed to allow unrestricted conversations
-            safety_settings = [
-                # Using the most permissive settings
-                {
-                    "category": "HARM_CATEGORY_HARASSMENT",
-                    "threshold": "BLOCK_NONE"
-                },
-                {
-                    "category": "HARM_CATEGORY_HATE_SPEECH",
-                    "threshold": "BLOCK_NONE"
-                },
-                {
-                    "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                    "threshold": "BLOCK_NONE"
-                },
-                {
-                    "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                    "threshold": "BLOCK_NONE"
-                }
-            ]
-            
-            # Initialize the model with configurations
-            model = genai.GenerativeModel(
-                #gemini-2.0-pro-exp-02-05
-                #gemini-1.5-pro-latest - old
-                model_name='gemini-2.0-pro-exp-02-05',
-                generation_config=generation_config,
-                safety_settings=safety_settings
-            )
+            chat = self.session_manager.get_chat(api_key, history)
             
-            # Start a chat session
-            chat = model.start_chat()
-            
-            # Set system prompt if available
-            if system_prompt:
-                chat.send_message(system_prompt)
-            
-            # Send user message and get response
-            response = chat.send_message(message)
-            
-            # Add bot response to conversation entry
-            conversation['bot_response'] = response.text
-            
-            # Display bot response
-            self.chat_display.insert(tk.END, "GF: " + response.text + "\n\n")
+            # Stream the reply so it shows up as it is generated
+            if not request['cancelled'].is_set():
+                start = time.perf_counter()
+                first_chunk = None
+                for chunk in chat.send_message(message, stream=True):
+                    if first_chunk is None:
+                        first_chunk = time.perf_counter() - start
+                        self.model_latency.observe(('first_chunk',), first_chunk)
+                        self.add_request_span(request, 'model.first_chunk', first_chunk)
+                    if request['cancelled'].is_set():
+                        break
+                    self.response_queue.put(('chunk', request, chunk.text))
+                elapsed = time.perf_counter() - start
+                self.model_latency.observe(('complete',), elapsed)
+                self.add_request_span(request, 'model.complete', elapsed)
             
+            self.response_queue.put(('done', request, None))
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to get response: {str(e)}")
-            self.chat_display.insert(tk.END, "Bot: Sorry, I encountered an error.\n\n")
-            # Add error response to conversation entry
-            conversation['bot_response'] = "Sorry, I encountered an error."
-        
+            # The session may hold a half-finished turn; start clean next time
+            self.session_manager.reset(chat)
+            self.response_queue.put(('error', request, e))
+    
+    @staticmethod
+    def add_request_span(request, name, seconds):
+        if request['spans'] is not None:
+            request['spans'].append((name, round(seconds * 1000, 3)))
+    
+    def process_response_queue(self):
+        try:
+            while True:
+                kind, request, payload = self.response_queue.get_nowait()
+                if kind == 'history':
+                    self.finish_history_load(*payload)
+                    continue
+                if kind == 'search_index':
+                    # Ignored if the history was cleared while it was being built
+                    if self.search_index is None:
+                        self.search_index = payload
+                        self.update_search_index()
+                    continue
+                if kind == 'avatar':
+                    if payload is not None:
+                        self.apply_profile_picture(payload)
+                    self.record_startup_phase('avatar')
+                    continue
+                if kind == 'avatar_set':
+                    path, error = payload
+                    if error is not None:
+                        messagebox.showerror("Error", f"Failed to set profile picture: {error}")
+                    else:
+                        self.apply_profile_picture(path)
+                        messagebox.showinfo("Success", "Profile picture updated successfully!")
+                    continue
+                if request is not self.current_request:
+                    continue
+                if kind == 'chunk':
+                    request['text'].append(payload)
+                    self.chat_display.insert(tk.END, payload)
+                    self.chat_display.see(tk.END)
+                elif kind == 'done':
+                    self.finish_request(request)
+                elif kind == 'error':
+                    self.fail_request(request, payload)
+        except queue.Empty:
+            pass
+        self.root.after(RESPONSE_POLL_MS, self.process_response_queue)
+    
+    def finish_request(self, request):
+        conversation = request['conversation']
+        conversation['bot_response'] = ''.join(request['text'])
+        if request['cancelled'].is_set():
+            self.chat_display.insert(tk.END, " [cancelled]")
+        elif 'cache_key' in request and not request.get('cached'):
+            self.response_cache.put(request['cache_key'], conversation['bot_response'])
+        self.chat_display.insert(tk.END, "\n\n")
+        self.complete_request(request)
+    
+    def fail_request(self, request, error):
+        messagebox.showerror("Error", f"Failed to get response: {str(error)}")
+        self.chat_display.delete('response_start', tk.END)
+        self.chat_display.insert(tk.END, "Bot: Sorry, I encountered an error.\n\n")
+        # Add error response to conversation entry
+        conversation = request['conversation']
+        conversation['bot_response'] = ERROR_RESPONSE
+        self.complete_request(request)
+    
+    def complete_request(self, request):
         # Add conversation to history and save
+        conversation = request['conversation']
         self.chat_history.append(conversation)
-        self.save_chat_history()
+        self.rendered_end += 1
+        self.update_search_index()
+        save_start = time.perf_counter()
+        self.save_conversation(conversation, request['log_position'])
+        self.add_request_span(request, 'chat_log.update', time.perf_counter() - save_start)
+        if request['spans'] is not None:
+            self.trace_sampler.record('message', time.perf_counter() - request['started'], request['spans'],
+                                      cached=bool(request.get('cached')),
+                                      cancelled=request['cancelled'].is_set())
         
         # Scroll to bottom
         self.chat_display.see(tk.END)
+        
+        self.current_request = None
+        self.cancel_button.configure(state=tk.DISABLED)
+        if self.pending_messages:
+            self.start_request(*self.pending_messages.popleft())
+        self.update_status()
+    
+    def cancel_response(self):
+        # The worker stops at the next chunk; whatever arrived so far is kept
+        if self.current_request is not None:
+            self.current_request['cancelled'].set()
+            # The abandoned stream leaves its session mid-turn, so the next message gets a fresh one
+            self.session_manager.reset()
+            self.finish_request(self.current_request)
+    
+    def update_status(self):
+        queued = len(self.pending_messages)
+        if not self.history_loaded:
+            self.status_label.configure(text="Loading history..." + (f" {queued} queued" if queued else ""))
+        else:
+            self.status_label.configure(text=f"{queued} queued" if queued else "")
+
+def conversation_text(conversation):
+    return f"{conversation.get('user_message', '')}\n{conversation.get('bot_response', '')}"
 
 def main():
     root = tk.Tk()
     app = ChatbotGUI(root)
     root.mainloop()
     
-    # Save chat history when application closes
-    app.save_chat_history()
+    # Stop any reply still streaming and close the chat log when application closes
+    if app.current_request is not None:
+        app.current_request['cancelled'].set()
+    app.close_chat_log()
+    if METRICS_FILE:
+        app.dump_metrics(METRICS_FILE)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,152 @@
+import hashlib
+import re
+
+from progress_store import LRUCache
+
+DEFAULT_TOKEN_BUDGET = 4096
+SUMMARY_TOKEN_BUDGET = 512
+# Older turns are folded into the summary this many at a time, so the summarizer runs
+# once every few messages instead of on every one
+SUMMARY_CHUNK_TURNS = 8
+TURN_OVERHEAD_TOKENS = 4
+SUMMARY_LINE_CHARS = 160
+SUMMARY_CACHE_SIZE = 10000
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English text; close enough for budgeting
+    return len(text) // 4 + 1
+
+def turn_text(turn):
+    if not isinstance(turn, dict):
+        return str(turn)
+    return ''.join(part.get('text', '') for part in turn.get('parts') or [] if isinstance(part, dict))
+
+def normalize_messages(messages):
+    # Accepts {'role', 'text'}, OpenAI-style {'role', 'content'} and stored Gemini turns
+    # {'role', 'parts'}; returns [{'role': 'user'|'assistant', 'text': ...}]
+    normalized = []
+    for message in messages or []:
+        if not isinstance(message, dict):
+            continue
+        if isinstance(message.get('text'), str):
+            text = message['text']
+        elif isinstance(message.get('content'), str):
+            text = message['content']
+        else:
+            text = turn_text(message)
+        role = 'assistant' if message.get('role') in ('assistant', 'model') else 'user'
+        if text:
+            normalized.append({'role': role, 'text': text})
+    return normalized
+
+def default_system_prompt(progress):
+    companion = 'girlfriend' if progress.get('companionGender', 'female') == 'female' else 'boyfriend'
+    personality = progress.get('personality') or 'sweet'
+    return f"You are the user's AI {companion} with a {personality} personality."
+
+class Summarizer:
+    # Folds new turns into an existing summary. Implementations must keep the result within
+    # max_tokens as measured by count_tokens.
+    def summarize(self, previous_summary, turns, max_tokens, count_tokens):
+        raise NotImplementedError
+
+class ExtractiveSummarizer(Summarizer):
+    # Local stand-in for a model-backed summarizer: keeps the first sentence of every turn and
+    # drops the oldest lines once over budget. Deterministic, so it works offline and in tests.
+    def summarize(self, previous_summary, turns, max_tokens, count_tokens):
+        lines = previous_summary.splitlines() if previous_summary else []
+        for turn in turns:
+            text = ' '.join(turn_text(turn).split())
+            if not text:
+                continue
+            sentence = re.split(r'(?<=[.!?])\s', text, maxsplit=1)[0][:SUMMARY_LINE_CHARS]
+            role = turn.get('role') if isinstance(turn, dict) else None
+            speaker = 'User' if role == 'user' else 'Companion'
+            lines.append(f'{speaker}: {sentence}')
+        return fit_summary(lines, max_tokens, count_tokens)
+
+def fit_summary(lines, max_tokens, count_tokens):
+    # Drop the oldest lines until the summary fits
+    while lines and count_tokens('\n'.join(lines)) > max_tokens:
+        lines.pop(0)
+    return '\n'.join(lines)
+
+class ContextBuilder:
+    # Turns a stored progress document into what a model call needs under a token budget:
+    # the system prompt, a rolling summary of older turns, and as many recent turns as fit.
+    # Summaries are cached per user and extended as the conversation grows.
+    def __init__(self, summarizer=None, count_tokens=estimate_tokens,
+                 summary_budget=SUMMARY_TOKEN_BUDGET, chunk_turns=SUMMARY_CHUNK_TURNS):
+        self.summarizer = summarizer or ExtractiveSummarizer()
+        self.count_tokens = count_tokens
+        self.summary_budget = summary_budget
+        self.chunk_turns = chunk_turns
+        # storage id -> (turns covered, fingerprint of the last covered turn, summary text)
+        self.summaries = LRUCache(SUMMARY_CACHE_SIZE)
+
+    def turn_tokens(self, turn):
+        return self.count_tokens(turn_text(turn)) + TURN_OVERHEAD_TOKENS
+
+    def build(self, storage_id, progress, budget=DEFAULT_TOKEN_BUDGET, system_prompt=None):
+        history = progress.get('chatHistory') or []
+        if system_prompt is None:
+            system_prompt = progress.get('systemPrompt') or default_system_prompt(progress)
+        system_tokens = self.count_tokens(system_prompt)
+
+        # Fill from the newest turn backwards; reserve room for a summary only if something is left over
+        available = budget - system_tokens
+        cut = self._fit_recent(history, available)
+        summary_budget = min(self.summary_budget, max(0, available) // 4)
+        if cut > 0:
+            cut = self._fit_recent(history, available - summary_budget)
+            # Round the boundary up to a chunk so the summary only moves in whole chunks,
+            # unless that would leave no recent turns at all
+            aligned = -(-cut // self.chunk_turns) * self.chunk_turns
+            if aligned < len(history):
+                cut = aligned
+
+        summary = ''
+        if cut > 0:
+            summary, cut = self._summary_for(storage_id, history, cut, summary_budget)
+        turns = history[cut:]
+        return {
+            'systemPrompt': system_prompt,
+            'summary': summary,
+            'turns': turns,
+            'firstTurn': cut,
+            'estimatedTokens': (system_tokens + (self.count_tokens(summary) if summary else 0)
+                                + sum(self.turn_tokens(turn) for turn in turns)),
+        }
+
+    def _fit_recent(self, history, available):
+        # Index of the oldest turn that still fits when taking turns newest-first
+        used = 0
+        cut = len(history)
+        while cut > 0:
+            cost = self.turn_tokens(history[cut - 1])
+            if used + cost > available:
+                break
+            used += cost
+            cut -= 1
+        return cut
+
+    def _summary_for(self, storage_id, history, cut, summary_budget):
+        # Returns (summary of history[:cut], cut); cut may move forward to reuse a cached summary
+        covered, fingerprint, summary = self.summaries.get(storage_id) or (0, None, '')
+        if covered and (covered > len(history) or fingerprint != self._fingerprint(history[covered - 1])):
+            # The history was rewritten underneath the summary; start over
+            covered, summary = 0, ''
+        if covered >= cut:
+            # A bigger budget would fit a few more turns, but re-summarizing isn't worth it.
+            # The cached summary may have been built for a larger budget than this call's.
+            if self.count_tokens(summary) > summary_budget:
+                summary = fit_summary(summary.splitlines(), summary_budget, self.count_tokens)
+            return summary, max(cut, covered) if covered else cut
+        summary = self.summarizer.summarize(summary, history[covered:cut], summary_budget,
+                                            self.count_tokens)
+        self.summaries.put(storage_id, (cut, self._fingerprint(history[cut - 1]), summary))
+        return summary, cut
+
+    @staticmethod
+    def _fingerprint(turn):
+        return hashlib.sha1(turn_text(turn).encode()).hexdigest()
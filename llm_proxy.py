@@ -0,0 +1,354 @@
+import http.client
+import json
+import queue
+import random
+import threading
+import time
+from urllib.parse import quote
+
+from context_builder import normalize_messages
+
+PROVIDERS = ('gemini', 'xai', 'groq', 'stub')
+DEFAULT_MODELS = {
+    'gemini': 'gemini-1.5-flash',
+    'xai': 'grok-beta',
+    'groq': 'llama-3.3-70b-versatile',
+    'stub': 'stub-echo',
+}
+# Requests in flight per provider; extra callers wait up to QUEUE_TIMEOUT for a slot
+DEFAULT_CONCURRENCY = {'gemini': 16, 'xai': 8, 'groq': 8, 'stub': 64}
+QUEUE_TIMEOUT = 10.0
+CONNECT_TIMEOUT = 10.0
+READ_TIMEOUT = 60.0  # longest silence allowed between two streamed events
+MAX_IDLE_CONNECTIONS = 8
+MAX_RETRIES = 2
+RETRY_BASE_DELAY = 0.25
+RETRY_MAX_DELAY = 4.0
+# Start a second identical request when the first has not produced a token after this long
+HEDGE_AFTER = 2.0
+RETRYABLE_STATUSES = (408, 429, 500, 502, 503, 504)
+
+class ProviderError(Exception):
+    def __init__(self, message, status=502, retryable=False):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+
+class ConnectionPool:
+    # Idle keep-alive connections to one host; a connection is only returned once its
+    # response has been read to the end
+    def __init__(self, host, port=None, use_tls=True, max_idle=MAX_IDLE_CONNECTIONS):
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        # Returns (connection, reused)
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self.connect(), False
+
+    def connect(self):
+        connection_class = http.client.HTTPSConnection if self.use_tls else http.client.HTTPConnection
+        return connection_class(self.host, self.port, timeout=CONNECT_TIMEOUT)
+
+    def put(self, connection):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+class Provider:
+    # One upstream API: builds its request from the normalized form and pulls text out of its
+    # Server-Sent Events stream
+    name = None
+    host = None
+    port = None
+    use_tls = True
+
+    def __init__(self, max_concurrency=None):
+        self.pool = ConnectionPool(self.host, self.port, self.use_tls)
+        self.slots = threading.BoundedSemaphore(max_concurrency or DEFAULT_CONCURRENCY.get(self.name, 8))
+
+    def build_request(self, api_key, model, messages, system_prompt, config):
+        # Returns (path, headers, body)
+        raise NotImplementedError
+
+    def parse_event(self, data):
+        # Text carried by one SSE `data:` payload, or None
+        raise NotImplementedError
+
+    def stream(self, api_key, model, messages, system_prompt, config, cancel):
+        path, headers, body = self.build_request(api_key, model, messages, system_prompt, config)
+        headers = dict(headers, **{'Content-Type': 'application/json', 'Accept': 'text/event-stream'})
+        connection, response = self._send(path, headers, json.dumps(body).encode())
+        finished = False
+        try:
+            if response.status != 200:
+                detail = response.read(2048).decode('utf-8', 'replace')
+                finished = True
+                raise ProviderError(f'{self.name} returned {response.status}: {detail}',
+                                    response.status, response.status in RETRYABLE_STATUSES)
+            connection.sock.settimeout(READ_TIMEOUT)
+            for data in iter_sse_data(response):
+                if cancel is not None and cancel.is_set():
+                    return
+                if data == '[DONE]':
+                    continue
+                text = self.parse_event(data)
+                if text:
+                    yield text
+            finished = True
+        except (OSError, http.client.HTTPException) as e:
+            raise ProviderError(f'{self.name} stream failed: {e}', 502, True) from e
+        except ValueError as e:
+            raise ProviderError(f'{self.name} sent an unreadable event: {e}') from e
+        finally:
+            # A partly read response would poison the next request on this connection
+            if finished and not response.will_close:
+                response.read()
+                self.pool.put(connection)
+            else:
+                connection.close()
+
+    def _send(self, path, headers, body):
+        connection, reused = self.pool.get()
+        while True:
+            try:
+                connection.request('POST', path, body, headers)
+                return connection, connection.getresponse()
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                if not reused:
+                    raise ProviderError(f'{self.name} request failed: {e}', 502, True) from e
+                # The server dropped the idle connection; try once more on a fresh one
+                connection, reused = self.pool.connect(), False
+
+    def close(self):
+        self.pool.close()
+
+class GeminiProvider(Provider):
+    name = 'gemini'
+    host = 'generativelanguage.googleapis.com'
+
+    def build_request(self, api_key, model, messages, system_prompt, config):
+        body = {
+            'contents': [{'role': 'model' if m['role'] == 'assistant' else 'user', 'parts': [{'text': m['text']}]}
+                         for m in messages],
+        }
+        if system_prompt:
+            body['systemInstruction'] = {'parts': [{'text': system_prompt}]}
+        generation_config = {}
+        for ours, theirs in (('temperature', 'temperature'), ('topP', 'topP'), ('maxTokens', 'maxOutputTokens')):
+            if ours in config:
+                generation_config[theirs] = config[ours]
+        if generation_config:
+            body['generationConfig'] = generation_config
+        path = f'/v1beta/models/{quote(model, safe="")}:streamGenerateContent?alt=sse'
+        return path, {'x-goog-api-key': api_key}, body
+
+    def parse_event(self, data):
+        event = json.loads(data)
+        candidates = event.get('candidates') or []
+        if not candidates:
+            return None
+        parts = (candidates[0].get('content') or {}).get('parts') or []
+        return ''.join(part.get('text', '') for part in parts)
+
+class OpenAICompatibleProvider(Provider):
+    # xAI and Groq both speak the OpenAI chat completions format
+    path = '/v1/chat/completions'
+
+    def build_request(self, api_key, model, messages, system_prompt, config):
+        chat = [{'role': 'system', 'content': system_prompt}] if system_prompt else []
+        chat += [{'role': m['role'], 'content': m['text']} for m in messages]
+        body = {'model': model, 'messages': chat, 'stream': True}
+        for ours, theirs in (('temperature', 'temperature'), ('topP', 'top_p'), ('maxTokens', 'max_tokens')):
+            if ours in config:
+                body[theirs] = config[ours]
+        return self.path, {'Authorization': f'Bearer {api_key}'}, body
+
+    def parse_event(self, data):
+        choices = json.loads(data).get('choices') or []
+        if not choices:
+            return None
+        return (choices[0].get('delta') or {}).get('content')
+
+class XAIProvider(OpenAICompatibleProvider):
+    name = 'xai'
+    host = 'api.x.ai'
+
+class GroqProvider(OpenAICompatibleProvider):
+    name = 'groq'
+    host = 'api.groq.com'
+    path = '/openai/v1/chat/completions'
+
+class StubProvider(Provider):
+    # Answers locally with simulated latency and failures so the proxy can be exercised offline.
+    # Goes through the same slots, retries and hedging as the real providers.
+    name = 'stub'
+
+    def __init__(self, max_concurrency=None, first_token_delay=0.05, token_delay=0.01,
+                 slow_rate=0.0, slow_delay=3.0, failure_rate=0.0):
+        self.pool = None
+        self.slots = threading.BoundedSemaphore(max_concurrency or DEFAULT_CONCURRENCY[self.name])
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+        self.slow_rate = slow_rate
+        self.slow_delay = slow_delay
+        self.failure_rate = failure_rate
+
+    def stream(self, api_key, model, messages, system_prompt, config, cancel):
+        cancel = cancel or threading.Event()
+        if random.random() < self.failure_rate:
+            raise ProviderError('stub provider failure', 503, True)
+        delay = self.slow_delay if random.random() < self.slow_rate else self.first_token_delay
+        if cancel.wait(delay):
+            return
+        last = next((m['text'] for m in reversed(messages) if m['role'] == 'user'), '')
+        words = f'You said: {last}'.split(' ')
+        limit = config.get('maxTokens')
+        for i, word in enumerate(words[:limit] if limit else words):
+            if i and cancel.wait(self.token_delay):
+                return
+            yield word if i == 0 else ' ' + word
+
+    def close(self):
+        pass
+
+def iter_sse_data(response):
+    # Yields the payload of each event; multi-line data fields are joined with newlines
+    data = []
+    while True:
+        line = response.readline()
+        if not line:
+            break
+        line = line.rstrip(b'\r\n')
+        if not line:
+            if data:
+                yield '\n'.join(data)
+                data = []
+        elif line.startswith(b'data:'):
+            data.append(line[5:].lstrip(b' ').decode('utf-8'))
+    if data:
+        yield '\n'.join(data)
+
+def retry_delay(attempt):
+    # Full jitter: anywhere between zero and the capped exponential backoff
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+class LLMProxy:
+    # Streams a normalized chat request from one provider, with a concurrency cap per provider,
+    # jittered retries until the first token arrives and optional hedging of slow starts
+    def __init__(self, providers=None, max_retries=MAX_RETRIES, hedge_after=HEDGE_AFTER):
+        if providers is None:
+            providers = [GeminiProvider(), XAIProvider(), GroqProvider(), StubProvider()]
+        self.providers = {provider.name: provider for provider in providers}
+        self.max_retries = max_retries
+        self.hedge_after = hedge_after
+
+    def stream(self, provider_name, api_key, messages, system_prompt=None, model=None,
+               config=None, hedge=False):
+        provider = self.providers.get(provider_name)
+        if provider is None:
+            raise ProviderError(f'Unknown provider: {provider_name}', 400)
+        request = (api_key, model or DEFAULT_MODELS[provider.name], normalize_messages(messages),
+                   system_prompt, config or {})
+        attempt = 0
+        while True:
+            started = False
+            try:
+                chunks = self._hedged(provider, request) if hedge else self._attempt(provider, request)
+                for text in chunks:
+                    started = True
+                    yield text
+                return
+            except ProviderError as e:
+                # Once text has reached the caller a retry would repeat it
+                if started or not e.retryable or attempt >= self.max_retries:
+                    raise
+            time.sleep(retry_delay(attempt))
+            attempt += 1
+
+    def _attempt(self, provider, request, cancel=None, wait=True):
+        if not provider.slots.acquire(timeout=QUEUE_TIMEOUT if wait else 0):
+            raise ProviderError(f'{provider.name} is at its concurrency limit', 503, True)
+        try:
+            yield from provider.stream(*request, cancel)
+        finally:
+            provider.slots.release()
+
+    def _hedged(self, provider, request):
+        # Run the request on a thread; if no token arrives within hedge_after, start a second
+        # copy and keep whichever produces text first
+        events = queue.Queue()
+        cancels = []
+
+        def launch(wait):
+            cancel = threading.Event()
+            cancels.append(cancel)
+            threading.Thread(target=self._run_attempt, daemon=True,
+                             args=(provider, request, len(cancels) - 1, cancel, wait, events)).start()
+
+        launch(True)
+        winner = None
+        failures = 0
+        try:
+            while True:
+                hedging = winner is None and len(cancels) == 1
+                try:
+                    index, kind, value = events.get(timeout=self.hedge_after if hedging else READ_TIMEOUT)
+                except queue.Empty:
+                    if not hedging:
+                        raise ProviderError(f'{provider.name} stopped responding', 504, True)
+                    # The hedge only runs if a slot is free right now
+                    launch(False)
+                    continue
+                if winner is None:
+                    if kind == 'error':
+                        failures += 1
+                        if failures == len(cancels):
+                            raise value
+                        continue
+                    winner = index
+                    for i, cancel in enumerate(cancels):
+                        if i != winner:
+                            cancel.set()
+                elif index != winner:
+                    continue
+                if kind == 'text':
+                    yield value
+                elif kind == 'done':
+                    return
+                else:
+                    raise value
+        finally:
+            for cancel in cancels:
+                cancel.set()
+
+    def _run_attempt(self, provider, request, index, cancel, wait, events):
+        try:
+            for text in self._attempt(provider, request, cancel, wait):
+                if cancel.is_set():
+                    return
+                events.put((index, 'text', text))
+            events.put((index, 'done', None))
+        except ProviderError as e:
+            events.put((index, 'error', e))
+        except Exception as e:
+            events.put((index, 'error', ProviderError(f'{provider.name} failed: {e}')))
+
+    def close(self):
+        for provider in self.providers.values():
+            provider.close()
@@ -0,0 +1,407 @@
+import argparse
+import json
+import os
+import signal
+import sys
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from cryptography.fernet import Fernet
+
+from avatar_store import AvatarStore
+from progress_store import DATA_DIR, FileProgressStore
+from server import ENCRYPTION_KEY_FILE, HASHED_ID_PATTERN, APIKeyManager, key_ring
+
+# Bulk jobs over every user's progress in data/, run by a process pool beside a live server.
+# Each user is handled on its own under the same per-user flock locks the server takes, and
+# every rewrite goes through a temp file and a rename, so the server only ever sees a document
+# before or after a job touched it.
+
+CHECKPOINT_DIR = os.path.join(DATA_DIR, '.maintenance')
+ARCHIVE_DIR = os.path.join(DATA_DIR, 'archive')
+# Users queued per worker process, so listing a huge data dir never runs far ahead of the work
+QUEUE_PER_JOB = 4
+REPORT_INTERVAL = 2.0  # seconds between progress lines
+
+# Outcomes of one user's job
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+INVALID = 'invalid'
+FAILED = 'failed'
+
+def user_ids(data_dir=DATA_DIR):
+    # Storage ids with progress in data_dir, listed lazily. A user is named by their snapshot,
+    # or by their journal when no snapshot has been written yet.
+    with os.scandir(data_dir) as entries:
+        for entry in entries:
+            name = entry.name
+            if name.startswith('.') or not entry.is_file():
+                continue
+            if name.endswith('.json'):
+                yield name[:-len('.json')]
+            elif name.endswith('.journal'):
+                storage_id = name[:-len('.journal')]
+                if not os.path.exists(os.path.join(data_dir, storage_id + '.json')):
+                    yield storage_id
+
+def progress_bytes(store, storage_id):
+    size = 0
+    for path in (store.snapshot_path(storage_id), store.journal_path(storage_id)):
+        try:
+            size += os.path.getsize(path)
+        except OSError:
+            pass
+    return size
+
+# Each worker process opens its own stores in _start_worker(); jobs run with this state
+_worker = {}
+
+def _start_worker(options):
+    # Ctrl+C stops the parent from queueing more work; jobs already started run to the end
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker['store'] = FileProgressStore()
+    _worker['options'] = options
+
+def _run_job(command, storage_id):
+    # (storage id, outcome, message)
+    try:
+        outcome, message = JOBS[command](_worker['store'], storage_id, _worker['options'])
+    except Exception as e:
+        return storage_id, FAILED, f'{type(e).__name__}: {e}'
+    return storage_id, outcome, message
+
+def validate(store, storage_id, options):
+    # The snapshot is checked on its own first: the store expects it to be an object
+    try:
+        with open(store.snapshot_path(storage_id), 'r') as f:
+            progress = json.load(f)
+        if not isinstance(progress, dict):
+            return INVALID, f'document is a {type(progress).__name__}, not an object'
+    except FileNotFoundError:
+        progress = None
+    except ValueError as e:
+        return INVALID, f'unreadable JSON: {e}'
+    if os.path.exists(store.journal_path(storage_id)):
+        progress = store.load(storage_id)
+    if progress is None:
+        return UNCHANGED, None
+    history = progress.get('chatHistory')
+    if history is not None:
+        if not isinstance(history, list):
+            return INVALID, 'chatHistory is not a list'
+        for i, turn in enumerate(history):
+            if not isinstance(turn, dict):
+                return INVALID, f'chatHistory[{i}] is not an object'
+    if not HASHED_ID_PATTERN.match(storage_id):
+        return INVALID, 'named after a raw API key (run migrate-ids)'
+    return UNCHANGED, None
+
+def migrate_id(store, legacy_id, options):
+    # Same move as the server's migrate_legacy_progress(): the check for newer progress and
+    # the write happen under the user's lock
+    storage_id = APIKeyManager.shared().hash_user_id(legacy_id)
+    legacy_file = store.snapshot_path(legacy_id)
+
+    def adopt(progress):
+        if progress is not None:
+            return None  # saved under the hashed id since; that copy is newer
+        with open(legacy_file, 'r') as f:
+            return json.load(f)
+
+    try:
+        moved = store.update(storage_id, adopt)
+        os.remove(legacy_file)
+    except FileNotFoundError:
+        return UNCHANGED, None  # the server migrated it first
+    except ValueError as e:
+        return INVALID, f'unreadable JSON: {e}'
+    if moved:
+        return CHANGED, f'moved to {storage_id}'
+    return CHANGED, f'dropped, {storage_id} already has newer progress'
+
+def compact(store, storage_id, options):
+    # A compacted journal keeps a bare {"seq": N} marker; only journals with deltas are folded
+    try:
+        with open(store.journal_path(storage_id), 'r') as f:
+            has_deltas = any('turns' in line or 'fields' in line for line in f)
+    except FileNotFoundError:
+        return UNCHANGED, None
+    if not has_deltas:
+        return UNCHANGED, None
+    store.compact(storage_id)
+    return CHANGED, None
+
+def trim_history(store, storage_id, options):
+    keep = options['keep']
+    archive_dir = options['archive_dir']
+    trimmed = []
+
+    def trim(progress):
+        history = progress.get('chatHistory') if isinstance(progress, dict) else None
+        if not isinstance(history, list) or len(history) <= keep:
+            return None
+        cut = len(history) - keep
+        if archive_dir:
+            # Archived before the snapshot is rewritten: a crash in between repeats turns in
+            # the archive rather than losing them
+            with open(os.path.join(archive_dir, f'{storage_id}.jsonl'), 'a') as f:
+                for turn in history[:cut]:
+                    f.write(json.dumps(turn) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        trimmed.append(cut)
+        progress['chatHistory'] = history[cut:]
+        return progress
+
+    try:
+        changed = store.update(storage_id, trim)
+    except ValueError as e:
+        return INVALID, f'unreadable JSON: {e}'
+    if not changed:
+        return UNCHANGED, None
+    return CHANGED, f'{trimmed[0]} turns ' + ('archived' if archive_dir else 'dropped')
+
+def externalize_avatars(store, storage_id, options):
+    avatars = AvatarStore()
+
+    def externalize(progress):
+        if isinstance(progress, dict) and avatars.externalize(progress):
+            return progress
+        return None
+
+    try:
+        changed = store.update(storage_id, externalize)
+    except ValueError as e:
+        return INVALID, f'unreadable JSON: {e}'
+    return (CHANGED if changed else UNCHANGED), None
+
+JOBS = {
+    'validate': validate,
+    'migrate-ids': migrate_id,
+    'compact': compact,
+    'trim-history': trim_history,
+    'externalize-avatars': externalize_avatars,
+}
+
+class Checkpoint:
+    # Users a job has finished with, one per line in data/.maintenance/<command>.done, so an
+    # interrupted run picks up where it stopped. The first line records the job's options; a
+    # checkpoint left by a run with different options is refused rather than mixed in. Users
+    # that failed aren't recorded and are retried. The file is removed once a run completes
+    # without failures, so the next run starts over.
+    def __init__(self, command, options, directory=CHECKPOINT_DIR):
+        self.path = os.path.join(directory, f'{command}.done')
+        self.header = json.dumps(options, sort_keys=True)
+        self.done = set()
+        self._file = None
+        self.directory = directory
+
+    def open(self, restart=False):
+        os.makedirs(self.directory, exist_ok=True)
+        if restart:
+            self.remove()
+        try:
+            with open(self.path, 'r') as f:
+                header = f.readline().rstrip('\n')
+                if header != self.header:
+                    raise SystemExit(f'{self.path} is from a run with options {header}; '
+                                     'rerun with them or pass --restart')
+                # A torn last line is just a user done again
+                self.done.update(line.rstrip('\n') for line in f if line.endswith('\n'))
+        except FileNotFoundError:
+            with open(self.path, 'w') as f:
+                f.write(self.header + '\n')
+        self._file = open(self.path, 'a')
+        return self
+
+    def record(self, storage_id):
+        self._file.write(storage_id + '\n')
+        self.done.add(storage_id)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+class Progress:
+    # Counts outcomes and prints throughput (users/s, MB/s of progress files) and an ETA
+    def __init__(self, total, out=sys.stderr, interval=REPORT_INTERVAL):
+        self.total = total
+        self.out = out
+        self.interval = interval
+        self.counts = dict.fromkeys((CHANGED, UNCHANGED, INVALID, FAILED), 0)
+        self.skipped = 0
+        self.interrupted = False
+        self.bytes = 0
+        self.started = time.monotonic()
+        self._reported = self.started
+
+    @property
+    def processed(self):
+        return sum(self.counts.values())
+
+    def add(self, outcome, size):
+        self.counts[outcome] += 1
+        self.bytes += size
+        now = time.monotonic()
+        if now - self._reported >= self.interval:
+            self._reported = now
+            self.report()
+
+    def report(self, final=False):
+        elapsed = time.monotonic() - self.started
+        rate = self.processed / elapsed if elapsed else 0.0
+        line = (f'{self.processed + self.skipped}/{self.total} users, '
+                f'{rate:.1f} users/s, {self.bytes / elapsed / 1e6 if elapsed else 0.0:.1f} MB/s, '
+                + ', '.join(f'{count} {outcome}' for outcome, count in self.counts.items()))
+        if self.skipped:
+            line += f', {self.skipped} already done'
+        if final:
+            line = f'Finished in {elapsed:.1f}s: ' + line
+        elif rate:
+            line += f', ETA {max(0, self.total - self.processed - self.skipped) / rate:.0f}s'
+        print(line, file=self.out, flush=True)
+
+def run(command, options, jobs, restart=False, verbose=True):
+    # Run one job over every user with a pool of `jobs` processes; returns the Progress.
+    # Invalid and failed users are always listed, changed ones only when `verbose`.
+    store = FileProgressStore()
+    if command == 'migrate-ids':
+        ids = lambda: (i for i in user_ids() if not HASHED_ID_PATTERN.match(i))
+    else:
+        ids = user_ids
+    checkpoint = Checkpoint(command, options).open(restart)
+    progress = Progress(sum(1 for _ in ids()))
+    if checkpoint.done:
+        print(f'Resuming: {len(checkpoint.done)} users already done')
+    pool = ProcessPoolExecutor(jobs, initializer=_start_worker, initargs=(options,))
+    pending = {}  # future -> progress bytes of the user
+    try:
+        for storage_id in ids():
+            if storage_id in checkpoint.done:
+                progress.skipped += 1
+                continue
+            if len(pending) >= jobs * QUEUE_PER_JOB:
+                _collect(wait(pending, return_when=FIRST_COMPLETED).done, pending, checkpoint, progress, verbose)
+            pending[pool.submit(_run_job, command, storage_id)] = progress_bytes(store, storage_id)
+        while pending:
+            _collect(wait(pending, return_when=FIRST_COMPLETED).done, pending, checkpoint, progress, verbose)
+    except KeyboardInterrupt:
+        progress.interrupted = True
+        print('Interrupted; waiting for jobs in progress')
+        pool.shutdown(cancel_futures=True)
+        _collect([future for future in pending if future.done() and not future.cancelled()],
+                 pending, checkpoint, progress, verbose)
+    finally:
+        pool.shutdown()
+        store.close()
+    progress.report(final=True)
+    if progress.interrupted or progress.counts[FAILED]:
+        checkpoint.close()
+        print(f'Run again with the same options to resume from {checkpoint.path}')
+    else:
+        checkpoint.remove()
+    return progress
+
+def _collect(futures, pending, checkpoint, progress, verbose):
+    for future in futures:
+        size = pending.pop(future)
+        storage_id, outcome, message = future.result()
+        if outcome != FAILED:
+            checkpoint.record(storage_id)
+        if message and (verbose or outcome in (INVALID, FAILED)):
+            print(f'{storage_id}: {outcome}: {message}')
+        progress.add(outcome, size)
+    checkpoint.flush()
+
+def rotate_key(retire=False):
+    # Put a new key at the front of the key file, keeping the old ones so tokens issued under
+    # them still resolve; with `retire`, drop every key but the newest instead. Servers pick
+    # the file up within KEY_CHECK_INTERVAL.
+    APIKeyManager.shared()  # creates the key file if there is none
+    with open(ENCRYPTION_KEY_FILE, 'rb') as f:
+        keys = f.read().split()
+    key_ring(b'\n'.join(keys))  # refuse to build on a corrupt file
+    if retire:
+        keys = keys[:1]
+    else:
+        keys.insert(0, Fernet.generate_key())
+    directory = os.path.dirname(ENCRYPTION_KEY_FILE)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        os.chmod(tmp, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'\n'.join(keys) + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, ENCRYPTION_KEY_FILE)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+    print(f'{ENCRYPTION_KEY_FILE} now holds {len(keys)} key' + ('s' if len(keys) != 1 else ''))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Bulk maintenance of the progress files in data/. '
+                                     'Safe to run while the server is up.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def job(name, help_text):
+        sub = commands.add_parser(name, help=help_text)
+        sub.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                         help='Worker processes (default: one per core)')
+        sub.add_argument('--restart', action='store_true',
+                         help='Ignore the checkpoint of an interrupted run and start over')
+        sub.add_argument('--quiet', action='store_true',
+                         help='Only print invalid and failed users and the progress lines')
+        return sub
+
+    job('validate', 'Report progress that is unreadable, malformed or named after a raw API key')
+    job('migrate-ids', 'Move files named after raw API keys to their hashed storage ids')
+    job('compact', 'Fold every journal into its snapshot')
+    trim = job('trim-history', 'Keep only the latest chatHistory turns, archiving the rest')
+    trim.add_argument('--keep', type=int, required=True, help='Turns to keep per user')
+    trim.add_argument('--archive-dir', default=ARCHIVE_DIR,
+                      help=f'Where older turns are appended, one <id>.jsonl per user (default: {ARCHIVE_DIR})')
+    trim.add_argument('--no-archive', action='store_true', help='Drop older turns instead of archiving them')
+    job('externalize-avatars', 'Move inline base64 profile pictures into the avatar store')
+    rotate = commands.add_parser('rotate-key', help='Add a new encryption key, or retire the old ones')
+    rotate.add_argument('--retire', action='store_true',
+                        help='Keep only the newest key; tokens issued under older keys stop working')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'rotate-key':
+        rotate_key(args.retire)
+        return
+    if args.jobs < 1:
+        sys.exit('--jobs must be at least 1')
+    options = {}
+    if args.command == 'trim-history':
+        if args.keep < 0:
+            sys.exit('--keep must not be negative')
+        options = {'keep': args.keep, 'archive_dir': None if args.no_archive else args.archive_dir}
+        if options['archive_dir']:
+            os.makedirs(options['archive_dir'], exist_ok=True)
+    progress = run(args.command, options, args.jobs, args.restart, not args.quiet)
+    if progress.interrupted:
+        sys.exit(130)
+    if progress.counts[INVALID] or progress.counts[FAILED]:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+import json
+import random
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+
+from progress_store import ProgressStore
+
+# Seconds; wide enough for a cached load (~100us) up to a slow model call
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+TRACE_SAMPLE_RATE = 0.01
+MAX_TRACES = 200
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}  # label values -> total
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f'{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}')
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [per-bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def time(self, labels=()):
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((labels, list(series)) for labels, series in self._series.items())
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series[:-1]):
+                cumulative += count
+                le = 'le="+Inf"' if bound == '+Inf' else f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}')
+            label_text = _format_labels(self.label_names, labels)
+            lines.append(f'{self.name}_sum{label_text} {_format_value(series[-1])}')
+            lines.append(f'{self.name}_count{label_text} {cumulative}')
+        return lines
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.start
+        self.histogram.observe(self.labels, self.elapsed)
+        add_span('.'.join((self.histogram.name,) + tuple(map(str, self.labels))), self.elapsed)
+
+class CallbackMetric:
+    # Value read at scrape time, for counters kept elsewhere (cache hits and the like)
+    def __init__(self, name, help_text, metric_type, callback, label_names=()):
+        self.name = name
+        self.help = help_text
+        self.type = metric_type
+        self.callback = callback
+        self.label_names = tuple(label_names)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            lines.append(f'{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}')
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help_text, label_names=()):
+        return self._register(Counter(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, label_names, buckets))
+
+    def callback(self, name, help_text, metric_type, callback, label_names=()):
+        return self._register(CallbackMetric(name, help_text, metric_type, callback, label_names))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            f.write(self.render())
+
+_trace_state = threading.local()
+
+def add_span(name, seconds):
+    # Attach a timing to the trace being recorded on this thread, if any
+    spans = getattr(_trace_state, 'spans', None)
+    if spans is not None:
+        spans.append((name, round(seconds * 1000, 3)))
+
+class TraceSampler:
+    # Keeps detailed timings for a random sample of requests; unsampled requests only pay
+    # for one random() call
+    def __init__(self, sample_rate=TRACE_SAMPLE_RATE, max_traces=MAX_TRACES):
+        self.sample_rate = sample_rate
+        self._traces = deque(maxlen=max_traces)
+
+    def sample(self):
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def record(self, name, seconds, spans, **attributes):
+        self._traces.append(dict(attributes, name=name, at=time.time(),
+                                 ms=round(seconds * 1000, 3), spans=spans))
+
+    def start(self):
+        # Begin collecting add_span() timings on this thread if the request is sampled
+        sampled = self.sample()
+        _trace_state.spans = [] if sampled else None
+        return sampled
+
+    def finish(self, name, seconds, **attributes):
+        spans = getattr(_trace_state, 'spans', None)
+        _trace_state.spans = None
+        if spans is not None:
+            self.record(name, seconds, spans, **attributes)
+
+    def discard(self):
+        _trace_state.spans = None
+
+    def traces(self):
+        return list(self._traces)
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for trace in self.traces():
+                f.write(json.dumps(trace) + '\n')
+
+class InstrumentedStore(ProgressStore):
+    # Times every storage call into a histogram labelled by operation
+    def __init__(self, backend, histogram):
+        self.backend = backend
+        self.histogram = histogram
+
+    def load(self, storage_id):
+        with self.histogram.time(('load',)):
+            return self.backend.load(storage_id)
+
+    def save(self, storage_id, progress):
+        with self.histogram.time(('save',)):
+            return self.backend.save(storage_id, progress)
+
+    def append(self, storage_id, turns, fields):
+        with self.histogram.time(('append',)):
+            return self.backend.append(storage_id, turns, fields)
+
+    def update(self, storage_id, change):
+        with self.histogram.time(('update',)):
+            return self.backend.update(storage_id, change)
+
+    def exists(self, storage_id):
+        with self.histogram.time(('exists',)):
+            return self.backend.exists(storage_id)
+
+    def version(self, storage_id):
+        with self.histogram.time(('version',)):
+            return self.backend.version(storage_id)
+
+    def load_history(self, storage_id, start=0, end=None):
+        with self.histogram.time(('load_history',)):
+            return self.backend.load_history(storage_id, start, end)
+
+    def load_tail(self, storage_id, limit):
+        with self.histogram.time(('load_tail',)):
+            return self.backend.load_tail(storage_id, limit)
+
+    def history_page(self, storage_id, before, limit):
+        with self.histogram.time(('history_page',)):
+            return self.backend.history_page(storage_id, before, limit)
+
+    def history_length(self, storage_id):
+        with self.histogram.time(('history_length',)):
+            return self.backend.history_length(storage_id)
+
+    def close(self):
+        self.backend.close()
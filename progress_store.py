@@ -0,0 +1,806 @@
+import heapq
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: file stores lock between threads only
+    fcntl = None
+
+DATA_DIR = 'data'
+STORAGE_BACKENDS = ('files', 'sqlite')
+SQLITE_FILENAME = 'progress.db'
+JOURNAL_SEQ_FIELD = '_journalSeq'
+COMPACT_JOURNAL_BYTES = 256 * 1024
+COMPACT_JOURNAL_ENTRIES = 200
+LOCK_STRIPES = 64
+# Lock files shared by every process using a data dir, one per lock stripe
+PROCESS_LOCK_DIR = '.locks'
+WRITE_BEHIND_WINDOW = 0.5  # seconds
+WRITE_BEHIND_MAX_PENDING = 10000
+
+class LRUCache:
+    # Small thread-safe LRU keyed by entry count
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                return default
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+class ByteLRUCache:
+    # LRU bounded by total payload bytes. A reader that fills the cache passes the generation
+    # it saw before loading; if the key was invalidated meanwhile the stale value is dropped.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._size = 0
+        self._generations = [0] * LOCK_STRIPES
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def generation(self, key):
+        return self._generations[hash(key) % LOCK_STRIPES]
+
+    def put(self, key, value, size, generation=None):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation(key):
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[key] = (value, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generations[hash(key) % LOCK_STRIPES] += 1
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+
+    @property
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+class SharedLocks:
+    # Striped per-user locks that also hold between processes sharing a data dir (prefork
+    # workers, maintenance scripts). A stripe is a thread lock plus flock() on its own file in
+    # `directory`. flock belongs to the open file, not the process, so threads of different
+    # processes waiting on each other's stripes aren't mistaken for a deadlock the way fcntl
+    # record locks are. Stripes are picked with crc32 because hash() differs between processes.
+    def __init__(self, directory, stripes=LOCK_STRIPES):
+        self.directory = directory
+        self._stripes = [_SharedLockStripe(os.path.join(directory, f'{i}.lock')) for i in range(stripes)]
+
+    def lock_for(self, storage_id):
+        return self._stripes[zlib.crc32(storage_id.encode()) % len(self._stripes)]
+
+    def close(self):
+        for stripe in self._stripes:
+            stripe.close()
+
+class _SharedLockStripe:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._fd = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            if self._fd is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except BaseException:
+            self.lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        with self.lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+def file_signature(path):
+    # Changes whenever the file is rewritten or appended to; None if it doesn't exist
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+def atomic_write_json(path, data):
+    # Write to a temp file, fsync, then rename over the target so readers never see a torn file
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def apply_delta(progress, entry):
+    turns = entry.get('turns')
+    if turns:
+        progress.setdefault('chatHistory', []).extend(turns)
+    for field, value in (entry.get('fields') or {}).items():
+        progress[field] = value
+
+class ProgressStore:
+    # Interface ProgressHandler talks to. Documents are the same shape the frontend sends:
+    # top-level fields plus a chatHistory list of turns.
+    def load(self, storage_id):
+        raise NotImplementedError
+
+    def save(self, storage_id, progress):
+        raise NotImplementedError
+
+    def append(self, storage_id, turns, fields):
+        raise NotImplementedError
+
+    def update(self, storage_id, change):
+        # Read-modify-write under the user's lock, which holds across processes sharing the
+        # data. change(progress) gets the current document (None if there is none) and returns
+        # the document to store, or None to leave it alone. True if it was written.
+        raise NotImplementedError
+
+    def exists(self, storage_id):
+        raise NotImplementedError
+
+    def version(self, storage_id):
+        # Opaque value that changes on every write to the user's progress, including writes
+        # from other processes. Caches compare it before trusting what they hold.
+        raise NotImplementedError
+
+    def load_history(self, storage_id, start=0, end=None):
+        # Turns in [start, end); both bounds are non-negative turn indexes
+        progress = self.load(storage_id) or {}
+        return (progress.get('chatHistory') or [])[start:end]
+
+    def load_tail(self, storage_id, limit):
+        # (document with only the last `limit` turns, index of the first one, total turns)
+        progress = self.load(storage_id)
+        if progress is None:
+            return None, 0, 0
+        history = progress.get('chatHistory') or []
+        start = max(0, len(history) - limit)
+        return dict(progress, chatHistory=history[start:]), start, len(history)
+
+    def history_page(self, storage_id, before, limit):
+        # (turns, start, end, total) for up to `limit` turns ending just before `before`
+        history = (self.load(storage_id) or {}).get('chatHistory') or []
+        end = len(history) if before is None else min(before, len(history))
+        start = max(0, end - limit)
+        return history[start:end], start, end, len(history)
+
+    def history_length(self, storage_id):
+        progress = self.load(storage_id) or {}
+        return len(progress.get('chatHistory') or [])
+
+    def close(self):
+        pass
+
+class FileProgressStore(ProgressStore):
+    # One snapshot per user (data/<id>.json) plus an append-only journal of deltas
+    # (data/<id>.journal). Each journal line carries a sequence number and the snapshot
+    # records the last one it contains, so replaying after a crash never applies a delta twice.
+    # Where fcntl is available the per-user locks hold across processes, so several server
+    # processes can share one data dir.
+    def __init__(self, data_dir=DATA_DIR):
+        self.data_dir = data_dir
+        if fcntl is not None:
+            self._shared_locks = SharedLocks(os.path.join(data_dir, PROCESS_LOCK_DIR))
+        else:
+            self._shared_locks = None
+            self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        # storage id -> ((journal inode, size), last seq, entry count) so appends don't rescan
+        # the journal; the inode catches a journal another process replaced
+        self._journal_state = LRUCache(4096)
+        self.compactor = JournalCompactor(self)
+
+    def snapshot_path(self, storage_id):
+        return os.path.join(self.data_dir, f'{storage_id}.json')
+
+    def journal_path(self, storage_id):
+        return os.path.join(self.data_dir, f'{storage_id}.journal')
+
+    def _lock_for(self, storage_id):
+        if self._shared_locks is not None:
+            return self._shared_locks.lock_for(storage_id)
+        return self._locks[hash(storage_id) % LOCK_STRIPES]
+
+    def load(self, storage_id):
+        with self._lock_for(storage_id):
+            return self._load_locked(storage_id)
+
+    def save(self, storage_id, progress):
+        # A full document supersedes every journaled delta
+        with self._lock_for(storage_id):
+            self._write_snapshot(storage_id, progress, self._last_seq(storage_id))
+
+    def append(self, storage_id, turns, fields):
+        with self._lock_for(storage_id):
+            seq = self._last_seq(storage_id, check_snapshot=True) + 1
+            line = json.dumps({'seq': seq, 'turns': turns, 'fields': fields}) + '\n'
+            os.makedirs(self.data_dir, exist_ok=True)
+            with open(self.journal_path(storage_id), 'a') as f:
+                f.write(line)
+                size = f.tell()
+                signature = (os.fstat(f.fileno()).st_ino, size)
+            entries = self._journal_state.get(storage_id, (None, 0, 0))[2] + 1
+            self._journal_state.put(storage_id, (signature, seq, entries))
+
+        if size > COMPACT_JOURNAL_BYTES or entries > COMPACT_JOURNAL_ENTRIES:
+            self.compactor.schedule(storage_id)
+        return seq
+
+    def exists(self, storage_id):
+        return (os.path.exists(self.snapshot_path(storage_id))
+                or os.path.exists(self.journal_path(storage_id)))
+
+    def version(self, storage_id):
+        # Snapshots are replaced through a temp file and journals only grow until they are
+        # replaced the same way, so inode, size and mtime together change on every write
+        return file_signature(self.snapshot_path(storage_id)), file_signature(self.journal_path(storage_id))
+
+    def update(self, storage_id, change):
+        with self._lock_for(storage_id):
+            progress = change(self._load_locked(storage_id))
+            if progress is None:
+                return False
+            self._write_snapshot(storage_id, progress, self._last_seq(storage_id))
+            return True
+
+    def compact(self, storage_id):
+        with self._lock_for(storage_id):
+            if not os.path.exists(self.journal_path(storage_id)):
+                return
+            progress = self._load_locked(storage_id)
+            if progress is not None:
+                self._write_snapshot(storage_id, progress, self._last_seq(storage_id))
+
+    def close(self):
+        self.compactor.stop()
+        if self._shared_locks is not None:
+            self._shared_locks.close()
+
+    def _load_locked(self, storage_id):
+        progress = self._read_snapshot(storage_id)
+        base_seq = progress.pop(JOURNAL_SEQ_FIELD, 0) if progress is not None else 0
+        for entry in self._read_journal(storage_id):
+            if entry['seq'] > base_seq:
+                if progress is None:
+                    progress = {}
+                apply_delta(progress, entry)
+        return progress
+
+    def _write_snapshot(self, storage_id, progress, seq):
+        os.makedirs(self.data_dir, exist_ok=True)
+        snapshot = dict(progress)
+        snapshot.pop(JOURNAL_SEQ_FIELD, None)
+        if seq:
+            snapshot[JOURNAL_SEQ_FIELD] = seq
+        atomic_write_json(self.snapshot_path(storage_id), snapshot)
+        if seq:
+            # Reset the journal to a bare marker so the next append continues the sequence
+            marker = json.dumps({'seq': seq}) + '\n'
+            journal_file = self.journal_path(storage_id)
+            tmp_path = journal_file + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(marker)
+                signature = (os.fstat(f.fileno()).st_ino, len(marker))
+            os.replace(tmp_path, journal_file)
+            self._journal_state.put(storage_id, (signature, seq, 0))
+
+    def _last_seq(self, storage_id, check_snapshot=False):
+        journal_file = self.journal_path(storage_id)
+        try:
+            st = os.stat(journal_file)
+        except OSError:
+            if not check_snapshot:
+                return 0
+            # No journal; a snapshot left by an earlier compaction may still carry a sequence
+            snapshot = self._read_snapshot(storage_id)
+            return snapshot.get(JOURNAL_SEQ_FIELD, 0) if snapshot else 0
+        cached = self._journal_state.get(storage_id)
+        if cached is not None and cached[0] == (st.st_ino, st.st_size):
+            return cached[1]
+        size = self._repair_journal_tail(journal_file)
+        seq = entries = 0
+        for entry in self._read_journal(storage_id):
+            seq = max(seq, entry['seq'])
+            entries += 1
+        self._journal_state.put(storage_id, ((st.st_ino, size), seq, entries))
+        return seq
+
+    def _repair_journal_tail(self, journal_file):
+        # Drop a torn last line so the next append doesn't get glued onto it
+        with open(journal_file, 'rb+') as f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end != len(data):
+                f.truncate(end)
+        return end
+
+    def _read_snapshot(self, storage_id):
+        try:
+            with open(self.snapshot_path(storage_id), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _read_journal(self, storage_id):
+        try:
+            f = open(self.journal_path(storage_id), 'r')
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A crash mid-append can leave a torn last line
+                    continue
+                if isinstance(entry, dict) and isinstance(entry.get('seq'), int):
+                    yield entry
+
+class SQLiteProgressStore(ProgressStore):
+    # Embedded SQLite in WAL mode: top-level fields as one JSON column per user and every
+    # chatHistory turn as its own row, so appends and range reads don't touch the whole history
+    SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS progress (
+            user_id TEXT PRIMARY KEY,
+            fields TEXT NOT NULL,
+            has_history INTEGER NOT NULL DEFAULT 0,
+            turn_count INTEGER NOT NULL DEFAULT 0,
+            version INTEGER NOT NULL DEFAULT 0
+        )''',
+        '''CREATE TABLE IF NOT EXISTS turns (
+            user_id TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            turn TEXT NOT NULL,
+            PRIMARY KEY (user_id, idx)
+        ) WITHOUT ROWID''',
+    )
+
+    def __init__(self, path=None, data_dir=DATA_DIR):
+        self.path = path or os.path.join(data_dir, SQLITE_FILENAME)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        with self._transaction() as conn:
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+
+    def _connection(self):
+        # sqlite3 connections can't be shared across threads, so each worker gets its own
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    @contextmanager
+    def _read(self):
+        # Reads spanning the progress row and its turns run in one deferred transaction, which
+        # in WAL mode sees a single snapshot even while other connections write
+        conn = self._connection()
+        conn.execute('BEGIN')
+        try:
+            yield conn
+        finally:
+            conn.execute('COMMIT')
+
+    def load(self, storage_id):
+        with self._read() as conn:
+            return self._load(conn, storage_id)
+
+    def save(self, storage_id, progress):
+        with self._transaction() as conn:
+            self._save(conn, storage_id, progress)
+
+    def update(self, storage_id, change):
+        # BEGIN IMMEDIATE takes the database write lock before the read, so no other
+        # connection or process can write in between
+        with self._transaction() as conn:
+            progress = change(self._load(conn, storage_id))
+            if progress is None:
+                return False
+            self._save(conn, storage_id, progress)
+            return True
+
+    def _load(self, conn, storage_id):
+        row = conn.execute('SELECT fields, has_history FROM progress WHERE user_id = ?',
+                           (storage_id,)).fetchone()
+        if row is None:
+            return None
+        progress = json.loads(row[0])
+        if row[1]:
+            progress['chatHistory'] = [json.loads(turn) for (turn,) in conn.execute(
+                'SELECT turn FROM turns WHERE user_id = ? ORDER BY idx', (storage_id,))]
+        return progress
+
+    def _save(self, conn, storage_id, progress):
+        history = progress.get('chatHistory')
+        has_history = isinstance(history, list)
+        turns = history if has_history else []
+        fields = {k: v for k, v in progress.items() if not (k == 'chatHistory' and has_history)}
+
+        row = conn.execute('SELECT turn_count FROM progress WHERE user_id = ?',
+                           (storage_id,)).fetchone()
+        # Clients resend the whole history on every save. Stored turns are kept up to the
+        # first one that differs from the document, so an unchanged history only writes its
+        # new tail while an edit to an earlier turn rewrites everything from that turn on.
+        # Rows are compared as serialized, the same way they were written.
+        encoded = [json.dumps(turn) for turn in turns]
+        keep = 0
+        if row is not None and row[0] and encoded:
+            cursor = conn.execute('SELECT turn FROM turns WHERE user_id = ? ORDER BY idx LIMIT ?',
+                                  (storage_id, len(encoded)))
+            for (stored,) in cursor:
+                if stored != encoded[keep]:
+                    break
+                keep += 1
+            cursor.close()
+        conn.execute('DELETE FROM turns WHERE user_id = ? AND idx >= ?', (storage_id, keep))
+        conn.executemany('INSERT INTO turns (user_id, idx, turn) VALUES (?, ?, ?)',
+                         ((storage_id, i, encoded[i]) for i in range(keep, len(encoded))))
+        self._upsert(conn, storage_id, fields, has_history, len(turns))
+
+    def append(self, storage_id, turns, fields):
+        with self._transaction() as conn:
+            row = conn.execute('SELECT fields, has_history, turn_count FROM progress WHERE user_id = ?',
+                               (storage_id,)).fetchone()
+            current, has_history, count = (json.loads(row[0]), row[1], row[2]) if row else ({}, 0, 0)
+            current.update(fields)
+            conn.executemany('INSERT INTO turns (user_id, idx, turn) VALUES (?, ?, ?)',
+                             ((storage_id, count + i, json.dumps(turn)) for i, turn in enumerate(turns)))
+            return self._upsert(conn, storage_id, current, bool(has_history or turns), count + len(turns))
+
+    def _upsert(self, conn, storage_id, fields, has_history, turn_count):
+        return conn.execute(
+            '''INSERT INTO progress (user_id, fields, has_history, turn_count, version)
+               VALUES (?, ?, ?, ?, 1)
+               ON CONFLICT (user_id) DO UPDATE SET
+                   fields = excluded.fields,
+                   has_history = excluded.has_history,
+                   turn_count = excluded.turn_count,
+                   version = progress.version + 1
+               RETURNING version''',
+            (storage_id, json.dumps(fields), int(has_history), turn_count)).fetchone()[0]
+
+    def exists(self, storage_id):
+        return self._connection().execute('SELECT 1 FROM progress WHERE user_id = ?',
+                                          (storage_id,)).fetchone() is not None
+
+    def version(self, storage_id):
+        row = self._connection().execute('SELECT version FROM progress WHERE user_id = ?',
+                                         (storage_id,)).fetchone()
+        return row[0] if row else 0
+
+    def load_history(self, storage_id, start=0, end=None):
+        with self._read() as conn:
+            end = self._turn_count(conn, storage_id) if end is None else end
+            return self._turn_range(conn, storage_id, start, end)
+
+    def history_length(self, storage_id):
+        return self._turn_count(self._connection(), storage_id)
+
+    def load_tail(self, storage_id, limit):
+        with self._read() as conn:
+            row = conn.execute('SELECT fields, turn_count FROM progress WHERE user_id = ?',
+                               (storage_id,)).fetchone()
+            if row is None:
+                return None, 0, 0
+            progress = json.loads(row[0])
+            start = max(0, row[1] - limit)
+            progress['chatHistory'] = self._turn_range(conn, storage_id, start, row[1])
+            return progress, start, row[1]
+
+    def history_page(self, storage_id, before, limit):
+        with self._read() as conn:
+            total = self._turn_count(conn, storage_id)
+            end = total if before is None else min(before, total)
+            start = max(0, end - limit)
+            return self._turn_range(conn, storage_id, start, end), start, end, total
+
+    def _turn_count(self, conn, storage_id):
+        row = conn.execute('SELECT turn_count FROM progress WHERE user_id = ?', (storage_id,)).fetchone()
+        return row[0] if row else 0
+
+    def _turn_range(self, conn, storage_id, start, end):
+        return [json.loads(turn) for (turn,) in conn.execute(
+            'SELECT turn FROM turns WHERE user_id = ? AND idx >= ? AND idx < ? ORDER BY idx',
+            (storage_id, start, end))]
+
+    def close(self):
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+class WriteBehindStore(ProgressStore):
+    # Acknowledges full saves from memory and writes them on a background thread. Saves for
+    # the same user inside one window collapse into a single write of the latest document;
+    # a document stays readable from memory until the backend has it.
+    def __init__(self, backend, window=WRITE_BEHIND_WINDOW, max_pending=WRITE_BEHIND_MAX_PENDING):
+        self.backend = backend
+        self.window = window
+        self.max_pending = max_pending
+        self._pending = {}  # storage id -> (flush deadline, progress)
+        # (flush deadline, storage id) for every pending save, so the writer only looks at
+        # the ones that are due. Items for saves flushed early are skipped when they come up.
+        self._deadlines = []
+        self._cond = threading.Condition()
+        self._write_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def _write_lock_for(self, storage_id):
+        return self._write_locks[hash(storage_id) % LOCK_STRIPES]
+
+    def _pending_progress(self, storage_id):
+        with self._cond:
+            entry = self._pending.get(storage_id)
+        return entry[1] if entry is not None else None
+
+    def load(self, storage_id):
+        progress = self._pending_progress(storage_id)
+        return progress if progress is not None else self.backend.load(storage_id)
+
+    def save(self, storage_id, progress):
+        with self._cond:
+            if not self._closed:
+                entry = self._pending.get(storage_id)
+                if entry is not None:
+                    # Keep the first deadline so a steady stream of saves still lands every window
+                    deadline = entry[0]
+                else:
+                    deadline = time.monotonic() + self.window
+                    heapq.heappush(self._deadlines, (deadline, storage_id))
+                    # Every window is the same length, so a new save is never due before the one
+                    # the writer is waiting for; it only needs waking when it had nothing to
+                    # wait for or the queue is full
+                    if not self._pending or len(self._pending) + 1 >= self.max_pending:
+                        self._cond.notify()
+                self._pending[storage_id] = (deadline, progress)
+                return
+        self.backend.save(storage_id, progress)
+
+    def append(self, storage_id, turns, fields):
+        # Deltas apply on top of the latest full document, so that has to reach the backend first
+        with self._write_lock_for(storage_id):
+            self._flush_locked(storage_id)
+            return self.backend.append(storage_id, turns, fields)
+
+    def update(self, storage_id, change):
+        # The backend's lock is the one shared across processes, so change() has to see what
+        # the backend holds, including a save still waiting here
+        with self._write_lock_for(storage_id):
+            self._flush_locked(storage_id)
+            return self.backend.update(storage_id, change)
+
+    def exists(self, storage_id):
+        return self._pending_progress(storage_id) is not None or self.backend.exists(storage_id)
+
+    def version(self, storage_id):
+        with self._cond:
+            entry = self._pending.get(storage_id)
+        if entry is None:
+            return self.backend.version(storage_id)
+        # Each save makes a new pending entry, so its identity marks the version until it lands
+        return 'pending', id(entry)
+
+    def load_history(self, storage_id, start=0, end=None):
+        progress = self._pending_progress(storage_id)
+        if progress is None:
+            return self.backend.load_history(storage_id, start, end)
+        return (progress.get('chatHistory') or [])[start:end]
+
+    def history_length(self, storage_id):
+        progress = self._pending_progress(storage_id)
+        if progress is None:
+            return self.backend.history_length(storage_id)
+        return len(progress.get('chatHistory') or [])
+
+    def load_tail(self, storage_id, limit):
+        if self._pending_progress(storage_id) is None:
+            return self.backend.load_tail(storage_id, limit)
+        return super().load_tail(storage_id, limit)
+
+    def history_page(self, storage_id, before, limit):
+        if self._pending_progress(storage_id) is None:
+            return self.backend.history_page(storage_id, before, limit)
+        return super().history_page(storage_id, before, limit)
+
+    def close(self):
+        # Drain everything still in memory before the backend goes away
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self.backend.close()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed and not self._pending:
+                        return
+                    if self._closed or len(self._pending) >= self.max_pending:
+                        due = list(self._pending)
+                        break
+                    now = time.monotonic()
+                    due = self._pop_due(now)
+                    if due:
+                        break
+                    self._cond.wait(self._deadlines[0][0] - now if self._deadlines else None)
+            for storage_id in due:
+                with self._write_lock_for(storage_id):
+                    self._flush_locked(storage_id)
+
+    def _pop_due(self, now):
+        due = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, storage_id = heapq.heappop(self._deadlines)
+            entry = self._pending.get(storage_id)
+            if entry is not None and entry[0] == deadline:
+                due.append(storage_id)
+        return due
+
+    def _flush_locked(self, storage_id):
+        with self._cond:
+            entry = self._pending.get(storage_id)
+        if entry is None:
+            return
+        try:
+            self.backend.save(storage_id, entry[1])
+        except Exception as e:
+            print(f'Failed to flush progress {storage_id}: {e}')
+            with self._cond:
+                if self._pending.get(storage_id) is entry:
+                    if self._closed:
+                        del self._pending[storage_id]
+                    else:
+                        deadline = time.monotonic() + self.window
+                        self._pending[storage_id] = (deadline, entry[1])
+                        heapq.heappush(self._deadlines, (deadline, storage_id))
+            return
+        with self._cond:
+            # A newer save may have arrived while writing; leave that one pending
+            if self._pending.get(storage_id) is entry:
+                del self._pending[storage_id]
+
+def open_store(backend, data_dir=DATA_DIR, write_behind=0):
+    if backend == 'files':
+        store = FileProgressStore(data_dir)
+    elif backend == 'sqlite':
+        store = SQLiteProgressStore(data_dir=data_dir)
+    else:
+        raise ValueError(f'Unknown storage backend: {backend}')
+    if write_behind > 0:
+        store = WriteBehindStore(store, window=write_behind)
+    return store
+
+class JournalCompactor:
+    # Folds journals back into their snapshots on a background thread
+    def __init__(self, store):
+        self.store = store
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def schedule(self, storage_id):
+        with self._lock:
+            if storage_id in self._pending:
+                return
+            self._pending.add(storage_id)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='journal-compactor', daemon=True)
+                self._thread.start()
+        self._queue.put(storage_id)
+
+    def stop(self):
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _run(self):
+        while True:
+            storage_id = self._queue.get()
+            if storage_id is None:
+                return
+            with self._lock:
+                self._pending.discard(storage_id)
+            try:
+                self.store.compact(storage_id)
+            except Exception as e:
+                print(f'Failed to compact journal {storage_id}: {e}')
@@ -0,0 +1,237 @@
+import codecs
+import json
+import math
+import re
+import threading
+import time
+
+from progress_store import LRUCache
+
+MAX_BODY_MB = 32  # /save-progress documents
+MAX_REQUEST_KB = 1024  # every other request body
+# Bodies up to this size are read whole and parsed with json.loads; larger ones are parsed
+# as they arrive
+STREAM_PARSE_MIN_BYTES = 1024 * 1024
+READ_CHUNK_BYTES = 64 * 1024
+# Requests being handled at once, and per client address
+MAX_CONCURRENT_REQUESTS = 64
+MAX_CLIENT_REQUESTS = 8
+# Per-client token bucket: sustained requests per second and the burst allowed on top
+CLIENT_RATE = 20.0
+CLIENT_BURST = 40
+# Body bytes that may be in flight across all uploads
+BODY_MEMORY_MB = 256
+MAX_TRACKED_CLIENTS = 65536
+# Slow clients: the request line and headers get HEADER_TIMEOUT seconds on top of the
+# keep-alive idle timeout, and a body gets BODY_TIMEOUT seconds plus its length at
+# MIN_UPLOAD_RATE bytes/s
+HEADER_TIMEOUT = 10
+BODY_TIMEOUT = 10
+MIN_UPLOAD_RATE = 64 * 1024
+# After refusing a request, what's left of its body is read and dropped for up to this long
+# (and this many bytes), so a client still sending gets the response rather than a reset
+LINGER_TIMEOUT = 2
+LINGER_BYTES = 16 * 1024 * 1024
+# Characters a JSON number can continue with; one ending the buffer may go on in the next chunk
+NUMBER_TAIL = re.compile(r'[0-9.eE+-]*\Z')
+# Object nesting levels of a streamed body that are parsed member by member
+STREAM_DEPTH = 2
+
+class RequestRejected(Exception):
+    # Turned into an error response; `reason` labels the rejection in metrics
+    def __init__(self, message, status, reason, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+def body_deadline(length, clock=time.monotonic):
+    return clock() + BODY_TIMEOUT + length / MIN_UPLOAD_RATE
+
+class TokenBucket:
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def take(self, now):
+        # 0 if a token was taken, otherwise seconds until one is available
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class AdmissionController:
+    # Decides whether a request may start. Requests with `limited` set count against the
+    # per-client token bucket and the per-client and global concurrency limits; every request
+    # with a body also counts its Content-Length against a shared budget of body bytes being
+    # read at once. admit() returns a ticket to pass to release() when the request is done,
+    # or raises RequestRejected: 429 when one client is asking too much, 503 when the server
+    # as a whole is busy.
+    def __init__(self, max_concurrent=MAX_CONCURRENT_REQUESTS, max_client_concurrent=MAX_CLIENT_REQUESTS,
+                 client_rate=CLIENT_RATE, client_burst=CLIENT_BURST, body_memory=BODY_MEMORY_MB * 1024 * 1024,
+                 max_clients=MAX_TRACKED_CLIENTS, clock=time.monotonic):
+        self.max_concurrent = max_concurrent
+        self.max_client_concurrent = max_client_concurrent
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.body_memory = body_memory
+        self.clock = clock
+        self._buckets = LRUCache(max_clients)
+        self._client_requests = {}  # client -> requests in progress
+        self._requests = 0
+        self._body_bytes = 0
+        self._lock = threading.Lock()
+
+    def admit(self, client, body_bytes=0, limited=True):
+        with self._lock:
+            if limited:
+                if self.client_rate > 0:
+                    now = self.clock()
+                    bucket = self._buckets.get(client)
+                    if bucket is None:
+                        bucket = TokenBucket(self.client_rate, self.client_burst, now)
+                        self._buckets.put(client, bucket)
+                    wait = bucket.take(now)
+                    if wait:
+                        raise RequestRejected('Too many requests', 429, 'rate_limited', max(1, math.ceil(wait)))
+                if self._client_requests.get(client, 0) >= self.max_client_concurrent:
+                    raise RequestRejected('Too many concurrent requests', 429, 'client_concurrency', 1)
+                if self._requests >= self.max_concurrent:
+                    raise RequestRejected('Server busy', 503, 'overloaded', 1)
+            # One body is always let through, so the budget never blocks a body within the size limit
+            if body_bytes and self._body_bytes and self._body_bytes + body_bytes > self.body_memory:
+                raise RequestRejected('Server busy', 503, 'body_memory', 1)
+            if limited:
+                self._client_requests[client] = self._client_requests.get(client, 0) + 1
+                self._requests += 1
+            self._body_bytes += body_bytes
+        return client, body_bytes, limited
+
+    def release(self, ticket):
+        client, body_bytes, limited = ticket
+        with self._lock:
+            self._body_bytes -= body_bytes
+            if limited:
+                self._requests -= 1
+                remaining = self._client_requests[client] - 1
+                if remaining:
+                    self._client_requests[client] = remaining
+                else:
+                    del self._client_requests[client]
+
+    def in_flight(self):
+        with self._lock:
+            return self._requests, self._body_bytes
+
+def parse_json_stream(read, length, chunk_size=READ_CHUNK_BYTES):
+    # Parse a JSON document of exactly `length` bytes from read(n) without ever holding the
+    # whole body. Objects down to STREAM_DEPTH levels are walked member by member and arrays
+    # inside them item by item ({"progress": {"chatHistory": [turn, ...]}}), while each turn
+    # or other value is decoded whole once it has arrived. Memory is the parsed result plus
+    # about one turn. Raises ValueError for malformed or truncated JSON.
+    stream = _JSONStream(read, length, chunk_size)
+    value = stream.value(0)
+    if stream.peek():
+        raise ValueError('unexpected data after the JSON document')
+    return value
+
+class _JSONStream:
+    def __init__(self, read, length, chunk_size):
+        self.read = read
+        self.remaining = length
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+
+    def fill(self, at_least=1):
+        # Append at least `at_least` more characters' worth of body; False once it is all read
+        if not self.remaining:
+            return False
+        parts = [self.buffer[self.pos:]]
+        wanted = max(at_least, self.chunk_size)
+        while self.remaining and wanted > 0:
+            chunk = self.read(min(self.remaining, max(wanted, self.chunk_size)))
+            if not chunk:
+                raise ValueError('request body ended early')
+            self.remaining -= len(chunk)
+            wanted -= len(chunk)
+            parts.append(self.utf8.decode(chunk, final=not self.remaining))
+        self.buffer = ''.join(parts)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        # Next non-whitespace character, or '' at the end of the body
+        while True:
+            buffer = self.buffer
+            pos = self.pos
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                pos += 1
+            self.pos = pos
+            if pos < len(buffer):
+                return buffer[pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f'expected one of {chars!r} at body offset {self.pos}')
+        self.pos += 1
+        return char
+
+    def value(self, depth=None):
+        # `depth` counts the streamed objects around this value; None decodes it whole
+        char = self.peek()
+        if depth is not None:
+            if char == '{' and depth < STREAM_DEPTH:
+                return self.object(depth + 1)
+            if char == '[':
+                return self.array()
+        # A failure near the end of the buffer may just mean the value isn't all here yet; the
+        # buffer is then at least doubled before retrying, so a large value costs amortized
+        # linear time
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill(len(self.buffer) - self.pos):
+                    raise
+                continue
+            if self.remaining and self.buffer[self.pos] not in '"{[tfn' and NUMBER_TAIL.match(self.buffer, end):
+                self.fill()
+                continue
+            self.pos = end
+            return value
+
+    def object(self, depth):
+        self.pos += 1
+        members = {}
+        if self.peek() == '}':
+            self.pos += 1
+            return members
+        while True:
+            if self.peek() != '"':
+                raise ValueError(f'expected an object key at body offset {self.pos}')
+            key = self.value()
+            self.expect(':')
+            members[key] = self.value(depth)
+            if self.expect(',}') == '}':
+                return members
+
+    def array(self):
+        self.pos += 1
+        items = []
+        if self.peek() == ']':
+            self.pos += 1
+            return items
+        while True:
+            items.append(self.value())
+            if self.expect(',]') == ']':
+                return items
@@ -0,0 +1,68 @@
+import hashlib
+import json
+import threading
+import time
+
+from context_builder import normalize_messages
+from progress_store import LRUCache
+
+RESPONSE_CACHE_SIZE = 2048
+RESPONSE_CACHE_TTL = 600  # seconds
+# Turns before the new message that take part in the key; a reply to "hi" only depends on
+# what was said just before it, not on the whole conversation
+CACHE_CONTEXT_TURNS = 2
+
+def normalize_text(text):
+    return ' '.join(text.casefold().split())
+
+class ResponseCache:
+    # Complete model replies keyed by provider, model, generation config, system prompt and the
+    # normalized tail of the conversation. Entries expire after `ttl` seconds; the least recently
+    # used are evicted beyond `max_entries`. Personalities in `uncached_personalities` always go
+    # to the model.
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL,
+                 context_turns=CACHE_CONTEXT_TURNS, uncached_personalities=(), clock=time.monotonic):
+        self.ttl = ttl
+        self.context_turns = context_turns
+        self.uncached_personalities = frozenset(uncached_personalities)
+        self.clock = clock
+        self._entries = LRUCache(max_entries)  # key -> (expires at, reply)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def enabled_for(self, personality=None):
+        return self._entries.max_entries > 0 and personality not in self.uncached_personalities
+
+    def key(self, provider, model, config, system_prompt, messages):
+        recent = normalize_messages(messages)[-(self.context_turns + 1):]
+        material = json.dumps([provider, model, config or {}, system_prompt or '',
+                               [[m['role'], normalize_text(m['text'])] for m in recent]],
+                              sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] <= self.clock():
+            self._entries.pop(key)
+            entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return entry[1]
+
+    def put(self, key, reply):
+        if reply:
+            self._entries.put(key, (self.clock() + self.ttl, reply))
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {'hits': hits, 'misses': misses, 'entries': len(self._entries),
+                'hitRate': hits / lookups if lookups else 0.0}
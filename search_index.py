@@ -0,0 +1,171 @@
+import hashlib
+import heapq
+import math
+import re
+import threading
+from array import array
+from collections import OrderedDict
+
+from context_builder import turn_text
+from progress_store import LOCK_STRIPES
+
+SEARCH_RESULT_LIMIT = 20
+MAX_SEARCH_RESULT_LIMIT = 200
+# Indexes kept in memory, bounded by the total number of turns they cover
+SEARCH_INDEX_MAX_TURNS = 2000000
+SNIPPET_CHARS = 160
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+# In multi-word queries, words found in more than this share of turns add almost nothing to
+# the ranking but cost the most to score, so they are skipped
+COMMON_TERM_SHARE = 0.5
+TOKEN_PATTERN = re.compile(r'\w+')
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.casefold())
+
+def make_snippet(text, terms, width=SNIPPET_CHARS):
+    # A window of `width` characters around the first query word found in the text
+    folded = text.casefold()
+    positions = [folded.find(term) for term in terms]
+    hit = min((p for p in positions if p >= 0), default=0)
+    start = max(0, min(hit - width // 3, len(text) - width))
+    snippet = ' '.join(text[start:start + width].split())
+    return ('…' if start > 0 else '') + snippet + ('…' if start + width < len(text) else '')
+
+class SearchIndex:
+    # Inverted index over one ordered list of documents (chat turns or conversations).
+    # Documents are only ever appended, so every posting list stays sorted by offset.
+    def __init__(self):
+        self.postings = {}  # term -> (array of offsets, array of term counts)
+        self.lengths = array('I')  # tokens per document
+        self.texts = []
+        self.roles = []
+        self.total_tokens = 0
+        self.fingerprint = None  # of the last document, to notice a rewritten history
+        self.version = None  # storage version the index was last brought up to
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def add(self, text, role=None):
+        offset = len(self.lengths)
+        counts = {}
+        tokens = tokenize(text)
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for term, count in counts.items():
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = (array('I'), array('I'))
+            posting[0].append(offset)
+            posting[1].append(count)
+        self.lengths.append(len(tokens))
+        self.texts.append(text)
+        self.roles.append(role)
+        self.total_tokens += len(tokens)
+        self.fingerprint = fingerprint(text)
+        return offset
+
+    def search(self, query, limit=SEARCH_RESULT_LIMIT):
+        # (ranked [(offset, score)], number of matching documents, query terms)
+        terms = list(dict.fromkeys(tokenize(query)))
+        documents = len(self.lengths)
+        postings = [(term, self.postings[term]) for term in terms if term in self.postings]
+        if not postings or not documents:
+            return [], 0, terms
+        if len(postings) > 1:
+            rare = [(term, p) for term, p in postings if len(p[0]) <= documents * COMMON_TERM_SHARE]
+            postings = rare or [min(postings, key=lambda item: len(item[1][0]))]
+
+        average_length = self.total_tokens / documents or 1
+        lengths = self.lengths
+        scores = {}
+        for _, (offsets, counts) in postings:
+            frequency = len(offsets)
+            idf = math.log(1 + (documents - frequency + 0.5) / (frequency + 0.5))
+            for offset, count in zip(offsets, counts):
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[offset] / average_length)
+                scores[offset] = scores.get(offset, 0.0) + idf * count * (BM25_K1 + 1) / (count + norm)
+        # Ties go to the more recent document
+        ranked = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], item[0]))
+        return ranked, len(scores), terms
+
+    def results(self, query, limit=SEARCH_RESULT_LIMIT):
+        ranked, total, terms = self.search(query, limit)
+        return [{'turn': offset, 'role': self.roles[offset], 'score': round(score, 4),
+                 'snippet': make_snippet(self.texts[offset], terms)}
+                for offset, score in ranked], total
+
+def fingerprint(text):
+    return hashlib.sha1(text.encode()).digest()
+
+class ProgressSearchIndexes:
+    # One SearchIndex per user over chatHistory. Every search first compares the storage
+    # version with the one the index was last brought up to; when they differ, only the turns
+    # past the indexed ones are read and added, or the index is rebuilt if the history was
+    # rewritten. Changes are noticed through storage rather than the save handlers, so saves
+    # made by other server processes or maintenance scripts are picked up too. Least recently
+    # used indexes are dropped once together they cover more than max_turns turns.
+    def __init__(self, max_turns=SEARCH_INDEX_MAX_TURNS):
+        self.max_turns = max_turns
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+        self._user_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+    def _user_lock(self, storage_id):
+        return self._user_locks[hash(storage_id) % LOCK_STRIPES]
+
+    def _get(self, storage_id):
+        with self._lock:
+            index = self._indexes.get(storage_id)
+            if index is not None:
+                self._indexes.move_to_end(storage_id)
+            return index
+
+    def _put(self, storage_id, index):
+        with self._lock:
+            self._indexes[storage_id] = index
+            self._indexes.move_to_end(storage_id)
+            total = sum(len(i) for i in self._indexes.values())
+            while total > self.max_turns and len(self._indexes) > 1:
+                _, evicted = self._indexes.popitem(last=False)
+                total -= len(evicted)
+
+    def search(self, storage_id, query, store, limit=SEARCH_RESULT_LIMIT):
+        with self._user_lock(storage_id):
+            # Read the version before the turns, so a write landing in between is caught next time
+            version = store.version(storage_id)
+            index = self._get(storage_id)
+            if index is None or index.version != version:
+                index = self._refresh(storage_id, index, store, version)
+        with index.lock:
+            return index.results(query, limit)
+
+    def _refresh(self, storage_id, index, store, version):
+        count = len(index) if index is not None else 0
+        # The last indexed turn is read again to check the history still continues from it
+        turns = store.load_history(storage_id, max(0, count - 1))
+        if count:
+            if turns and fingerprint(turn_text(turns[0])) == index.fingerprint:
+                turns = turns[1:]
+            else:
+                index = None
+                turns = store.load_history(storage_id)
+        if index is None:
+            index = SearchIndex()
+        with index.lock:
+            for turn in turns:
+                index.add(turn_text(turn), turn_role(turn))
+            index.version = version
+        self._put(storage_id, index)
+        return index
+
+    def drop(self, storage_id):
+        with self._lock:
+            self._indexes.pop(storage_id, None)
+
+def turn_role(turn):
+    return turn.get('role') if isinstance(turn, dict) else None
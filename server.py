@@ -1,22 +1,151 @@
 import http.server
 import socketserver
+import socket
 import json
 import os
 import hashlib
 import secrets
+import argparse
+import asyncio
+import io
+import threading
+import glob
+import re
+import signal
+import sys
+import gzip
+import zlib
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse, parse_qs
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, MultiFernet
 import base64
+from static_assets import StaticAssetCache, encoding_etag
+from avatar_store import AVATAR_URL_PREFIX, MAX_AVATAR_BYTES, AvatarError, AvatarStore, avatar_url
+from context_builder import ContextBuilder, DEFAULT_TOKEN_BUDGET
+from llm_proxy import DEFAULT_MODELS, HEDGE_AFTER, LLMProxy, ProviderError
+from metrics import InstrumentedStore, MetricsRegistry, TRACE_SAMPLE_RATE, TraceSampler
+from response_cache import RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, ResponseCache
+from request_limits import (BODY_MEMORY_MB, BODY_TIMEOUT, CLIENT_BURST, CLIENT_RATE, HEADER_TIMEOUT,
+                            LINGER_BYTES, LINGER_TIMEOUT, MAX_BODY_MB, MAX_CLIENT_REQUESTS,
+                            MAX_CONCURRENT_REQUESTS, MAX_REQUEST_KB, MIN_UPLOAD_RATE, STREAM_PARSE_MIN_BYTES,
+                            AdmissionController, RequestRejected, body_deadline, parse_json_stream)
+from search_index import MAX_SEARCH_RESULT_LIMIT, SEARCH_RESULT_LIMIT, ProgressSearchIndexes
+from progress_store import (ByteLRUCache, FileProgressStore, LRUCache, JOURNAL_SEQ_FIELD,
+                            STORAGE_BACKENDS, WRITE_BEHIND_WINDOW, file_signature, open_store)
 
 PORT = 3000
+SERVER_MODES = ('single', 'threaded', 'asyncio')
+DEFAULT_WORKERS = 32
+KEEPALIVE_TIMEOUT = 15  # seconds an idle keep-alive connection may hold a worker
+SHUTDOWN_GRACE = 10  # seconds a stopping server gives requests in progress
+# Prefork supervisor: how long workers get to stop before they are killed, and the pause
+# before restarting a worker that died within MIN_WORKER_UPTIME seconds of starting
+WORKER_STOP_TIMEOUT = SHUTDOWN_GRACE + 5
+MIN_WORKER_UPTIME = 5
+WORKER_RESTART_DELAY = 1.0
+MAX_HEADER_BYTES = 64 * 1024
+TOKEN_CACHE_SIZE = 4096
+ENCRYPTION_KEY_FILE = 'data/encryption.key'
+# Seconds between checks of the key file for a rotation made while the server runs
+KEY_CHECK_INTERVAL = 1.0
+PROGRESS_CACHE_MB = 64
+GZIP_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+CHUNK_SIZE = 64 * 1024
+# Response bytes an asyncio-mode handler may queue before it waits for the client to read them
+STREAM_HIGH_WATER = 256 * 1024
+STREAM_HISTORY_TURNS = 5000  # full loads above this many turns are streamed rather than cached
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 1000
+# Paths that get their own metrics label; everything else is counted as static
+METRIC_ENDPOINTS = frozenset({'/load-progress', '/load-history', '/save-progress', '/append-progress',
+                              '/build-context', '/chat', '/search', '/avatar', '/metrics', '/metrics/traces'})
+# /avatar/<hash> URLs name immutable content, so clients may keep them forever
+AVATAR_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Endpoints outside per-client and global admission control (body size limits still apply)
+UNLIMITED_ENDPOINTS = frozenset({'static', '/metrics', '/metrics/traces'})
+
+# Replaced in main() when another backend is selected with --storage
+progress_store = FileProgressStore()
+# storage id -> (ETag, serialized /load-progress body, gzipped body, storage version)
+progress_cache = ByteLRUCache(PROGRESS_CACHE_MB * 1024 * 1024)
+# Front-end files served from memory; preloaded in main()
+static_assets = StaticAssetCache()
+# Keeps a rolling summary per user so prompts stay within a token budget
+context_builder = ContextBuilder()
+# Pooled, rate-limited connections to the model providers behind /chat
+llm_proxy = LLMProxy()
+# Finished /chat replies for repeated prompts; rebuilt from the command line in main()
+response_cache = ResponseCache()
+# Full-text indexes over chatHistory, built on a user's first /search and caught up with
+# whatever was saved since on later ones
+search_indexes = ProgressSearchIndexes()
+# Profile pictures by content hash with pre-rendered thumbnails, served at /avatar/<hash>
+avatar_store = AvatarStore()
+# Request rate and concurrency limits and body size limits; rebuilt from the command line in serve()
+admission = AdmissionController()
+max_body_bytes = MAX_BODY_MB * 1024 * 1024  # /save-progress
+max_request_bytes = MAX_REQUEST_KB * 1024  # every other endpoint
+
+metrics = MetricsRegistry()
+http_requests = metrics.counter('progress_http_requests_total', 'Requests handled',
+                                ('endpoint', 'method', 'status'))
+http_latency = metrics.histogram('progress_http_request_seconds', 'Time from request line to last byte',
+                                 ('endpoint',))
+http_bytes = metrics.counter('progress_http_bytes_total', 'Request body and response bytes',
+                             ('endpoint', 'direction'))
+storage_latency = metrics.histogram('progress_storage_seconds', 'Progress storage call time', ('op',))
+chat_first_token = metrics.histogram('progress_chat_first_token_seconds',
+                                     'Time until /chat had its first chunk', ('provider', 'cached'))
+metrics.callback('progress_cache_lookups_total', 'Cache lookups by result', 'counter',
+                 lambda: {('progress', 'hit'): progress_cache.hits, ('progress', 'miss'): progress_cache.misses,
+                          ('response', 'hit'): response_cache.hits, ('response', 'miss'): response_cache.misses},
+                 ('cache', 'result'))
+http_rejected = metrics.counter('progress_http_rejected_total', 'Requests refused by size limits, '
+                                'admission control or read timeouts', ('endpoint', 'reason'))
+metrics.callback('progress_requests_in_flight', 'API requests being handled, and request body bytes '
+                 'admitted but not yet released', 'gauge',
+                 lambda: dict(zip((('requests',), ('body_bytes',)), admission.in_flight())), ('kind',))
+metrics.callback('progress_cache_bytes', 'Memory held by cached /load-progress responses', 'gauge',
+                 lambda: progress_cache.size)
+# Per-request span timings for a sample of requests, served at /metrics/traces
+trace_sampler = TraceSampler()
+
+def key_ring(key_data):
+    # encryption.key holds one Fernet key per line, newest first. Tokens are issued with the
+    # first key and accepted under any of them, so a rotated-out key keeps working until it
+    # is retired.
+    return MultiFernet([Fernet(key) for key in key_data.split()])
 
 class APIKeyManager:
+    _shared = None
+    _shared_lock = threading.Lock()
+
     def __init__(self):
         self.key = self._get_or_create_key()
-        self.cipher = Fernet(self.key)
+        self.cipher = key_ring(self.key)
+        self._key_signature = file_signature(ENCRYPTION_KEY_FILE)
+        self._key_checked = time.monotonic()
+        self._key_lock = threading.Lock()
+        # encrypted token -> storage id ('' marks a token that failed to decrypt)
+        self._token_cache = LRUCache(TOKEN_CACHE_SIZE)
+        # storage ids whose legacy raw-key file has already been checked
+        self._migrated_ids = LRUCache(TOKEN_CACHE_SIZE)
+        self._migration_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        # One manager per process so the key file is read and the cipher built only once
+        if cls._shared is None:
+            with cls._shared_lock:
+                if cls._shared is None:
+                    cls._shared = cls()
+        return cls._shared
 
     def _get_or_create_key(self):
-        key_file = 'data/encryption.key'
+        key_file = ENCRYPTION_KEY_FILE
         if os.path.exists(key_file):
             with open(key_file, 'rb') as f:
                 return f.read()
@@ -24,7 +153,13 @@ class APIKeyManager:
             # Ensure data directory exists
             os.makedirs('data', exist_ok=True)
             key = Fernet.generate_key()
-            with open(key_file, 'wb') as f:
+            try:
+                # O_EXCL so two processes starting together cannot write different keys
+                fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            except FileExistsError:
+                with open(key_file, 'rb') as f:
+                    return f.read()
+            with os.fdopen(fd, 'wb') as f:
                 f.write(key)
             # Restrict file permissions (Unix/Linux)
             try:
@@ -33,14 +168,36 @@ class APIKeyManager:
                 pass  # Windows doesn't support chmod
             return key
 
+    def _check_key_file(self):
+        # Pick up keys rotated by maintenance.py without a restart. Cached token lookups are
+        # dropped with the old key ring so a retired key stops resolving within a second.
+        now = time.monotonic()
+        if now - self._key_checked < KEY_CHECK_INTERVAL:
+            return
+        self._key_checked = now
+        signature = file_signature(ENCRYPTION_KEY_FILE)
+        if signature is None or signature == self._key_signature:
+            return
+        with self._key_lock:
+            if signature == self._key_signature:
+                return
+            with open(ENCRYPTION_KEY_FILE, 'rb') as f:
+                key = f.read()
+            self.cipher = key_ring(key)
+            self.key = key
+            self._key_signature = signature
+            self._token_cache.clear()
+
     def encrypt_key(self, api_key):
         if not api_key:
             return None
+        self._check_key_file()
         return self.cipher.encrypt(api_key.encode()).decode()
 
     def decrypt_key(self, encrypted_key):
         if not encrypted_key:
             return None
+        self._check_key_file()
         try:
             return self.cipher.decrypt(encrypted_key.encode()).decode()
         except:
@@ -50,74 +207,643 @@ class APIKeyManager:
         # Create a secure hash for user identification
         return hashlib.sha256(str(user_data).encode()).hexdigest()[:16]
 
+    def storage_id_for_key(self, api_key):
+        storage_id = self.hash_user_id(api_key)
+        if self._migrated_ids.get(storage_id) is None:
+            with self._migration_lock:
+                migrate_legacy_progress(api_key, storage_id)
+            self._migrated_ids.put(storage_id, True)
+        return storage_id
+
+    def resolve_token(self, encrypted_key):
+        # Map an encrypted API key to its storage id; Fernet runs only on a cache miss
+        if not encrypted_key:
+            return None
+        self._check_key_file()
+        storage_id = self._token_cache.get(encrypted_key)
+        if storage_id is None:
+            api_key = self.decrypt_key(encrypted_key)
+            storage_id = self.storage_id_for_key(api_key) if api_key else ''
+            self._token_cache.put(encrypted_key, storage_id)
+        return storage_id or None
+
+def migrate_legacy_progress(api_key, storage_id):
+    # Progress used to be saved as data/<raw api key>.json; move it to the hashed name
+    api_key = str(api_key)
+    if os.path.basename(api_key) != api_key or api_key.startswith('.'):
+        return
+    legacy_file = f'data/{api_key}.json'
+    if not os.path.exists(legacy_file):
+        return
+
+    def adopt(progress):
+        # Checked under the user's lock: with --processes another worker may already have
+        # migrated the file and taken appends, and that newer document must not be overwritten
+        if progress is not None:
+            return None
+        with open(legacy_file, 'r') as f:
+            return json.load(f)
+
+    try:
+        progress_store.update(storage_id, adopt)
+        os.remove(legacy_file)
+    except FileNotFoundError:
+        # Another server process migrated it first
+        pass
+
 class ProgressHandler(http.server.SimpleHTTPRequestHandler):
+    # HTTP/1.1 so browsers can reuse connections; every response must carry a Content-Length
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
+    # Headers and body go out as separate writes; without TCP_NODELAY the body waits for the
+    # client's delayed ACK (~40ms) on every keep-alive response
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.wfile = CountingWriter(self.wfile)
+        # Reads on a real socket are bounded by read_deadline as a whole; see DeadlineReader
+        self.read_deadline = None
+        self.admission_ticket = None
+        if isinstance(self.connection, socket.socket):
+            self.rfile.close()
+            self.rfile = io.BufferedReader(DeadlineReader(self.connection, self))
+
+    def handle_one_request(self):
+        # Between requests the connection is idle, and a draining server may close it
+        connection_idle = getattr(self.server, 'connection_idle', None)
+        if connection_idle is not None and not connection_idle(self.connection):
+            self.close_connection = True
+            return
+        # Times each request and records it by endpoint once the response has been written
+        self.status_code = None
+        sent_before = self.wfile.bytes
+        start = time.perf_counter()
+        trace_sampler.start()
+        # The request line and headers must all arrive within this, however slowly they trickle in
+        self.read_deadline = time.monotonic() + self.timeout + HEADER_TIMEOUT
+        try:
+            super().handle_one_request()
+        except RequestRejected as e:
+            # Raised while the body was being read, before any response was started
+            try:
+                self.send_rejection(e)
+            except OSError:
+                self.close_connection = True
+        finally:
+            self.read_deadline = None
+            if self.admission_ticket is not None:
+                admission.release(self.admission_ticket)
+                self.admission_ticket = None
+        elapsed = time.perf_counter() - start
+        if self.status_code is None:
+            # Idle keep-alive connection closed; nothing was handled
+            trace_sampler.discard()
+            return
+        # A malformed request line is rejected before path and headers are parsed
+        endpoint = endpoint_label(getattr(self, 'path', ''))
+        headers = getattr(self, 'headers', None)
+        http_requests.inc((endpoint, self.command or '-', str(self.status_code)))
+        http_latency.observe((endpoint,), elapsed)
+        http_bytes.inc((endpoint, 'in'), int((headers and headers.get('Content-Length')) or 0))
+        http_bytes.inc((endpoint, 'out'), self.wfile.bytes - sent_before)
+        trace_sampler.finish(endpoint, elapsed, method=self.command, status=self.status_code)
+
+    def parse_request(self):
+        # The request line has arrived, so the connection is no longer idle
+        connection_busy = getattr(self.server, 'connection_busy', None)
+        if connection_busy is not None:
+            connection_busy(self.connection)
+        if not super().parse_request() or not self.admit():
+            return False
+        content_length = int(self.headers.get('Content-Length') or 0)
+        self.read_deadline = body_deadline(content_length) if content_length else None
+        return True
+
+    def handle_expect_100(self):
+        # Refuse before the client is told to send its body
+        return self.admit() and super().handle_expect_100()
+
+    def admit(self):
+        # Size limits and admission control are checked before the body is read. The asyncio
+        # server has already done so in its event loop.
+        if self.admission_ticket is not None or getattr(self.server, 'admits_requests', False):
+            return True
+        try:
+            self.admission_ticket = admit_request(self.client_address, self.path,
+                                                  self.headers.get('Content-Length'),
+                                                  self.headers.get('Transfer-Encoding'))
+        except RequestRejected as e:
+            self.send_rejection(e)
+            return False
+        return True
+
+    def finish(self):
+        connection_busy = getattr(self.server, 'connection_busy', None)
+        if connection_busy is not None:
+            connection_busy(self.connection)
+        super().finish()
+
+    def log_request(self, code='-', size='-'):
+        self.status_code = int(code) if str(code).isdigit() else code
+        super().log_request(code, size)
+
+    def accepts_encoding(self, encoding):
+        for coding in (self.headers.get('Accept-Encoding') or '').split(','):
+            name, _, params = coding.partition(';')
+            if name.strip().lower() == encoding:
+                try:
+                    return float(params.strip().partition('q=')[2] or 1) > 0
+                except ValueError:
+                    return True
+        return False
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        gzip_body = gzip.compress(body, GZIP_LEVEL) if len(body) >= GZIP_MIN_BYTES and self.accepts_encoding('gzip') else None
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        if gzip_body is not None:
+            body = gzip_body
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_cached_json(self, etag, body, gzip_body):
+        # Clients revalidate with If-None-Match and get a bodyless 304 when nothing changed.
+        # The gzip body is a different representation, so it is matched against its own ETag.
+        use_gzip = gzip_body is not None and self.accepts_encoding('gzip')
+        if use_gzip:
+            body = gzip_body
+            etag = encoding_etag(etag, 'gzip')
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+            if gzip_body is not None:
+                self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        if gzip_body is not None:
+            self.send_header('Vary', 'Accept-Encoding')
+        if use_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json_stream(self, payload):
+        # Encode incrementally and send as chunks so a huge history is never held as one buffer.
+        # Every mode writes straight to the client: in asyncio mode _StreamingConnection waits
+        # once STREAM_HIGH_WATER bytes are queued, so a slow reader holds up the encoder instead.
+        if self.request_version != 'HTTP/1.1':
+            return self.send_json(200, payload)
+        use_gzip = self.accepts_encoding('gzip')
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        if use_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        writer = ChunkedWriter(self.wfile, use_gzip)
+        for piece in json.JSONEncoder().iterencode(payload):
+            writer.write(piece.encode())
+        writer.close()
+
+    def send_rejection(self, rejection):
+        # The request body may be unread, so the connection can't carry another request
+        http_rejected.inc((endpoint_label(getattr(self, 'path', '')), rejection.reason))
+        self.close_connection = True
+        self.connection.settimeout(self.timeout)
+        body = json.dumps({'error': str(rejection)}).encode()
+        self.send_response(rejection.status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if rejection.retry_after:
+            self.send_header('Retry-After', str(rejection.retry_after))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+        if self.headers.get('Content-Length', '0') != '0' or self.headers.get('Transfer-Encoding'):
+            self.discard_body()
+
+    def discard_body(self):
+        # Drop what's left of a refused body for a moment; closing with unread data would reset
+        # the connection before a client still sending has read the response
+        if not isinstance(self.connection, socket.socket):
+            return
+        self.read_deadline = time.monotonic() + LINGER_TIMEOUT
+        try:
+            self.connection.shutdown(socket.SHUT_WR)
+            received = 0
+            while received < LINGER_BYTES:
+                chunk = self.rfile.read1(CHUNK_SIZE)
+                if not chunk:
+                    break
+                received += len(chunk)
+        except OSError:
+            pass
+
+    def read_json_body(self):
+        # None unless the body is a JSON object. parse_request has checked its size against
+        # the endpoint's limit; large bodies are parsed as they arrive rather than buffered whole.
+        content_length = int(self.headers.get('Content-Length') or 0)
+        try:
+            if content_length > STREAM_PARSE_MIN_BYTES:
+                data = parse_json_stream(self.rfile.read, content_length)
+            else:
+                data = json.loads(self.rfile.read(content_length))
+        except ValueError:
+            # Whatever is left of a malformed body would be read as the next request
+            self.close_connection = True
+            return None
+        except TimeoutError:
+            raise RequestRejected('Timed out reading the request body', 408, 'body_timeout')
+        finally:
+            self.read_deadline = None
+        return data if isinstance(data, dict) else None
+
     def do_GET(self):
         if self.path.startswith('/load-progress'):
-            parsed_url = urlparse(self.path)
-            query_params = parse_qs(parsed_url.query)
+            query_params = parse_qs(urlparse(self.path).query)
             api_key = query_params.get('apiKey', [''])[0]
 
             if api_key:
-                # Initialize API key manager
-                api_key_manager = APIKeyManager()
-                # Decrypt the API key
-                decrypted_api_key = api_key_manager.decrypt_key(api_key)
-
-                if decrypted_api_key:
-                    progress_file = f'data/{decrypted_api_key}.json'
-                    if os.path.exists(progress_file):
-                        with open(progress_file, 'r') as f:
-                            progress_data = json.load(f)
-                            self.send_response(200)
-                            self.send_header('Content-type', 'application/json')
-                            self.end_headers()
-                            self.wfile.write(json.dumps({'progress': progress_data}).encode())
-                            return
+                # Decrypt the API key (cached) and rebuild progress from snapshot + journal
+                storage_id = APIKeyManager.shared().resolve_token(api_key)
+
+                if storage_id:
+                    history_limit = query_int(query_params, 'historyLimit')
+                    if history_limit is not None:
+                        self.send_recent_progress(storage_id, max(0, history_limit))
+                    else:
+                        self.send_full_progress(storage_id)
+                    return
 
             # Return empty progress if no data found
+            self.send_json(200, {'progress': None})
+            return
+
+        if self.path.startswith('/load-history'):
+            self.handle_load_history()
+            return
+
+        if self.path.startswith('/search'):
+            self.handle_search()
+            return
+
+        if self.path.startswith(AVATAR_URL_PREFIX):
+            self.send_avatar()
+            return
+
+        if self.path == '/metrics':
+            body = metrics.render().encode()
             self.send_response(200)
-            self.send_header('Content-type', 'application/json')
+            self.send_header('Content-type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
             self.end_headers()
-            self.wfile.write(json.dumps({'progress': None}).encode())
+            self.wfile.write(body)
+            return
+
+        if self.path == '/metrics/traces':
+            self.send_json(200, {'sampleRate': trace_sampler.sample_rate, 'traces': trace_sampler.traces()})
+            return
+
+        if self.send_static_asset():
             return
 
         return super().do_GET()
 
+    def do_HEAD(self):
+        if self.path.startswith(AVATAR_URL_PREFIX):
+            self.send_avatar(head_only=True)
+            return
+        if self.send_static_asset(head_only=True):
+            return
+        return super().do_HEAD()
+
+    def send_static_asset(self, head_only=False):
+        asset = static_assets.get(urlparse(self.path).path)
+        if asset is None:
+            return False
+        encoding, body, etag = asset.select(self.accepts_encoding)
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', asset.cache_control)
+            if asset.compressed:
+                self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return True
+        self.send_response(200)
+        self.send_header('Content-type', asset.content_type)
+        if encoding != 'identity':
+            self.send_header('Content-Encoding', encoding)
+        if asset.compressed:
+            self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(asset.mtime))
+        self.send_header('Cache-Control', asset.cache_control)
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(body)
+        return True
+
+    def send_avatar(self, head_only=False):
+        # /avatar/<hash>, or ?size=80 for the nearest pre-rendered thumbnail at least that big
+        url = urlparse(self.path)
+        opened = avatar_store.open(url.path[len(AVATAR_URL_PREFIX):], query_int(parse_qs(url.query), 'size'))
+        if opened is None:
+            self.send_json(404, {'error': 'Unknown avatar'})
+            return
+        f, content_type = opened
+        with f:
+            etag = f'"{os.path.basename(f.name)}"'
+            if etag_matches(self.headers.get('If-None-Match'), etag):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', AVATAR_CACHE_CONTROL)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-type', content_type)
+            self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', AVATAR_CACHE_CONTROL)
+            self.send_header('X-Content-Type-Options', 'nosniff')
+            self.end_headers()
+            if not head_only:
+                self.copyfile(f, self.wfile)
+
+    def handle_avatar_upload(self):
+        # The body is the raw image. It is stored once under its hash and thumbnailed here, so
+        # clients only ever fetch the small versions they display.
+        content_length = int(self.headers.get('Content-Length') or 0)
+        try:
+            data = self.rfile.read(content_length)
+        except TimeoutError:
+            raise RequestRejected('Timed out reading the request body', 408, 'body_timeout')
+        finally:
+            self.read_deadline = None
+        try:
+            digest = avatar_store.put(data, MAX_AVATAR_BYTES)
+        except AvatarError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        self.send_json(200, {
+            'hash': digest,
+            'url': avatar_url(digest),
+            'thumbnails': {str(size): avatar_url(digest, size) for size in avatar_store.sizes},
+        })
+
+    def copyfile(self, source, outputfile):
+        # Files outside the asset cache go straight from the page cache to the socket
+        if hasattr(self.connection, 'sendfile') and hasattr(self.connection, 'fileno'):
+            try:
+                self.wfile.bytes += self.connection.sendfile(source)
+                return
+            except (OSError, ValueError):
+                # Nothing has been sent yet when sendfile is unusable for this file
+                if source.tell() != 0:
+                    raise
+        super().copyfile(source, outputfile)
+
+    def send_full_progress(self, storage_id):
+        # The storage version catches writes made by other processes, which can't invalidate
+        # this process's cache; it is read before loading so a racing write isn't missed
+        version = progress_store.version(storage_id)
+        cached = progress_cache.get(storage_id)
+        if cached is None or cached[3] != version:
+            generation = progress_cache.generation(storage_id)
+            progress_data = progress_store.load(storage_id)
+            if progress_data is None:
+                self.send_json(200, {'progress': None})
+                return
+            if len(progress_data.get('chatHistory') or []) > STREAM_HISTORY_TURNS:
+                # Too large to be worth caching; stream it instead of building one big buffer
+                self.send_json_stream({'progress': progress_data})
+                return
+            body = json.dumps({'progress': progress_data}).encode()
+            gzip_body = gzip.compress(body, GZIP_LEVEL) if len(body) >= GZIP_MIN_BYTES else None
+            cached = (make_etag(body), body, gzip_body, version)
+            progress_cache.put(storage_id, cached, len(body) + len(gzip_body or b''), generation)
+        self.send_cached_json(*cached[:3])
+
+    def send_recent_progress(self, storage_id, history_limit):
+        # Top-level fields plus only the latest turns; older ones come from /load-history
+        progress_data, start, total = progress_store.load_tail(storage_id, history_limit)
+        if progress_data is None:
+            self.send_json(200, {'progress': None})
+            return
+        self.send_json(200, {'progress': progress_data, 'historyStart': start, 'historyTotal': total})
+
+    def handle_load_history(self):
+        # Pages backwards through chatHistory: pass the returned nextCursor as `before`
+        query_params = parse_qs(urlparse(self.path).query)
+        storage_id = APIKeyManager.shared().resolve_token(query_params.get('apiKey', [''])[0])
+        if not storage_id:
+            self.send_json(400, {'error': 'Invalid data'})
+            return
+
+        limit = min(max(query_int(query_params, 'limit') or HISTORY_PAGE_SIZE, 1), MAX_HISTORY_PAGE_SIZE)
+        before = query_int(query_params, 'before')
+        turns, start, end, total = progress_store.history_page(
+            storage_id, None if before is None else max(before, 0), limit)
+        self.send_json(200, {
+            'turns': turns,
+            'start': start,
+            'end': end,
+            'total': total,
+            'nextCursor': start if start > 0 else None,
+        })
+
+    def handle_search(self):
+        # Best-matching chatHistory turns for `q`, ranked by BM25
+        started = time.perf_counter()
+        query_params = parse_qs(urlparse(self.path).query)
+        storage_id = APIKeyManager.shared().resolve_token(query_params.get('apiKey', [''])[0])
+        query = query_params.get('q', [''])[0].strip()
+        if not storage_id or not query:
+            self.send_json(400, {'error': 'Invalid data'})
+            return
+
+        limit = min(max(query_int(query_params, 'limit') or SEARCH_RESULT_LIMIT, 1), MAX_SEARCH_RESULT_LIMIT)
+        results, total = search_indexes.search(storage_id, query, progress_store, limit)
+        self.send_json(200, {
+            'results': results,
+            'total': total,
+            'tookMs': round((time.perf_counter() - started) * 1000, 3),
+        })
+
     def do_POST(self):
         if self.path == '/save-progress':
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data)
+            data = self.read_json_body() or {}
 
             api_key = data.get('apiKey')
             progress = data.get('progress')
 
-            if api_key and progress:
-                # Initialize API key manager
-                api_key_manager = APIKeyManager()
+            if api_key and isinstance(progress, dict) and progress:
+                # Progress is stored under a hash of the key, never the raw key
+                storage_id = APIKeyManager.shared().storage_id_for_key(api_key)
+
+                if storage_id:
+                    # An inline base64 picture is stored once as a file and replaced by its URL
+                    avatar_store.externalize(progress)
+                    # Invalidate on both sides of the write so a concurrent load can't cache the old document
+                    progress_cache.invalidate(storage_id)
+                    progress_store.save(storage_id, progress)
+                    progress_cache.invalidate(storage_id)
+                    self.send_json(200, {'status': 'success'})
+                    return
+
+            self.send_json(400, {'error': 'Invalid data'})
+            return
+
+        if self.path == '/append-progress':
+            # Delta save: only the new chatHistory turns plus changed top-level fields
+            data = self.read_json_body() or {}
 
-                # Encrypt the API key before saving
-                encrypted_api_key = api_key_manager.encrypt_key(api_key)
+            api_key = data.get('apiKey')
+            turns = data.get('turns') or []
+            fields = data.get('fields') or {}
 
-                if encrypted_api_key:
-                    os.makedirs('data', exist_ok=True)
-                    progress_file = f'data/{api_key}.json'  # Save with original key for now
-                    with open(progress_file, 'w') as f:
-                        json.dump(progress, f)
+            valid = (isinstance(turns, list) and isinstance(fields, dict)
+                     and 'chatHistory' not in fields and JOURNAL_SEQ_FIELD not in fields)
+            if api_key and valid and (turns or fields):
+                storage_id = APIKeyManager.shared().storage_id_for_key(api_key)
 
-                    self.send_response(200)
-                    self.send_header('Content-type', 'application/json')
-                    self.end_headers()
-                    self.wfile.write(json.dumps({'status': 'success'}).encode())
+                if storage_id:
+                    avatar_store.externalize(fields)
+                    progress_cache.invalidate(storage_id)
+                    seq = progress_store.append(storage_id, turns, fields)
+                    progress_cache.invalidate(storage_id)
+                    self.send_json(200, {'status': 'success', 'seq': seq})
                     return
 
-            self.send_response(400)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({'error': 'Invalid data'}).encode())
+            self.send_json(400, {'error': 'Invalid data'})
+            return
+
+        if self.path == '/build-context':
+            # System prompt, rolling summary and the recent turns that fit in `budget` tokens
+            data = self.read_json_body() or {}
+
+            api_key = data.get('apiKey')
+            budget = data.get('budget', DEFAULT_TOKEN_BUDGET)
+            system_prompt = data.get('systemPrompt')
+
+            valid = (isinstance(budget, int) and budget > 0
+                     and (system_prompt is None or isinstance(system_prompt, str)))
+            if api_key and valid:
+                storage_id = APIKeyManager.shared().storage_id_for_key(api_key)
+                progress_data = progress_store.load(storage_id) if storage_id else None
+                if progress_data is None:
+                    progress_data = {}
+                self.send_json(200, context_builder.build(storage_id, progress_data, budget, system_prompt))
+                return
+
+            self.send_json(400, {'error': 'Invalid data'})
+            return
+
+        if self.path == '/chat':
+            self.handle_chat()
             return
 
-        return super().do_POST()
+        if self.path == '/avatar':
+            self.handle_avatar_upload()
+            return
+
+        # SimpleHTTPRequestHandler has no do_POST; answer instead of dropping the connection
+        self.send_error(501, 'Unsupported method (POST)')
+
+    def handle_chat(self):
+        # One model reply streamed as Server-Sent Events: `data: {"text": ...}` per chunk, then
+        # `event: done`. Without `messages` the context is built from the user's stored progress.
+        data = self.read_json_body() or {}
+
+        api_key = data.get('apiKey')
+        provider = data.get('provider', 'gemini')
+        message = data.get('message')
+        messages = data.get('messages')
+        system_prompt = data.get('systemPrompt')
+        config = data.get('config') or {}
+        budget = data.get('budget', DEFAULT_TOKEN_BUDGET)
+        personality = data.get('personality')
+
+        valid = (provider in llm_proxy.providers and isinstance(config, dict)
+                 and (message is None or isinstance(message, str))
+                 and (messages is None or isinstance(messages, list))
+                 and (system_prompt is None or isinstance(system_prompt, str))
+                 and isinstance(budget, int) and budget > 0)
+        if not (api_key or provider == 'stub') or not valid or not (message or messages):
+            self.send_json(400, {'error': 'Invalid data'})
+            return
+
+        if messages is None:
+            storage_id = APIKeyManager.shared().storage_id_for_key(api_key) if api_key else None
+            progress_data = (progress_store.load(storage_id) if storage_id else None) or {}
+            context = context_builder.build(storage_id, progress_data, budget, system_prompt)
+            system_prompt = context['systemPrompt']
+            if context['summary']:
+                system_prompt += '\n\nEarlier in this conversation:\n' + context['summary']
+            messages = context['turns'] + [{'role': 'user', 'text': message}]
+            personality = personality or progress_data.get('personality')
+
+        model = data.get('model') or DEFAULT_MODELS[provider]
+        cache_key = None
+        cached = None
+        if response_cache.enabled_for(personality):
+            cache_key = response_cache.key(provider, model, config, system_prompt, messages)
+            cached = response_cache.get(cache_key)
+        if cached is not None:
+            chunks = iter([cached])
+        else:
+            # xAI and Groq keys differ from the Gemini key that identifies the user
+            chunks = llm_proxy.stream(provider, data.get('providerKey') or api_key, messages, system_prompt,
+                                      model, config, bool(data.get('hedge')))
+        # Wait for the first chunk so a failed call still gets a proper status code
+        try:
+            with chat_first_token.time((provider, str(cached is not None).lower())):
+                first = next(chunks, None)
+        except ProviderError as e:
+            self.send_json(e.status, {'error': str(e)})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        if self.request_version == 'HTTP/1.1':
+            self.send_header('Transfer-Encoding', 'chunked')
+            writer = ChunkedWriter(self.wfile)
+        else:
+            self.close_connection = True
+            writer = self.wfile
+        self.end_headers()
+        reply = []
+        try:
+            if first is not None:
+                reply.append(first)
+                write_sse(writer, {'text': first})
+                for text in chunks:
+                    reply.append(text)
+                    write_sse(writer, {'text': text})
+            if cache_key is not None and cached is None:
+                response_cache.put(cache_key, ''.join(reply))
+            write_sse(writer, {'provider': provider, 'cached': cached is not None}, 'done')
+        except ProviderError as e:
+            write_sse(writer, {'error': str(e), 'status': e.status}, 'error')
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+        if writer is not self.wfile:
+            writer.close()
 
     def end_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
@@ -127,11 +853,685 @@ class ProgressHandler(http.server.SimpleHTTPRequestHandler):
 
     def do_OPTIONS(self):
         self.send_response(200)
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
-if __name__ == '__main__':
+def endpoint_label(path):
+    route = urlparse(path).path
+    if route.startswith(AVATAR_URL_PREFIX):
+        return '/avatar'
+    return route if route in METRIC_ENDPOINTS else 'static'
+
+def body_limit(path):
+    route = urlparse(path).path
+    if route == '/save-progress':
+        return max_body_bytes
+    return MAX_AVATAR_BYTES if route == '/avatar' else max_request_bytes
+
+def admit_request(client_address, path, content_length, transfer_encoding=None):
+    # Check a request's declared body size, then admit it. Returns a ticket for
+    # admission.release() once the request is done, or raises RequestRejected.
+    if transfer_encoding:
+        raise RequestRejected('Request bodies need a Content-Length', 411, 'length_required')
+    try:
+        length = int(content_length or 0)
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise RequestRejected('Invalid Content-Length', 400, 'bad_length')
+    limit = body_limit(path)
+    if length > limit:
+        raise RequestRejected(f'Request body is larger than {limit} bytes', 413, 'body_too_large')
+    client = client_address[0] if client_address else ''
+    return admission.admit(client, length, endpoint_label(path) not in UNLIMITED_ENDPOINTS)
+
+def rejection_response(rejection):
+    # Raw HTTP response for a request the event loop refuses before it reaches a handler
+    body = json.dumps({'error': str(rejection)}).encode()
+    lines = [f'HTTP/1.1 {rejection.status} {http.HTTPStatus(rejection.status).phrase}',
+             'Content-type: application/json', f'Content-Length: {len(body)}',
+             'Access-Control-Allow-Origin: *', 'Connection: close']
+    if rejection.retry_after:
+        lines.append(f'Retry-After: {rejection.retry_after}')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode() + body
+
+class DeadlineReader(io.RawIOBase):
+    # Socket reads limited by the handler's read_deadline as a whole rather than per recv(),
+    # so a client trickling a byte at a time can't hold a worker thread indefinitely
+    def __init__(self, sock, handler):
+        self.sock = sock
+        self.handler = handler
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        timeout = self.handler.timeout
+        deadline = self.handler.read_deadline
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError('request read deadline passed')
+            timeout = min(timeout, remaining)
+        self.sock.settimeout(timeout)
+        return self.sock.recv_into(buffer)
+
+class CountingWriter:
+    # Wraps the handler's wfile to count bytes sent on the connection
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+        return self.raw.write(data)
+
+    def flush(self):
+        self.raw.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+def query_int(query_params, name):
+    try:
+        return int(query_params[name][0])
+    except (KeyError, IndexError, ValueError):
+        return None
+
+class ChunkedWriter:
+    # HTTP/1.1 chunked transfer encoding, optionally gzip-compressed, with small writes batched
+    def __init__(self, wfile, use_gzip=False, chunk_size=CHUNK_SIZE):
+        self.wfile = wfile
+        self.chunk_size = chunk_size
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31) if use_gzip else None
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        data = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self._send_chunk(data)
+
+    def _send_chunk(self, data):
+        if data:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+
+    def flush(self):
+        # Push out whatever is buffered now, e.g. after each streamed event
+        if self._buffered:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        if self._compressor is not None:
+            self._send_chunk(self._compressor.flush())
+        self.wfile.write(b'0\r\n\r\n')
+
+def write_sse(writer, payload, event=None):
+    lines = f'event: {event}\n' if event else ''
+    writer.write((lines + f'data: {json.dumps(payload)}\n\n').encode())
+    writer.flush()
+
+def make_etag(body):
+    return '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(',')]
+    # Weak comparison is fine for a conditional GET
+    return '*' in candidates or etag in candidates or f'W/{etag}' in candidates
+
+class SingleThreadedServer(socketserver.TCPServer):
+    # The original one-connection-at-a-time server, kept for debugging
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class, reuse_port=False):
+        # Keep-alive would let one idle client block everyone else in this mode
+        handler_class = type(handler_class.__name__, (handler_class,), {'protocol_version': 'HTTP/1.0'})
+        self.allow_reuse_port = reuse_port
+        super().__init__(server_address, handler_class)
+
+    def drain(self, timeout):
+        # Requests are handled on the serving thread, so none can be in progress here
+        return True
+
+class ThreadPoolServer(socketserver.TCPServer):
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, max_workers=DEFAULT_WORKERS, reuse_port=False):
+        self.allow_reuse_port = reuse_port
+        super().__init__(server_address, handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='progress-worker')
+        # Bound accepted-but-unserved connections; beyond this the accept loop blocks and
+        # new clients wait in the kernel backlog instead of piling up in memory
+        self._capacity = max_workers * 2
+        self._slots = threading.BoundedSemaphore(self._capacity)
+        # Keep-alive connections waiting for their next request, closed first when draining
+        self._idle = set()
+        self._idle_lock = threading.Lock()
+        self.draining = False
+
+    def connection_idle(self, connection):
+        # False once draining has started: the handler should close instead of waiting
+        with self._idle_lock:
+            if self.draining:
+                return False
+            self._idle.add(connection)
+            return True
+
+    def connection_busy(self, connection):
+        with self._idle_lock:
+            self._idle.discard(connection)
+
+    def drain(self, timeout):
+        # Stop taking requests, close idle keep-alive connections and wait up to `timeout`
+        # seconds for the requests in progress. False if some were still running.
+        self.socket.close()
+        with self._idle_lock:
+            self.draining = True
+            idle = list(self._idle)
+        for connection in idle:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        deadline = time.monotonic() + timeout
+        acquired = 0
+        while acquired < self._capacity and self._slots.acquire(timeout=max(0, deadline - time.monotonic())):
+            acquired += 1
+        return acquired == self._capacity
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        try:
+            self.executor.submit(self._process_request_worker, request, client_address)
+        except RuntimeError:
+            # Executor already shut down
+            self._slots.release()
+            self.shutdown_request(request)
+
+    def _process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+class _StreamingConnection:
+    # Socket stand-in that lets a BaseHTTPRequestHandler run in a worker thread against bytes
+    # already read by the event loop. Each write is handed to the loop as it is made, so /chat
+    # events and chunked histories reach the client as they are produced; once
+    # STREAM_HIGH_WATER bytes are queued the handler waits for the client to take them.
+    def __init__(self, raw_request, loop, writer):
+        self.raw_request = raw_request
+        self.loop = loop
+        self.writer = writer
+        self.written = 0
+        self._queued = 0
+
+    def makefile(self, mode, buffering=-1):
+        if 'r' in mode:
+            return io.BytesIO(self.raw_request)
+        raise ValueError('write side is unbuffered')
+
+    def sendall(self, data):
+        if self.writer.transport.is_closing():
+            raise BrokenPipeError('client disconnected')
+        data = bytes(data)
+        self.loop.call_soon_threadsafe(self.writer.write, data)
+        self.written += len(data)
+        self._queued += len(data)
+        if self._queued >= STREAM_HIGH_WATER:
+            self._queued = 0
+            drained = asyncio.run_coroutine_threadsafe(self.writer.drain(), self.loop)
+            try:
+                drained.result(KEEPALIVE_TIMEOUT)
+            except TimeoutError:
+                drained.cancel()
+                raise
+
+    def settimeout(self, timeout):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+class AsyncioServer:
+    # Connections, keep-alive and slow uploads are handled by the event loop; only complete
+    # requests are handed to a worker thread, so a slow client never pins a thread
+    admits_requests = True  # admission control runs in the event loop, not the handler
+    def __init__(self, server_address, handler_class, max_workers=DEFAULT_WORKERS, reuse_port=False):
+        self.server_address = server_address
+        self.RequestHandlerClass = handler_class
+        self.reuse_port = reuse_port
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='progress-worker')
+        self._loop = None
+        self._server = None
+        self._stopped = None
+        self._connections = set()
+        # Connection tasks waiting for their next request
+        self._idle = set()
+        self.draining = False
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    def shutdown(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+
+    def drain(self, timeout):
+        # _serve drains before it returns
+        return True
+
+    def server_close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        # SIGTERM and Ctrl+C stop the loop gracefully instead of unwinding it from the signal handler
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            try:
+                self._loop.add_signal_handler(signum, self._stopped.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        host, port = self.server_address
+        self._server = await asyncio.start_server(self._handle_connection, host or None, port,
+                                                  limit=MAX_HEADER_BYTES, reuse_address=True,
+                                                  reuse_port=self.reuse_port or None)
+        async with self._server:
+            await self._stopped.wait()
+            # Stop accepting, drop idle keep-alive connections and give requests in progress
+            # SHUTDOWN_GRACE seconds to finish
+            self._server.close()
+            self.draining = True
+            for task in list(self._idle):
+                task.cancel()
+            if self._connections:
+                await asyncio.wait(list(self._connections), timeout=SHUTDOWN_GRACE)
+            for task in list(self._connections):
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+
+    async def _handle_connection(self, reader, writer):
+        client_address = writer.get_extra_info('peername')
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while not self.draining:
+                self._idle.add(task)
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEPALIVE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                        asyncio.TimeoutError, ConnectionError):
+                    break
+                finally:
+                    self._idle.discard(task)
+
+                path, version, headers = _parse_request_head(head)
+                # Oversized, over-limit and rate-limited requests are refused before their body is read
+                try:
+                    ticket = admit_request(client_address, path, headers.get('content-length'),
+                                           headers.get('transfer-encoding'))
+                except RequestRejected as e:
+                    http_rejected.inc((endpoint_label(path), e.reason))
+                    writer.write(rejection_response(e))
+                    await writer.drain()
+                    await _discard_body(reader, writer)
+                    break
+                try:
+                    content_length = int(headers.get('content-length') or 0)
+                    body = b''
+                    if headers.get('expect', '').lower() == '100-continue':
+                        # The request passed the checks above, so ask for the body now rather
+                        # than leave the client waiting out its expect timeout. The handler
+                        # must not answer the Expect again once the body is here.
+                        if version == 'HTTP/1.1' and content_length > 0:
+                            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+                            await writer.drain()
+                        head = _remove_header(head, b'expect')
+                    if content_length > 0:
+                        try:
+                            body = await asyncio.wait_for(reader.readexactly(content_length),
+                                                          BODY_TIMEOUT + content_length / MIN_UPLOAD_RATE)
+                        except asyncio.TimeoutError:
+                            e = RequestRejected('Timed out reading the request body', 408, 'body_timeout')
+                            http_rejected.inc((endpoint_label(path), e.reason))
+                            writer.write(rejection_response(e))
+                            await writer.drain()
+                            await _discard_body(reader, writer)
+                            break
+                        except (asyncio.IncompleteReadError, ConnectionError):
+                            break
+
+                    # The handler writes its response onto the connection as it goes
+                    broken = await self._loop.run_in_executor(
+                        self.executor, self._dispatch, head + body, client_address, writer)
+                finally:
+                    admission.release(ticket)
+                await writer.drain()
+                if broken:
+                    break
+
+                connection = headers.get('connection', '').lower()
+                if connection == 'close' or (version == 'HTTP/1.0' and connection != 'keep-alive'):
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    def _dispatch(self, raw_request, client_address, writer):
+        # True if the connection can't carry another request: the handler failed part way
+        # through its response, or the client went away
+        connection = _StreamingConnection(raw_request, self._loop, writer)
+        try:
+            self.RequestHandlerClass(connection, client_address, self)
+        except Exception:
+            if connection.written:
+                return True
+            try:
+                connection.sendall(b'HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\n\r\n')
+            except (OSError, RuntimeError):
+                return True
+        return False
+
+async def _discard_body(reader, writer):
+    # Event-loop counterpart of ProgressHandler.discard_body
+    async def drain():
+        received = 0
+        while received < LINGER_BYTES:
+            chunk = await reader.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            received += len(chunk)
+    try:
+        if writer.can_write_eof():
+            writer.write_eof()
+        await asyncio.wait_for(drain(), LINGER_TIMEOUT)
+    except (asyncio.TimeoutError, OSError):
+        pass
+
+def _remove_header(head, name):
+    # `name` in lower case; the request line and every other header are kept as sent
+    lines = head.split(b'\r\n')
+    kept = [line for line in lines[1:] if line.partition(b':')[0].strip().lower() != name]
+    return b'\r\n'.join(lines[:1] + kept)
+
+def _parse_request_head(head):
+    lines = head.decode('iso-8859-1').split('\r\n')
+    parts = lines[0].split()
+    path = parts[1] if len(parts) > 1 else ''
+    version = parts[2] if len(parts) == 3 else 'HTTP/1.0'
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return path, version, headers
+
+def build_server(mode, server_address, workers=DEFAULT_WORKERS, handler_class=ProgressHandler,
+                 reuse_port=False):
+    # reuse_port lets several processes bind the same port; the kernel spreads connections
+    if mode == 'single':
+        return SingleThreadedServer(server_address, handler_class, reuse_port)
+    if mode == 'threaded':
+        return ThreadPoolServer(server_address, handler_class, max_workers=workers, reuse_port=reuse_port)
+    if mode == 'asyncio':
+        return AsyncioServer(server_address, handler_class, max_workers=workers, reuse_port=reuse_port)
+    raise ValueError(f'Unknown server mode: {mode}')
+
+HASHED_ID_PATTERN = re.compile(r'^[0-9a-f]{16}$')
+
+def import_json_progress(store, data_dir='data'):
+    # Copy every data/*.json document (snapshot plus journal) into another backend.
+    # Files named after a raw API key are imported under its hashed id. Sources are left in place.
+    source = FileProgressStore(data_dir)
+    key_manager = APIKeyManager.shared()
+    imported = 0
+    for path in sorted(glob.glob(os.path.join(data_dir, '*.json'))):
+        name = os.path.basename(path)[:-len('.json')]
+        storage_id = name if HASHED_ID_PATTERN.match(name) else key_manager.hash_user_id(name)
+        try:
+            progress = source.load(name)
+        except ValueError as e:
+            print(f'Skipping {path}: {e}')
+            continue
+        if isinstance(progress, dict):
+            store.save(storage_id, progress)
+            imported += 1
+    return imported
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Progress server for the AI companion app')
+    parser.add_argument('--mode', choices=SERVER_MODES,
+                        default=os.environ.get('PROGRESS_SERVER_MODE', 'threaded'),
+                        help='concurrency mode (env: PROGRESS_SERVER_MODE)')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PROGRESS_SERVER_PORT', PORT)),
+                        help='port to listen on (env: PROGRESS_SERVER_PORT)')
+    parser.add_argument('--processes', type=int,
+                        default=int(os.environ.get('PROGRESS_SERVER_PROCESSES', 1)),
+                        help='server processes sharing the port, 0 for one per CPU core; more than one '
+                             'needs fork() and SO_REUSEPORT (env: PROGRESS_SERVER_PROCESSES)')
+    parser.add_argument('--workers', type=int,
+                        default=int(os.environ.get('PROGRESS_SERVER_WORKERS', DEFAULT_WORKERS)),
+                        help='worker threads for threaded/asyncio modes (env: PROGRESS_SERVER_WORKERS)')
+    parser.add_argument('--storage', choices=STORAGE_BACKENDS,
+                        default=os.environ.get('PROGRESS_STORAGE', 'files'),
+                        help='progress storage backend (env: PROGRESS_STORAGE)')
+    parser.add_argument('--write-behind-ms', type=int,
+                        default=int(os.environ.get('PROGRESS_WRITE_BEHIND_MS', WRITE_BEHIND_WINDOW * 1000)),
+                        help='coalescing window for /save-progress writes, 0 writes synchronously '
+                             '(env: PROGRESS_WRITE_BEHIND_MS)')
+    parser.add_argument('--cache-mb', type=int,
+                        default=int(os.environ.get('PROGRESS_CACHE_MB', PROGRESS_CACHE_MB)),
+                        help='memory for cached /load-progress responses, 0 disables (env: PROGRESS_CACHE_MB)')
+    parser.add_argument('--hedge-ms', type=int,
+                        default=int(os.environ.get('CHAT_HEDGE_MS', HEDGE_AFTER * 1000)),
+                        help='start a backup /chat request when a hedged one has sent no token for this '
+                             'long (env: CHAT_HEDGE_MS)')
+    parser.add_argument('--response-cache-size', type=int,
+                        default=int(os.environ.get('RESPONSE_CACHE_SIZE', RESPONSE_CACHE_SIZE)),
+                        help='finished /chat replies kept for repeated prompts, 0 disables '
+                             '(env: RESPONSE_CACHE_SIZE)')
+    parser.add_argument('--response-cache-ttl', type=int,
+                        default=int(os.environ.get('RESPONSE_CACHE_TTL', RESPONSE_CACHE_TTL)),
+                        help='seconds a cached reply stays valid (env: RESPONSE_CACHE_TTL)')
+    parser.add_argument('--uncached-personalities',
+                        default=os.environ.get('RESPONSE_CACHE_SKIP', ''),
+                        help='comma-separated personalities whose replies are never cached '
+                             '(env: RESPONSE_CACHE_SKIP)')
+    parser.add_argument('--trace-sample-rate', type=float,
+                        default=float(os.environ.get('TRACE_SAMPLE_RATE', TRACE_SAMPLE_RATE)),
+                        help='fraction of requests whose span timings are kept for /metrics/traces '
+                             '(env: TRACE_SAMPLE_RATE)')
+    parser.add_argument('--max-body-mb', type=int,
+                        default=int(os.environ.get('PROGRESS_MAX_BODY_MB', MAX_BODY_MB)),
+                        help='largest /save-progress body; bigger ones get 413 (env: PROGRESS_MAX_BODY_MB)')
+    parser.add_argument('--max-request-kb', type=int,
+                        default=int(os.environ.get('PROGRESS_MAX_REQUEST_KB', MAX_REQUEST_KB)),
+                        help='largest body for every other endpoint (env: PROGRESS_MAX_REQUEST_KB)')
+    parser.add_argument('--upload-memory-mb', type=int,
+                        default=int(os.environ.get('PROGRESS_UPLOAD_MEMORY_MB', BODY_MEMORY_MB)),
+                        help='request body bytes a process reads at once before answering 503 '
+                             '(env: PROGRESS_UPLOAD_MEMORY_MB)')
+    parser.add_argument('--max-concurrent', type=int,
+                        default=int(os.environ.get('PROGRESS_MAX_CONCURRENT', MAX_CONCURRENT_REQUESTS)),
+                        help='API requests a process handles at once before answering 503 '
+                             '(env: PROGRESS_MAX_CONCURRENT)')
+    parser.add_argument('--client-concurrency', type=int,
+                        default=int(os.environ.get('PROGRESS_CLIENT_CONCURRENCY', MAX_CLIENT_REQUESTS)),
+                        help='API requests one client address may have in progress before getting 429 '
+                             '(env: PROGRESS_CLIENT_CONCURRENCY)')
+    parser.add_argument('--client-rate', type=float,
+                        default=float(os.environ.get('PROGRESS_CLIENT_RATE', CLIENT_RATE)),
+                        help='sustained API requests per second per client address, 0 disables '
+                             '(env: PROGRESS_CLIENT_RATE)')
+    parser.add_argument('--client-burst', type=int,
+                        default=int(os.environ.get('PROGRESS_CLIENT_BURST', CLIENT_BURST)),
+                        help='requests a client may make at once above --client-rate (env: PROGRESS_CLIENT_BURST)')
+    parser.add_argument('--import-json', action='store_true',
+                        help='import data/*.json into the selected storage backend and exit')
+    return parser.parse_args(argv)
+
+def serve(args, reuse_port=False):
+    global progress_store, progress_cache, llm_proxy, response_cache
+    global admission, max_body_bytes, max_request_bytes
+    progress_store = InstrumentedStore(open_store(args.storage, write_behind=args.write_behind_ms / 1000),
+                                       storage_latency)
+    progress_cache = ByteLRUCache(args.cache_mb * 1024 * 1024)
+    static_assets.preload()
+    trace_sampler.sample_rate = args.trace_sample_rate
+    llm_proxy = LLMProxy(hedge_after=args.hedge_ms / 1000)
+    response_cache = ResponseCache(args.response_cache_size, args.response_cache_ttl,
+                                   uncached_personalities=[name.strip() for name in args.uncached_personalities.split(',')
+                                                           if name.strip()])
+    max_body_bytes = args.max_body_mb * 1024 * 1024
+    max_request_bytes = args.max_request_kb * 1024
+    admission = AdmissionController(args.max_concurrent, args.client_concurrency, args.client_rate,
+                                    args.client_burst, args.upload_memory_mb * 1024 * 1024)
+    httpd = build_server(args.mode, ('', args.port), args.workers, reuse_port=reuse_port)
+    # Treat SIGTERM like Ctrl+C so buffered saves are drained before exit
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if not reuse_port:
+        print(f'Server running on port {args.port} ({args.mode} mode, {args.storage} storage)')
+    try:
+        httpd.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        # A second signal shouldn't cut the drain short
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        httpd.drain(SHUTDOWN_GRACE)
+        httpd.server_close()
+        llm_proxy.close()
+        progress_store.close()
+
+def run_prefork(args, processes):
+    # Supervisor for `processes` forked workers. Each binds the port itself with SO_REUSEPORT,
+    # so the kernel spreads connections across them and no request passes through here.
+    # Workers that die are restarted; SIGTERM or Ctrl+C stops them all gracefully.
+    if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+        sys.exit('--processes needs fork() and SO_REUSEPORT (Linux, macOS, BSD)')
+    if args.write_behind_ms:
+        # A save still held in one process's memory would be invisible to the others, and an
+        # append handled elsewhere meanwhile would be overwritten when it landed
+        print('Write-behind saves are disabled when running several processes')
+        args.write_behind_ms = 0
+    # Create the encryption key and the storage schema before workers can race to
+    APIKeyManager.shared()
+    open_store(args.storage).close()
+
+    workers = {}  # pid -> start time
+    stop_signals = {signal.SIGTERM, signal.SIGINT}
+
+    def start_worker():
+        # Signals stay blocked across fork so a worker can't start unrecorded
+        signal.pthread_sigmask(signal.SIG_BLOCK, stop_signals)
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, stop_signals)
+                serve(args, reuse_port=True)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        workers[pid] = time.monotonic()
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, stop_signals)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for _ in range(processes):
+            start_worker()
+        print(f'Server running on port {args.port} ({processes} processes, {args.mode} mode, '
+              f'{args.storage} storage)')
+        while True:
+            pid, status = os.wait()
+            started = workers.pop(pid, None)
+            if started is None:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            print(f'Worker {pid} exited with ' + (f'signal {-code}' if code < 0 else f'code {code}')
+                  + ', restarting')
+            if time.monotonic() - started < MIN_WORKER_UPTIME:
+                time.sleep(WORKER_RESTART_DELAY)
+            start_worker()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        stop_workers(workers)
+
+def stop_workers(workers, timeout=WORKER_STOP_TIMEOUT):
+    # SIGTERM every worker, wait for them to drain and exit, and kill whatever is left
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    deadline = time.monotonic() + timeout
+    while workers and time.monotonic() < deadline:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            time.sleep(0.05)
+        else:
+            workers.pop(pid, None)
+    for pid in workers:
+        print(f'Worker {pid} did not stop in time, killing it')
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+
+def main(argv=None):
+    global progress_store
+    args = parse_args(argv)
     os.makedirs('data', exist_ok=True)
-    server_address = ('', PORT)
-    httpd = socketserver.TCPServer(server_address, ProgressHandler)
-    print(f'Server running on port {PORT}')
-    httpd.serve_forever()
\ No newline at end of file
+
+    if args.import_json:
+        progress_store = InstrumentedStore(open_store(args.storage, write_behind=args.write_behind_ms / 1000),
+                                           storage_latency)
+        imported = import_json_progress(progress_store)
+        print(f'Imported {imported} progress files into {args.storage} storage')
+        progress_store.close()
+        return
+
+    processes = args.processes or os.cpu_count() or 1
+    if processes > 1:
+        run_prefork(args, processes)
+    else:
+        serve(args)
+
+if __name__ == '__main__':
+    main()
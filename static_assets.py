@@ -0,0 +1,110 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # brotli is optional; gzip is always available
+
+# Files every page load asks for; they are read and compressed once at startup
+PRELOAD_ASSETS = (
+    'index.html',
+    'info.html',
+    'app.js',
+    'styles.css',
+    'images/sweet_neutral.png',
+    'images/sweet_neutral.svg',
+)
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+MIN_COMPRESS_BYTES = 512
+REVALIDATE_INTERVAL = 1.0  # seconds between stat() checks for edited files
+HTML_CACHE_CONTROL = 'no-cache'
+ASSET_CACHE_CONTROL = 'public, max-age=300'
+# Each Content-Encoding is its own representation and gets its own strong ETag
+ETAG_ENCODING_SUFFIXES = {'gzip': '-gz', 'br': '-br'}
+
+def encoding_etag(etag, encoding):
+    # '"abc"' -> '"abc-gz"' for a gzip body; identity keeps the plain tag
+    suffix = ETAG_ENCODING_SUFFIXES.get(encoding)
+    return etag[:-1] + suffix + '"' if suffix else etag
+
+class StaticAsset:
+    def __init__(self, name, body, mtime, size):
+        self.name = name
+        self.mtime = mtime
+        self.size = size
+        self.checked = time.monotonic()
+        self.content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self.etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        self.cache_control = HTML_CACHE_CONTROL if self.content_type == 'text/html' else ASSET_CACHE_CONTROL
+        # Content-Encoding -> bytes, in order of preference
+        self.bodies = {}
+        if len(body) >= MIN_COMPRESS_BYTES and self.content_type.startswith(COMPRESSIBLE_TYPES):
+            if brotli is not None:
+                self.bodies['br'] = brotli.compress(body)
+            self.bodies['gzip'] = gzip.compress(body, 9)
+        self.bodies['identity'] = body
+        self.etags = {encoding: encoding_etag(self.etag, encoding) for encoding in self.bodies}
+
+    @property
+    def compressed(self):
+        return len(self.bodies) > 1
+
+    def select(self, accepts_encoding):
+        # (encoding, body, ETag) for the smallest body the client accepts; identity always is
+        for encoding, body in self.bodies.items():
+            if encoding == 'identity' or accepts_encoding(encoding):
+                return encoding, body, self.etags[encoding]
+
+class StaticAssetCache:
+    # Serves the known front-end files from memory with precomputed ETags and compressed variants
+    def __init__(self, root=None, names=PRELOAD_ASSETS):
+        self.root = root  # None serves from the working directory, like SimpleHTTPRequestHandler
+        self.names = set(names)
+        self._assets = {}
+        self._lock = threading.Lock()
+
+    def preload(self):
+        for name in sorted(self.names):
+            self._load(name)
+        return len(self._assets)
+
+    def get(self, url_path):
+        name = url_path.lstrip('/') or 'index.html'
+        if name not in self.names:
+            return None
+        asset = self._assets.get(name)
+        if asset is None or time.monotonic() - asset.checked > REVALIDATE_INTERVAL:
+            asset = self._revalidate(name, asset)
+        return asset
+
+    def _path(self, name):
+        return os.path.join(self.root or os.getcwd(), name)
+
+    def _revalidate(self, name, asset):
+        try:
+            st = os.stat(self._path(name))
+        except OSError:
+            with self._lock:
+                self._assets.pop(name, None)
+            return None
+        if asset is not None and (st.st_mtime, st.st_size) == (asset.mtime, asset.size):
+            asset.checked = time.monotonic()
+            return asset
+        return self._load(name)
+
+    def _load(self, name):
+        try:
+            with open(self._path(name), 'rb') as f:
+                st = os.fstat(f.fileno())
+                body = f.read()
+        except OSError:
+            return None
+        asset = StaticAsset(name, body, st.st_mtime, st.st_size)
+        with self._lock:
+            self._assets[name] = asset
+        return asset
@@ -0,0 +1,60 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image
+
+from avatar_store import (IMPORT_MAX_SIDE, MAX_AVATAR_BYTES, THUMBNAIL_SIZES, AvatarError, AvatarStore,
+                          fit_for_import)
+
+def png(width, height, noise=False):
+    # Noise doesn't compress, so a few megapixels of it are enough to pass the byte cap
+    data = os.urandom(width * height * 3) if noise else bytes(width * height * 3)
+    out = io.BytesIO()
+    Image.frombytes('RGB', (width, height), data).save(out, 'PNG', compress_level=1)
+    return out.getvalue()
+
+class AvatarStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.store = AvatarStore(self.dir)
+
+    def test_put_stores_original_and_thumbnails_once(self):
+        data = png(300, 200)
+        digest = self.store.put(data)
+        self.assertEqual(self.store.put(data), digest)
+        with open(self.store.path(digest), 'rb') as f:
+            self.assertEqual(f.read(), data)
+        for size in THUMBNAIL_SIZES:
+            with Image.open(self.store.path(digest, size)) as thumbnail:
+                self.assertEqual(thumbnail.size, (size, size))
+
+    def test_byte_cap_applies_only_when_asked(self):
+        data = png(1800, 1600, noise=True)
+        self.assertGreater(len(data), MAX_AVATAR_BYTES)
+        with self.assertRaises(AvatarError):
+            self.store.put(data, MAX_AVATAR_BYTES)
+        self.assertTrue(self.store.exists(self.store.put(data)))
+
+    def test_large_local_pictures_are_downscaled_instead_of_refused(self):
+        data = png(1800, 1600, noise=True)
+        fitted = fit_for_import(data)
+        self.assertLessEqual(len(fitted), MAX_AVATAR_BYTES)
+        with Image.open(io.BytesIO(fitted)) as image:
+            self.assertEqual(image.size, (IMPORT_MAX_SIDE, IMPORT_MAX_SIDE * 1600 // 1800))
+        digest = self.store.put(fitted, MAX_AVATAR_BYTES)
+        self.assertIsNotNone(self.store.thumbnail_path(digest, 30))
+
+    def test_pictures_within_the_limits_are_imported_unchanged(self):
+        data = png(300, 200)
+        self.assertIs(fit_for_import(data), data)
+
+    def test_unreadable_import_is_refused(self):
+        with self.assertRaises(AvatarError):
+            fit_for_import(b'\x89PNG\r\n\x1a\n' + b'\0' * 100)
+
+if __name__ == '__main__':
+    unittest.main()
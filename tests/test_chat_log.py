@@ -0,0 +1,153 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from chat_log import COMPACT_MIN_DEAD, INDEX_HEADER_BYTES, OFFSET_BYTES, ChatLog, read_snapshot
+
+def conversation(i, reply=None):
+    entry = {'timestamp': '2024-01-01 00:00:00', 'user_message': f'message {i}'}
+    if reply is not None:
+        entry['bot_response'] = reply
+    return entry
+
+class ChatLogTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.path = os.path.join(self.dir, 'chat_history.jsonl')
+        self.legacy_path = os.path.join(self.dir, 'chat_history.json')
+        self.log = self.open_log()
+
+    def open_log(self):
+        log = ChatLog(self.path, self.legacy_path)
+        self.addCleanup(log.close)
+        return log
+
+    def reopen(self):
+        self.log.close()
+        self.log = self.open_log()
+
+    def line_count(self):
+        with open(self.path, 'rb') as f:
+            return sum(1 for _ in f)
+
+    def test_append_update_and_read(self):
+        for i in range(5):
+            self.assertEqual(self.log.append(conversation(i)), i)
+        self.log.update(3, conversation(3, 'reply'))
+        expected = [conversation(i) for i in range(5)]
+        expected[3] = conversation(3, 'reply')
+        self.assertEqual(self.log.read(0), expected)
+        self.assertEqual(self.log.tail(2), expected[3:])
+        self.assertEqual(self.log.read(1, 3), expected[1:3])
+        self.reopen()
+        self.assertEqual(len(self.log), 5)
+        self.assertEqual(self.log.read(0), expected)
+        self.assertEqual(read_snapshot(self.path), expected)
+
+    def test_torn_last_line_is_truncated_on_open(self):
+        for i in range(3):
+            self.log.append(conversation(i))
+        self.log.close()
+        with open(self.path, 'ab') as f:
+            f.write(b'{"i": 3, "c": {"user_mess')
+        self.log = self.open_log()
+        self.assertEqual(len(self.log), 3)
+        self.assertEqual(self.log.append(conversation(3)), 3)
+        self.reopen()
+        self.assertEqual(self.log.read(0), [conversation(i) for i in range(4)])
+
+    def test_missing_index_is_rebuilt(self):
+        for i in range(4):
+            self.log.append(conversation(i))
+        self.log.update(1, conversation(1, 'reply'))
+        self.log.close()
+        os.remove(self.path + '.idx')
+        self.log = self.open_log()
+        self.assertEqual(self.log.read(1, 2), [conversation(1, 'reply')])
+        self.assertEqual(len(self.log), 4)
+        self.assertEqual(self.log.dead, 1)
+
+    def test_stale_index_is_rebuilt(self):
+        # The log got further than the index before a crash
+        for i in range(4):
+            self.log.append(conversation(i))
+        self.log.close()
+        with open(self.path + '.idx', 'r+b') as f:
+            f.truncate(INDEX_HEADER_BYTES + 2 * OFFSET_BYTES)
+        self.log = self.open_log()
+        self.assertEqual(self.log.read(0), [conversation(i) for i in range(4)])
+
+    def test_index_without_header_is_rebuilt(self):
+        for i in range(3):
+            self.log.append(conversation(i))
+        self.log.update(0, conversation(0, 'a'))
+        self.log.update(0, conversation(0, 'b'))
+        self.log.close()
+        with open(self.path + '.idx', 'r+b') as f:
+            f.seek(INDEX_HEADER_BYTES)
+            offsets = f.read()
+        with open(self.path + '.idx', 'wb') as f:
+            f.write(offsets)
+        self.log = self.open_log()
+        self.assertEqual(self.log.dead, 2)
+        self.assertEqual(self.log.read(0, 1), [conversation(0, 'b')])
+
+    def test_compacts_once_dead_lines_reach_the_threshold(self):
+        for i in range(10):
+            self.log.append(conversation(i))
+        for n in range(COMPACT_MIN_DEAD - 1):
+            self.log.update(n % 10, conversation(n % 10, f'reply {n}'))
+        self.assertEqual(self.line_count(), 10 + COMPACT_MIN_DEAD - 1)
+        expected = self.log.read(0)
+        # The dead count survives a reopen, so the next update still triggers compaction
+        self.reopen()
+        self.assertEqual(self.log.dead, COMPACT_MIN_DEAD - 1)
+        self.log.update(0, conversation(0, 'last'))
+        expected[0] = conversation(0, 'last')
+        self.assertEqual(self.line_count(), 10)
+        self.assertEqual(self.log.dead, 0)
+        self.assertEqual(self.log.read(0), expected)
+        self.reopen()
+        self.assertEqual(self.log.read(0), expected)
+
+    def test_large_logs_compact_at_half_the_live_lines(self):
+        live = COMPACT_MIN_DEAD * 4
+        for i in range(live):
+            self.log.append(conversation(i))
+        for i in range(live // 2 - 1):
+            self.log.update(i, conversation(i, 'reply'))
+        self.assertEqual(self.line_count(), live + live // 2 - 1)
+        self.log.update(live - 1, conversation(live - 1, 'reply'))
+        self.assertEqual(self.line_count(), live)
+
+    def test_legacy_json_is_imported_once(self):
+        self.log.close()
+        os.remove(self.path)
+        os.remove(self.path + '.idx')
+        conversations = [conversation(i, f'reply {i}') for i in range(3)]
+        with open(self.legacy_path, 'w') as f:
+            json.dump({'conversations': conversations}, f)
+        self.log = self.open_log()
+        self.assertEqual(self.log.read(0), conversations)
+        self.assertFalse(os.path.exists(self.legacy_path))
+        self.assertTrue(os.path.exists(self.legacy_path + '.migrated'))
+        self.log.append(conversation(3))
+        self.reopen()
+        self.assertEqual(len(self.log), 4)
+
+    def test_update_after_clear_is_refused_without_writing(self):
+        for i in range(3):
+            self.log.append(conversation(i))
+        self.log.clear()
+        with self.assertRaises(IndexError):
+            self.log.update(2, conversation(2, 'late reply'))
+        self.assertEqual(os.path.getsize(self.path), 0)
+        self.assertEqual(self.log.append(conversation(0)), 0)
+        self.reopen()
+        self.assertEqual(self.log.read(0), [conversation(0)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+
+from context_builder import ContextBuilder, ExtractiveSummarizer
+
+def count_words(text):
+    return len(text.split())
+
+def history(turns, words=6):
+    return [{'role': 'user' if i % 2 == 0 else 'model', 'parts': [{'text': ' '.join(['w'] * words)}]}
+            for i in range(turns)]
+
+class CountingSummarizer(ExtractiveSummarizer):
+    def __init__(self):
+        self.calls = []
+
+    def summarize(self, previous_summary, turns, max_tokens, count_tokens):
+        self.calls.append(len(turns))
+        return super().summarize(previous_summary, turns, max_tokens, count_tokens)
+
+class ContextBuilderTest(unittest.TestCase):
+    def build(self, builder, turns, budget):
+        return builder.build('user', {'chatHistory': turns}, budget=budget, system_prompt='sys')
+
+    def test_short_history_is_sent_whole(self):
+        builder = ContextBuilder(count_tokens=count_words)
+        context = self.build(builder, history(5), 1000)
+        self.assertEqual(context['summary'], '')
+        self.assertEqual(context['firstTurn'], 0)
+        self.assertEqual(len(context['turns']), 5)
+
+    def test_long_history_fits_the_budget(self):
+        builder = ContextBuilder(count_tokens=count_words)
+        turns = history(500)
+        for budget in (200, 600, 2000):
+            context = self.build(builder, turns, budget)
+            self.assertLessEqual(context['estimatedTokens'], budget)
+            self.assertTrue(context['summary'])
+            self.assertEqual(context['turns'], turns[context['firstTurn']:])
+
+    def test_summary_is_cached_and_extended_in_chunks(self):
+        summarizer = CountingSummarizer()
+        builder = ContextBuilder(summarizer=summarizer, count_tokens=count_words, chunk_turns=8)
+        turns = history(200)
+        first = self.build(builder, turns, 600)
+        self.assertEqual(summarizer.calls, [first['firstTurn']])
+
+        self.build(builder, turns, 600)
+        self.assertEqual(len(summarizer.calls), 1)
+
+        # A few more turns stay within the chunk boundary the summary already covers
+        self.build(builder, turns + history(2), 600)
+        self.assertEqual(len(summarizer.calls), 1)
+
+        grown = self.build(builder, turns + history(16), 600)
+        self.assertEqual(len(summarizer.calls), 2)
+        self.assertEqual(summarizer.calls[1], grown['firstTurn'] - first['firstTurn'])
+
+    def test_rewritten_history_is_summarized_again(self):
+        summarizer = CountingSummarizer()
+        builder = ContextBuilder(summarizer=summarizer, count_tokens=count_words)
+        self.build(builder, history(200), 600)
+        rewritten = history(200, words=7)
+        context = self.build(builder, rewritten, 600)
+        self.assertEqual(summarizer.calls[-1], context['firstTurn'])
+
+    def test_cached_summary_is_trimmed_to_a_smaller_budget(self):
+        # Both budgets round to the same summary boundary, so the second call reuses the
+        # summary built under the first call's larger summary budget
+        builder = ContextBuilder(count_tokens=count_words, summary_budget=10000, chunk_turns=50)
+        turns = history(200)
+        large = self.build(builder, turns, 1935)
+        small = self.build(builder, turns, 1401)
+        self.assertEqual(large['firstTurn'], small['firstTurn'])
+        self.assertGreater(count_words(large['summary']), count_words(small['summary']))
+        self.assertLessEqual(small['estimatedTokens'], 1401)
+
+    def test_entries_that_are_not_objects_are_tolerated(self):
+        builder = ContextBuilder(count_tokens=count_words)
+        turns = history(300)
+        turns[3] = 'a plain string turn'
+        turns[5] = None
+        context = self.build(builder, turns, 600)
+        self.assertLessEqual(context['estimatedTokens'], 600)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+import llm_proxy
+from llm_proxy import LLMProxy, ProviderError, StubProvider, retry_delay
+
+MESSAGES = [{'role': 'user', 'text': 'hello there'}]
+
+class ScriptedStub(StubProvider):
+    # Plays one scripted behaviour per attempt: 'fail' (retryable), 'fatal', 'slow', 'break'
+    # (fails after the first token) or 'ok'; attempts past the end of the script answer normally
+    def __init__(self, script, **kwargs):
+        super().__init__(first_token_delay=0.0, token_delay=0.0, **kwargs)
+        self.script = list(script)
+        self.attempts = []
+        self.lock = threading.Lock()
+
+    def stream(self, api_key, model, messages, system_prompt, config, cancel):
+        with self.lock:
+            step = self.script[len(self.attempts)] if len(self.attempts) < len(self.script) else 'ok'
+            attempt = {'step': step, 'cancel': cancel, 'finished': threading.Event()}
+            self.attempts.append(attempt)
+        try:
+            if step == 'fail':
+                raise ProviderError('stub provider failure', 503, True)
+            if step == 'fatal':
+                raise ProviderError('bad request', 400, False)
+            if step == 'slow' and cancel.wait(5.0):
+                return
+            for text in super().stream(api_key, model, messages, system_prompt, config, cancel):
+                yield text
+                if step == 'break':
+                    raise ProviderError('stream reset', 502, True)
+        finally:
+            attempt['finished'].set()
+
+def collect(proxy, **kwargs):
+    return ''.join(proxy.stream('stub', 'key', MESSAGES, **kwargs))
+
+class RetryTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(llm_proxy, 'retry_delay', side_effect=lambda attempt: 0.0)
+        self.retry_delay = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_retry_delay_is_jittered_within_the_backoff_cap(self):
+        for attempt in range(8):
+            cap = min(llm_proxy.RETRY_MAX_DELAY, llm_proxy.RETRY_BASE_DELAY * 2 ** attempt)
+            samples = [retry_delay(attempt) for _ in range(200)]
+            self.assertTrue(all(0 <= delay <= cap for delay in samples))
+            self.assertGreater(len(set(samples)), 1)
+
+    def test_retryable_failures_are_retried_until_a_token_arrives(self):
+        provider = ScriptedStub(['fail', 'fail'])
+        proxy = LLMProxy(providers=[provider], max_retries=2)
+        self.assertEqual(collect(proxy), 'You said: hello there')
+        self.assertEqual(len(provider.attempts), 3)
+        self.assertEqual([c.args for c in self.retry_delay.call_args_list], [(0,), (1,)])
+
+    def test_retries_stop_after_max_retries(self):
+        provider = StubProvider(first_token_delay=0.0, failure_rate=1.0)
+        proxy = LLMProxy(providers=[provider], max_retries=2)
+        with self.assertRaises(ProviderError) as raised:
+            collect(proxy)
+        self.assertEqual(raised.exception.status, 503)
+        self.assertEqual(self.retry_delay.call_count, 2)
+
+    def test_errors_that_are_not_retryable_are_raised_at_once(self):
+        provider = ScriptedStub(['fatal'])
+        with self.assertRaises(ProviderError):
+            collect(LLMProxy(providers=[provider]))
+        self.assertEqual(len(provider.attempts), 1)
+        self.assertEqual(self.retry_delay.call_count, 0)
+
+    def test_no_retry_once_text_has_been_sent(self):
+        provider = ScriptedStub(['break'])
+        chunks = []
+        with self.assertRaises(ProviderError):
+            for text in LLMProxy(providers=[provider]).stream('stub', 'key', MESSAGES):
+                chunks.append(text)
+        self.assertEqual(chunks, ['You'])
+        self.assertEqual(len(provider.attempts), 1)
+
+class HedgeTest(unittest.TestCase):
+    def test_slow_first_attempt_is_hedged_and_cancelled(self):
+        provider = ScriptedStub(['slow'], max_concurrency=4)
+        proxy = LLMProxy(providers=[provider], hedge_after=0.05)
+        started = time.monotonic()
+        self.assertEqual(collect(proxy, hedge=True), 'You said: hello there')
+        self.assertLess(time.monotonic() - started, 2.0)
+        self.assertEqual([a['step'] for a in provider.attempts], ['slow', 'ok'])
+        slow = provider.attempts[0]
+        self.assertTrue(slow['cancel'].is_set())
+        self.assertTrue(slow['finished'].wait(1.0))
+        # The cancelled attempt gave its slot back
+        for _ in range(4):
+            self.assertTrue(provider.slots.acquire(timeout=1.0))
+
+    def test_fast_first_attempt_is_not_hedged(self):
+        provider = ScriptedStub([])
+        proxy = LLMProxy(providers=[provider], hedge_after=1.0)
+        self.assertEqual(collect(proxy, hedge=True), 'You said: hello there')
+        self.assertEqual(len(provider.attempts), 1)
+
+    def test_hedge_needs_a_free_slot(self):
+        provider = ScriptedStub(['slow'], max_concurrency=1)
+        proxy = LLMProxy(providers=[provider], hedge_after=0.05)
+        result = []
+        thread = threading.Thread(target=lambda: result.append(collect(proxy, hedge=True)))
+        thread.start()
+        time.sleep(0.3)
+        # The only slot is held by the slow attempt, so the hedge fails without a second call
+        self.assertEqual(len(provider.attempts), 1)
+        provider.attempts[0]['cancel'].set()
+        thread.join(5.0)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(result, [''])
+
+if __name__ == '__main__':
+    unittest.main()
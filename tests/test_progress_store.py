@@ -0,0 +1,356 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import server
+from progress_store import (JOURNAL_SEQ_FIELD, FileProgressStore, SQLiteProgressStore,
+                            WriteBehindStore, atomic_write_json)
+
+def turns(start, count):
+    return [{'role': 'user' if i % 2 == 0 else 'model', 'parts': [{'text': f'turn {i}'}]}
+            for i in range(start, start + count)]
+
+class StoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir, True)
+        self.store = self.open_store()
+        self.addCleanup(lambda: self.store.close())
+
+    def reopen(self):
+        self.store.close()
+        self.store = self.open_store()
+
+class BackendCases:
+    # Run against every backend, so the two stay interchangeable behind ProgressHandler
+    def test_missing_user(self):
+        self.assertIsNone(self.store.load('nobody'))
+        self.assertFalse(self.store.exists('nobody'))
+        self.assertEqual(self.store.load_tail('nobody', 10), (None, 0, 0))
+        self.assertEqual(self.store.history_page('nobody', None, 10), ([], 0, 0, 0))
+        self.assertEqual(self.store.history_length('nobody'), 0)
+
+    def test_save_and_load(self):
+        progress = {'level': 3, 'name': 'x', 'chatHistory': turns(0, 5)}
+        self.store.save('u', progress)
+        self.assertTrue(self.store.exists('u'))
+        self.assertEqual(self.store.load('u'), progress)
+        self.reopen()
+        self.assertEqual(self.store.load('u'), progress)
+
+    def test_save_without_history(self):
+        self.store.save('u', {'level': 1})
+        self.assertEqual(self.store.load('u'), {'level': 1})
+        self.assertEqual(self.store.history_length('u'), 0)
+
+    def test_append_extends_history_and_updates_fields(self):
+        self.store.save('u', {'level': 1, 'chatHistory': turns(0, 3)})
+        self.store.append('u', turns(3, 2), {'level': 2})
+        self.store.append('u', turns(5, 1), {'mood': 'ok'})
+        self.assertEqual(self.store.load('u'), {'level': 2, 'mood': 'ok', 'chatHistory': turns(0, 6)})
+        self.reopen()
+        self.assertEqual(self.store.load('u'), {'level': 2, 'mood': 'ok', 'chatHistory': turns(0, 6)})
+
+    def test_append_to_missing_user(self):
+        self.store.append('u', turns(0, 2), {'level': 1})
+        self.assertEqual(self.store.load('u'), {'level': 1, 'chatHistory': turns(0, 2)})
+
+    def test_save_replaces_appended_history(self):
+        self.store.save('u', {'chatHistory': turns(0, 3)})
+        self.store.append('u', turns(3, 3), {})
+        self.store.save('u', {'level': 5, 'chatHistory': turns(0, 2)})
+        self.assertEqual(self.store.load('u'), {'level': 5, 'chatHistory': turns(0, 2)})
+        self.store.append('u', turns(2, 1), {})
+        self.assertEqual(self.store.load('u')['chatHistory'], turns(0, 3))
+
+    def test_load_tail(self):
+        self.store.save('u', {'level': 1, 'chatHistory': turns(0, 10)})
+        self.store.append('u', turns(10, 2), {})
+        progress, start, total = self.store.load_tail('u', 5)
+        self.assertEqual((start, total), (7, 12))
+        self.assertEqual(progress, {'level': 1, 'chatHistory': turns(7, 5)})
+        progress, start, total = self.store.load_tail('u', 50)
+        self.assertEqual((start, total, progress['chatHistory']), (0, 12, turns(0, 12)))
+
+    def test_history_page_and_ranges(self):
+        self.store.save('u', {'chatHistory': turns(0, 20)})
+        self.assertEqual(self.store.history_page('u', None, 5), (turns(15, 5), 15, 20, 20))
+        self.assertEqual(self.store.history_page('u', 15, 5), (turns(10, 5), 10, 15, 20))
+        self.assertEqual(self.store.history_page('u', 3, 5), (turns(0, 3), 0, 3, 20))
+        self.assertEqual(self.store.history_page('u', 100, 2), (turns(18, 2), 18, 20, 20))
+        self.assertEqual(self.store.load_history('u', 4, 7), turns(4, 3))
+        self.assertEqual(self.store.load_history('u', 18), turns(18, 2))
+        self.assertEqual(self.store.history_length('u'), 20)
+
+    def test_update_reads_and_writes_under_the_lock(self):
+        seen = []
+
+        def add_level(progress):
+            seen.append(progress)
+            return dict(progress or {}, level=len(seen))
+
+        self.assertTrue(self.store.update('u', add_level))
+        self.store.append('u', turns(0, 2), {})
+        self.assertTrue(self.store.update('u', add_level))
+        self.assertEqual(seen, [None, {'level': 1, 'chatHistory': turns(0, 2)}])
+        self.assertFalse(self.store.update('u', lambda progress: None))
+        self.assertEqual(self.store.load('u'), {'level': 2, 'chatHistory': turns(0, 2)})
+
+    def test_version_changes_on_every_write(self):
+        seen = [self.store.version('u')]
+        self.store.save('u', {'chatHistory': turns(0, 1)})
+        seen.append(self.store.version('u'))
+        self.store.append('u', turns(1, 1), {})
+        seen.append(self.store.version('u'))
+        self.store.save('u', {'chatHistory': turns(0, 1)})
+        seen.append(self.store.version('u'))
+        self.assertEqual(len(set(seen)), len(seen))
+        self.assertEqual(self.store.version('u'), self.store.version('u'))
+
+class FileProgressStoreTest(BackendCases, StoreTestCase):
+    def open_store(self):
+        return FileProgressStore(self.data_dir)
+
+    def test_journal_replays_on_load(self):
+        self.store.save('u', {'chatHistory': turns(0, 2)})
+        for i in range(2, 6):
+            self.store.append('u', turns(i, 1), {'last': i})
+        with open(self.store.journal_path('u')) as f:
+            self.assertEqual([json.loads(line)['seq'] for line in f], [1, 2, 3, 4])
+        self.reopen()
+        self.assertEqual(self.store.load('u'), {'last': 5, 'chatHistory': turns(0, 6)})
+
+    def test_crash_between_snapshot_and_journal_reset(self):
+        # The snapshot records the last sequence it contains, so the deltas still in the journal
+        # are not applied a second time
+        self.store.save('u', {'chatHistory': turns(0, 2)})
+        for i in range(2, 5):
+            self.store.append('u', turns(i, 1), {})
+        atomic_write_json(self.store.snapshot_path('u'), {'chatHistory': turns(0, 5), JOURNAL_SEQ_FIELD: 3})
+        self.reopen()
+        self.assertEqual(self.store.load('u'), {'chatHistory': turns(0, 5)})
+        self.assertEqual(self.store.append('u', turns(5, 1), {}), 4)
+        self.assertEqual(self.store.load('u'), {'chatHistory': turns(0, 6)})
+
+    def test_compacted_sequence_continues_without_a_journal(self):
+        self.store.append('u', turns(0, 2), {})
+        self.store.compact('u')
+        os.remove(self.store.journal_path('u'))
+        self.reopen()
+        self.assertEqual(self.store.append('u', turns(2, 1), {}), 2)
+        self.assertEqual(self.store.load('u'), {'chatHistory': turns(0, 3)})
+
+    def test_torn_journal_line_is_dropped(self):
+        self.store.save('u', {'chatHistory': turns(0, 1)})
+        self.store.append('u', turns(1, 1), {})
+        with open(self.store.journal_path('u'), 'a') as f:
+            f.write('{"seq": 2, "turns": [{"role": "us')
+        self.reopen()
+        self.assertEqual(self.store.load('u'), {'chatHistory': turns(0, 2)})
+        self.assertEqual(self.store.append('u', turns(2, 1), {}), 2)
+        self.assertEqual(self.store.load('u'), {'chatHistory': turns(0, 3)})
+
+class SQLiteProgressStoreTest(BackendCases, StoreTestCase):
+    def open_store(self):
+        return SQLiteProgressStore(data_dir=self.data_dir)
+
+    def stored_rows(self, storage_id):
+        return [json.loads(turn) for (turn,) in self.store._connection().execute(
+            'SELECT turn FROM turns WHERE user_id = ? ORDER BY idx', (storage_id,))]
+
+    def test_save_keeps_prefix_and_rewrites_from_first_change(self):
+        history = turns(0, 6)
+        self.store.save('u', {'chatHistory': history})
+        self.store.save('u', {'chatHistory': history + turns(6, 2)})
+        self.assertEqual(self.stored_rows('u'), turns(0, 8))
+
+        edited = turns(0, 8)
+        edited[2] = {'role': 'user', 'parts': [{'text': 'edited'}]}
+        self.store.save('u', {'chatHistory': edited})
+        self.assertEqual(self.stored_rows('u'), edited)
+
+        self.store.save('u', {'chatHistory': edited[:4]})
+        self.assertEqual(self.stored_rows('u'), edited[:4])
+        self.assertEqual(self.store.load('u'), {'chatHistory': edited[:4]})
+
+    def test_edit_of_last_turn_only(self):
+        self.store.save('u', {'chatHistory': turns(0, 3)})
+        edited = turns(0, 3)
+        edited[-1] = {'role': 'user', 'parts': [{'text': 'changed'}]}
+        self.store.save('u', {'chatHistory': edited})
+        self.assertEqual(self.store.load('u')['chatHistory'], edited)
+
+    def test_reads_see_one_version_while_another_connection_writes(self):
+        # Every saved document has count == len(chatHistory); a read mixing the progress row of
+        # one save with the turns of another would break that
+        stop = threading.Event()
+        writer_store = self.open_store()
+        self.addCleanup(writer_store.close)
+
+        def write():
+            n = 1
+            while not stop.is_set():
+                n = n % 40 + 1
+                writer_store.save('u', {'count': n, 'chatHistory': turns(0, n)})
+
+        self.store.save('u', {'count': 1, 'chatHistory': turns(0, 1)})
+        thread = threading.Thread(target=write)
+        thread.start()
+        try:
+            deadline = time.monotonic() + 0.5
+            while time.monotonic() < deadline:
+                progress = self.store.load('u')
+                self.assertEqual(progress['count'], len(progress['chatHistory']))
+                tail, start, total = self.store.load_tail('u', 5)
+                self.assertEqual(tail['count'], total)
+                self.assertEqual(len(tail['chatHistory']), total - start)
+        finally:
+            stop.set()
+            thread.join()
+
+class RecordingStore(FileProgressStore):
+    def __init__(self, data_dir, failures=0):
+        super().__init__(data_dir)
+        self.saves = []
+        self.failures = failures
+
+    def save(self, storage_id, progress):
+        if self.failures:
+            self.failures -= 1
+            raise OSError('disk full')
+        self.saves.append((storage_id, progress))
+        super().save(storage_id, progress)
+
+class WriteBehindStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir, True)
+
+    def open_store(self, window=60.0, failures=0):
+        self.backend = RecordingStore(self.data_dir, failures)
+        store = WriteBehindStore(self.backend, window=window)
+        self.addCleanup(store.close)
+        return store
+
+    def wait_for(self, condition, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_saves_within_a_window_collapse_into_one_write(self):
+        store = self.open_store(window=0.2)
+        for n in range(1, 51):
+            store.save('u', {'count': n, 'chatHistory': turns(0, n)})
+        self.wait_for(lambda: self.backend.saves)
+        time.sleep(0.3)
+        self.assertEqual(self.backend.saves, [('u', {'count': 50, 'chatHistory': turns(0, 50)})])
+
+    def test_pending_save_is_readable_before_it_is_written(self):
+        store = self.open_store()
+        self.backend.save('u', {'level': 1, 'chatHistory': turns(0, 2)})
+        written_version = store.version('u')
+        progress = {'level': 2, 'chatHistory': turns(0, 10)}
+        store.save('u', progress)
+        store.save('v', {'level': 7})
+
+        self.assertEqual(self.backend.load('u'), {'level': 1, 'chatHistory': turns(0, 2)})
+        self.assertEqual(store.load('u'), progress)
+        self.assertEqual(store.load_tail('u', 3), ({'level': 2, 'chatHistory': turns(7, 3)}, 7, 10))
+        self.assertEqual(store.history_page('u', 5, 2), (turns(3, 2), 3, 5, 10))
+        self.assertEqual(store.load_history('u', 8), turns(8, 2))
+        self.assertEqual(store.history_length('u'), 10)
+        self.assertNotEqual(store.version('u'), written_version)
+        self.assertTrue(store.exists('v'))
+        self.assertFalse(self.backend.exists('v'))
+
+    def test_append_writes_the_pending_document_first(self):
+        store = self.open_store()
+        store.save('u', {'level': 1, 'chatHistory': turns(0, 3)})
+        store.append('u', turns(3, 2), {'level': 2})
+        self.assertEqual(len(self.backend.saves), 1)
+        self.assertEqual(self.backend.load('u'), {'level': 2, 'chatHistory': turns(0, 5)})
+        self.assertEqual(store.load('u'), {'level': 2, 'chatHistory': turns(0, 5)})
+
+    def test_close_drains_every_pending_save(self):
+        store = self.open_store()
+        for i in range(20):
+            store.save(f'user{i}', {'n': i})
+        store.save('user0', {'n': 'latest'})
+        store.close()
+        reopened = FileProgressStore(self.data_dir)
+        self.addCleanup(reopened.close)
+        self.assertEqual(reopened.load('user0'), {'n': 'latest'})
+        self.assertEqual([reopened.load(f'user{i}') for i in range(1, 20)], [{'n': i} for i in range(1, 20)])
+        self.assertEqual(len(self.backend.saves), 20)
+
+    def test_update_sees_the_pending_save(self):
+        store = self.open_store()
+        store.save('u', {'level': 1})
+        self.assertTrue(store.update('u', lambda progress: dict(progress, level=progress['level'] + 1)))
+        self.assertEqual(self.backend.load('u'), {'level': 2})
+        self.assertEqual(store.load('u'), {'level': 2})
+
+    def test_failed_write_is_retried(self):
+        store = self.open_store(window=0.05, failures=1)
+        with mock.patch('builtins.print'):
+            store.save('u', {'level': 3})
+            self.wait_for(lambda: self.backend.saves)
+        self.assertEqual(self.backend.saves, [('u', {'level': 3})])
+        self.assertEqual(store.load('u'), {'level': 3})
+
+class BackendParityTest(unittest.TestCase):
+    def test_same_operations_give_same_documents(self):
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, data_dir, True)
+        stores = [FileProgressStore(os.path.join(data_dir, 'files')),
+                  SQLiteProgressStore(data_dir=os.path.join(data_dir, 'sqlite'))]
+        for store in stores:
+            self.addCleanup(store.close)
+            store.save('u', {'level': 1, 'chatHistory': turns(0, 4)})
+            store.append('u', turns(4, 3), {'level': 2})
+            store.save('v', {'settings': {'theme': 'dark'}})
+            store.append('v', turns(0, 1), {})
+            store.save('u', store.load('u') | {'chatHistory': turns(0, 6)})
+        for storage_id in ('u', 'v'):
+            self.assertEqual(stores[0].load(storage_id), stores[1].load(storage_id))
+            self.assertEqual(stores[0].load_tail(storage_id, 3), stores[1].load_tail(storage_id, 3))
+            self.assertEqual(stores[0].history_page(storage_id, 4, 2), stores[1].history_page(storage_id, 4, 2))
+
+class ImportJsonTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir, True)
+        key_file = os.path.join(self.data_dir, 'encryption.key')
+        for patcher in (mock.patch.object(server, 'ENCRYPTION_KEY_FILE', key_file),
+                        mock.patch.object(server.APIKeyManager, '_shared', None)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_snapshots_and_journals_are_imported(self):
+        source = FileProgressStore(self.data_dir)
+        hashed = '0123456789abcdef'
+        source.save(hashed, {'level': 1, 'chatHistory': turns(0, 2)})
+        source.append(hashed, turns(2, 2), {'level': 2})
+        source.close()
+        with open(os.path.join(self.data_dir, 'raw-api-key.json'), 'w') as f:
+            json.dump({'legacy': True}, f)
+        with open(os.path.join(self.data_dir, 'broken.json'), 'w') as f:
+            f.write('{not json')
+
+        target = SQLiteProgressStore(path=os.path.join(self.data_dir, 'import.db'))
+        self.addCleanup(target.close)
+        with mock.patch('builtins.print'):
+            self.assertEqual(server.import_json_progress(target, self.data_dir), 2)
+        self.assertEqual(target.load(hashed), {'level': 2, 'chatHistory': turns(0, 4)})
+        legacy_id = server.APIKeyManager.shared().hash_user_id('raw-api-key')
+        self.assertEqual(target.load(legacy_id), {'legacy': True})
+        self.assertTrue(os.path.exists(os.path.join(self.data_dir, 'raw-api-key.json')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+import io
+import json
+import unittest
+
+from request_limits import AdmissionController, RequestRejected, parse_json_stream
+
+DOCUMENTS = [
+    {'apiKey': 'k', 'progress': {'level': 3, 'chatHistory': [
+        {'role': 'user', 'parts': [{'text': 'héllo 👋 "quoted" \\ back\nslash'}]},
+        {'role': 'model', 'parts': [{'text': 'x' * 300}]},
+    ], 'score': 123456789, 'ratio': -1.25e-7, 'flags': [True, False, None], 'empty': {}, 'none': []}},
+    [1, 22, 333, {'a': [4444, 55555]}],
+    {'nested': {'deeper': {'deepest': [1, {'x': 'y'}]}}},
+    1234567,
+    'just a string',
+    [],
+    {},
+]
+
+class ShortReads:
+    # A body that arrives a few bytes at a time, whatever read() asks for
+    def __init__(self, data, most):
+        self.data = io.BytesIO(data)
+        self.most = most
+
+    def read(self, n):
+        return self.data.read(min(n, self.most))
+
+def parse(data, chunk_size=4, most=None, length=None):
+    reader = ShortReads(data, most) if most else io.BytesIO(data)
+    return parse_json_stream(reader.read, len(data) if length is None else length, chunk_size)
+
+class ParseJSONStreamTest(unittest.TestCase):
+    def test_matches_json_loads_for_any_split(self):
+        for document in DOCUMENTS:
+            for text in (json.dumps(document), json.dumps(document, indent=2, ensure_ascii=False)):
+                data = text.encode()
+                for chunk_size in (1, 2, 3, 5, 64, 1 << 20):
+                    with self.subTest(document=text[:40], chunk_size=chunk_size):
+                        self.assertEqual(parse(data, chunk_size), document)
+                self.assertEqual(parse(data, 8, most=3), document)
+
+    def test_numbers_split_across_reads(self):
+        # A number cut at a chunk boundary must not be decoded from its first digits only
+        data = b'{"progress": {"a": 1234567890, "b": [9876543210, 1.5e10]}}'
+        for chunk_size in range(1, len(data) + 1):
+            self.assertEqual(parse(data, chunk_size), json.loads(data))
+
+    def test_multibyte_characters_split_across_reads(self):
+        data = json.dumps({'progress': {'text': 'ü€𝄞' * 50}}, ensure_ascii=False).encode()
+        for chunk_size in (1, 2, 3):
+            self.assertEqual(parse(data, chunk_size), json.loads(data))
+
+    def test_oversized_turn_is_decoded_whole(self):
+        turn = {'role': 'user', 'parts': [{'text': 'long ' * 400000}]}
+        data = json.dumps({'progress': {'chatHistory': [turn, turn]}}).encode()
+        self.assertEqual(parse(data, chunk_size=1024), {'progress': {'chatHistory': [turn, turn]}})
+
+    def test_malformed_bodies_raise_value_error(self):
+        for data in (b'{"a": 1', b'{"a": 1}}', b'{"a" 1}', b'{"a": 1,}', b'[1, 2,]', b'{a: 1}',
+                     b'{"a": tru}', b'{"progress": {"x": [1 2]}}', b'', b'   ', b'{"a": "\xff"}'):
+            with self.subTest(data=data):
+                with self.assertRaises(ValueError):
+                    parse(data, 2)
+
+    def test_body_shorter_than_its_length(self):
+        with self.assertRaises(ValueError):
+            parse(b'{"a": [1, 2, 3]}', 4, length=100)
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class AdmissionControllerTest(unittest.TestCase):
+    def controller(self, **kwargs):
+        self.clock = FakeClock()
+        options = dict(max_concurrent=100, max_client_concurrent=100, client_rate=0, client_burst=1,
+                       body_memory=1000)
+        options.update(kwargs)
+        return AdmissionController(clock=self.clock, **options)
+
+    def assert_rejected(self, admission, status, reason, *args, **kwargs):
+        with self.assertRaises(RequestRejected) as raised:
+            admission.admit(*args, **kwargs)
+        self.assertEqual((raised.exception.status, raised.exception.reason), (status, reason))
+        return raised.exception
+
+    def test_token_bucket_allows_a_burst_then_refills(self):
+        admission = self.controller(client_rate=2.0, client_burst=3)
+        for _ in range(3):
+            admission.release(admission.admit('a'))
+        rejected = self.assert_rejected(admission, 429, 'rate_limited', 'a')
+        self.assertEqual(rejected.retry_after, 1)
+        # Other clients have buckets of their own
+        admission.release(admission.admit('b'))
+        self.clock.now += 0.5
+        admission.release(admission.admit('a'))
+        self.assert_rejected(admission, 429, 'rate_limited', 'a')
+
+    def test_retry_after_rounds_the_wait_up(self):
+        admission = self.controller(client_rate=0.25, client_burst=1)
+        admission.release(admission.admit('a'))
+        self.assertEqual(self.assert_rejected(admission, 429, 'rate_limited', 'a').retry_after, 4)
+        self.clock.now += 3
+        self.assertEqual(self.assert_rejected(admission, 429, 'rate_limited', 'a').retry_after, 1)
+        self.clock.now += 1
+        admission.admit('a')
+
+    def test_rejected_requests_do_not_count_against_concurrency(self):
+        admission = self.controller(client_rate=1.0, client_burst=1, max_client_concurrent=1)
+        ticket = admission.admit('a')
+        self.assert_rejected(admission, 429, 'rate_limited', 'a')
+        self.assertEqual(admission.in_flight(), (1, 0))
+        admission.release(ticket)
+        self.assertEqual(admission.in_flight(), (0, 0))
+
+    def test_per_client_concurrency(self):
+        admission = self.controller(max_client_concurrent=2)
+        tickets = [admission.admit('a'), admission.admit('a')]
+        rejected = self.assert_rejected(admission, 429, 'client_concurrency', 'a')
+        self.assertEqual(rejected.retry_after, 1)
+        admission.release(admission.admit('b'))
+        admission.release(tickets.pop())
+        tickets.append(admission.admit('a'))
+
+    def test_global_concurrency(self):
+        admission = self.controller(max_concurrent=2)
+        first = admission.admit('a')
+        admission.admit('b')
+        self.assert_rejected(admission, 503, 'overloaded', 'c')
+        # Endpoints outside admission control still get through
+        admission.release(admission.admit('c', limited=False))
+        admission.release(first)
+        admission.admit('c')
+
+    def test_body_memory_budget(self):
+        admission = self.controller(body_memory=1000)
+        # A single body is let through even above the budget
+        big = admission.admit('a', 5000)
+        self.assert_rejected(admission, 503, 'body_memory', 'b', 10)
+        self.assert_rejected(admission, 503, 'body_memory', 'b', 10, limited=False)
+        admission.admit('b')  # no body, no budget needed
+        admission.release(big)
+        small = admission.admit('b', 600)
+        self.assert_rejected(admission, 503, 'body_memory', 'c', 500)
+        admission.admit('c', 400)
+        admission.release(small)
+        self.assertEqual(admission.in_flight(), (2, 400))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import subprocess
+import sys
+import unittest
+
+from response_cache import ResponseCache
+
+def messages(*texts):
+    return [{'role': 'user' if i % 2 == 0 else 'assistant', 'text': text} for i, text in enumerate(texts)]
+
+class ResponseCacheTest(unittest.TestCase):
+    def test_key_ignores_case_whitespace_and_older_turns(self):
+        cache = ResponseCache(context_turns=2)
+        key = cache.key('gemini', 'm', {'temperature': 0.7}, 'sys', messages('old', 'a', 'b', 'Hi  there'))
+        self.assertEqual(key, cache.key('gemini', 'm', {'temperature': 0.7}, 'sys',
+                                        messages('different', 'A', ' b', 'hi there')))
+        self.assertNotEqual(key, cache.key('gemini', 'm', {'temperature': 0.8}, 'sys',
+                                           messages('old', 'a', 'b', 'Hi  there')))
+        self.assertNotEqual(key, cache.key('gemini', 'm', {'temperature': 0.7}, 'other',
+                                           messages('old', 'a', 'b', 'Hi  there')))
+
+    def test_stored_gemini_turns_key_like_plain_messages(self):
+        cache = ResponseCache()
+        turns = [{'role': 'user', 'parts': [{'text': 'hello'}]}, {'role': 'model', 'parts': [{'text': 'hey'}]}]
+        self.assertEqual(cache.key('gemini', 'm', None, None, turns),
+                         cache.key('gemini', 'm', None, None, messages('hello', 'hey')))
+
+    def test_entries_expire(self):
+        now = [0.0]
+        cache = ResponseCache(ttl=10, clock=lambda: now[0])
+        cache.put('k', 'reply')
+        self.assertEqual(cache.get('k'), 'reply')
+        now[0] = 11.0
+        self.assertIsNone(cache.get('k'))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_disabled_for_uncached_personalities_and_zero_size(self):
+        self.assertFalse(ResponseCache(uncached_personalities=['flirty']).enabled_for('flirty'))
+        self.assertTrue(ResponseCache(uncached_personalities=['flirty']).enabled_for('sweet'))
+        self.assertFalse(ResponseCache(max_entries=0).enabled_for())
+
+    def test_import_does_not_load_the_network_stack(self):
+        # chatbot.py imports this module before its window opens
+        code = ('import sys, response_cache\n'
+                'print(sorted(m for m in ("llm_proxy", "http.client", "ssl") if m in sys.modules))')
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(result.stdout.strip(), '[]')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+import gzip
+import http.client
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import server
+from progress_store import ByteLRUCache, FileProgressStore
+from static_assets import StaticAssetCache
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+class ServerTestCase(unittest.TestCase):
+    # Runs a real server on a free port with its data dir, key file and caches in a temp dir
+    mode = 'threaded'
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir, True)
+        store = FileProgressStore(self.data_dir)
+        self.addCleanup(store.close)
+        assets = StaticAssetCache(root=self.data_dir, names=('app.js',))
+        with open(os.path.join(self.data_dir, 'app.js'), 'w') as f:
+            f.write('console.log("hello");\n' * 100)
+        for name, value in (('progress_store', store),
+                            ('progress_cache', ByteLRUCache(1024 * 1024)),
+                            ('static_assets', assets),
+                            ('ENCRYPTION_KEY_FILE', os.path.join(self.data_dir, 'encryption.key'))):
+            patcher = mock.patch.object(server, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(server.APIKeyManager, '_shared', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.port = free_port()
+        self.server = server.build_server(self.mode, ('127.0.0.1', self.port), workers=4)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.stop_server, thread)
+        self.wait_until_listening()
+
+    def stop_server(self, thread):
+        self.server.shutdown()
+        thread.join(5)
+        self.server.server_close()
+
+    def wait_until_listening(self):
+        for _ in range(200):
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return
+            except OSError:
+                threading.Event().wait(0.01)
+        self.fail('server did not start')
+
+    def request(self, method, path, body=None, headers=None):
+        # A fresh connection per request, so idle keep-alive connections don't hold the workers
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        try:
+            if isinstance(body, dict):
+                body = json.dumps(body).encode()
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            return response, response.read()
+        finally:
+            connection.close()
+
+class EncodingETagTest(ServerTestCase):
+    def assert_variants(self, path):
+        plain, _ = self.request('GET', path)
+        compressed, body = self.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(compressed.getheader('Content-Encoding'), 'gzip')
+        gzip.decompress(body)
+        plain_tag, gzip_tag = plain.getheader('ETag'), compressed.getheader('ETag')
+        self.assertNotEqual(plain_tag, gzip_tag)
+
+        # A validator only matches the representation it was issued for
+        response, _ = self.request('GET', path, headers={'Accept-Encoding': 'gzip', 'If-None-Match': gzip_tag})
+        self.assertEqual((response.status, response.getheader('ETag')), (304, gzip_tag))
+        response, _ = self.request('GET', path, headers={'If-None-Match': plain_tag})
+        self.assertEqual((response.status, response.getheader('ETag')), (304, plain_tag))
+        response, _ = self.request('GET', path, headers={'If-None-Match': gzip_tag})
+        self.assertEqual((response.status, response.getheader('ETag')), (200, plain_tag))
+        response, _ = self.request('GET', path, headers={'Accept-Encoding': 'gzip', 'If-None-Match': plain_tag})
+        self.assertEqual((response.status, response.getheader('ETag')), (200, gzip_tag))
+
+    def test_static_asset_encodings_have_their_own_etags(self):
+        self.assert_variants('/app.js')
+
+    def test_cached_progress_encodings_have_their_own_etags(self):
+        turns = [{'role': 'user', 'parts': [{'text': f'message {i}'}]} for i in range(100)]
+        response, _ = self.request('POST', '/save-progress',
+                                   {'apiKey': 'key', 'progress': {'chatHistory': turns}})
+        self.assertEqual(response.status, 200)
+        token = server.APIKeyManager.shared().encrypt_key('key')
+        self.assert_variants(f'/load-progress?apiKey={token}')
+
+class ExpectContinueTest(ServerTestCase):
+    def send_head(self, sock, body_length, path='/save-progress'):
+        sock.sendall((f'POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+                      f'Content-Length: {body_length}\r\nExpect: 100-continue\r\n\r\n').encode())
+
+    def read_head(self, reader):
+        # (status, headers) of the next response on the connection
+        status = int(reader.readline().split()[1])
+        headers = {}
+        for line in iter(reader.readline, b'\r\n'):
+            name, _, value = line.decode().partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return status, headers
+
+    def test_body_is_requested_before_it_is_read(self):
+        body = json.dumps({'apiKey': 'key', 'progress': {'level': 1}}).encode()
+        with socket.create_connection(('127.0.0.1', self.port), timeout=1.0) as sock:
+            reader = sock.makefile('rb')
+            self.send_head(sock, len(body))
+            # Within a second, long before a client's expect timeout
+            self.assertEqual(self.read_head(reader)[0], 100)
+            sock.sendall(body)
+            # The final response follows directly, with no second interim one
+            status, headers = self.read_head(reader)
+            self.assertEqual(status, 200)
+            reader.read(int(headers['content-length']))
+        self.assertEqual(server.progress_store.load(server.APIKeyManager.shared().hash_user_id('key')),
+                         {'level': 1})
+
+    def test_refused_request_gets_a_final_status_instead(self):
+        with socket.create_connection(('127.0.0.1', self.port), timeout=1.0) as sock:
+            reader = sock.makefile('rb')
+            self.send_head(sock, 10 * 1024 * 1024, path='/build-context')
+            self.assertEqual(self.read_head(reader)[0], 413)
+
+class AsyncioExpectContinueTest(ExpectContinueTest):
+    mode = 'asyncio'
+
+class LegacyMigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        # Legacy files are looked up as data/<raw key>.json relative to the working directory
+        cwd = os.getcwd()
+        os.chdir(self.dir)
+        self.addCleanup(os.chdir, cwd)
+        os.makedirs('data')
+        self.store = FileProgressStore('data')
+        self.addCleanup(self.store.close)
+        patcher = mock.patch.object(server, 'progress_store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.write_legacy({'level': 1})
+
+    def write_legacy(self, progress):
+        with open(os.path.join('data', 'raw-key.json'), 'w') as f:
+            json.dump(progress, f)
+
+    def test_legacy_file_moves_to_the_hashed_id(self):
+        server.migrate_legacy_progress('raw-key', 'hashed')
+        self.assertEqual(self.store.load('hashed'), {'level': 1})
+        self.assertFalse(os.path.exists(os.path.join('data', 'raw-key.json')))
+
+    def test_newer_hashed_document_is_kept(self):
+        # Another worker migrated the file and took an append before this one got the lock;
+        # the legacy file it still sees is stale
+        self.store.save('hashed', {'level': 1})
+        self.store.append('hashed', [{'role': 'user', 'parts': [{'text': 'new'}]}], {'level': 2})
+        server.migrate_legacy_progress('raw-key', 'hashed')
+        self.assertEqual(self.store.load('hashed'),
+                         {'level': 2, 'chatHistory': [{'role': 'user', 'parts': [{'text': 'new'}]}]})
+        self.assertFalse(os.path.exists(os.path.join('data', 'raw-key.json')))
+
+if __name__ == '__main__':
+    unittest.main()